@@ -0,0 +1,269 @@
+# artifact_store.py
+# Content-addressed storage for games_repo. Every file (uploaded zips and the
+# files extracted from them) is stored once under its sha256 in .blobs/, and
+# each installed game version is a tree in .trees/<game_id>/<version>.json
+# mapping paths to blobs. Installed game directories are hard links to blobs,
+# so a file shared by several versions or games takes disk space only once.
+import os
+import json
+import shutil
+import hashlib
+import stat
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: a single lobby process owns the store
+
+
+def _make_writable_and_retry(func, path, _exc_info):
+    # Blobs are read-only; Windows refuses to unlink read-only files
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+def remove_dir(path):
+    if os.path.exists(path):
+        shutil.rmtree(path, onerror=_make_writable_and_retry)
+
+
+class ArtifactStore:
+    """Blobs addressed by sha256, per-version trees and blob reference counts.
+
+    Reference counts live in memory and are rebuilt from the trees by load(),
+    so the trees on disk are the only state that has to stay consistent. A
+    blob whose count drops to zero is deleted by the next collect(). Blobs a
+    caller has written but not yet referenced from a tree are pinned through
+    staging() so a concurrent collect() cannot remove them. Thread-safe.
+
+    With shared=True several processes use the store (POSIX only): staging()
+    also holds a shared file lock, collect() skips its run while any process
+    is staging and re-reads the trees first, since other processes add and
+    remove them.
+    """
+
+    def __init__(self, root, shared=False):
+        self.root = root
+        self.shared = shared
+        self.blob_dir = os.path.join(root, ".blobs")
+        self.tree_dir = os.path.join(root, ".trees")
+        self._lock = threading.Lock()
+        self._refs = Counter()     # sha256 -> trees referencing it
+        self._pending = Counter()  # sha256 -> staging() blocks pinning it
+
+    # ---------- blobs ----------
+
+    def blob_path(self, sha):
+        return os.path.join(self.blob_dir, sha[:2], sha)
+
+    def has_blob(self, sha):
+        return os.path.exists(self.blob_path(sha))
+
+    def _process_lock(self, mode):
+        """Open and flock the store's lock file; closing the file releases it."""
+        os.makedirs(self.root, exist_ok=True)
+        f = open(os.path.join(self.root, ".lock"), "a")
+        try:
+            fcntl.flock(f, mode)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    @contextmanager
+    def staging(self):
+        """Pin blobs written inside the block until it exits (by then a tree references them)."""
+        pinned = []
+        process_lock = self._process_lock(fcntl.LOCK_SH) if self.shared else None
+        try:
+            yield pinned
+        finally:
+            with self._lock:
+                self._pending.subtract(pinned)
+                self._pending += Counter()  # Drop entries that reached zero
+            if process_lock:
+                process_lock.close()
+
+    def _commit(self, tmp_path, sha, pinned):
+        path = self.blob_path(sha)
+        with self._lock:
+            self._pending[sha] += 1
+            pinned.append(sha)
+            if os.path.exists(path):
+                os.remove(tmp_path)  # Already stored: deduplicated
+                return False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(tmp_path, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_path, path)
+            return True
+
+    def put_file(self, path, sha, pinned):
+        """Move a file whose sha256 is already known into the store. Returns True if it was new."""
+        os.makedirs(self.blob_dir, exist_ok=True)
+        return self._commit(path, sha, pinned)
+
+    def put_stream(self, src, pinned):
+        """Copy a readable binary stream into the store. Returns (sha256, size, new)."""
+        os.makedirs(self.blob_dir, exist_ok=True)
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for block in iter(lambda: src.read(1024 * 1024), b""):
+                    h.update(block)
+                    out.write(block)
+                    size += len(block)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        sha = h.hexdigest()
+        return sha, size, self._commit(tmp_path, sha, pinned)
+
+    # ---------- trees ----------
+
+    def _tree_path(self, game_id, version):
+        return os.path.join(self.tree_dir, game_id, f"{version}.json")
+
+    @staticmethod
+    def _tree_blobs(tree):
+        blobs = [f["sha256"] for f in tree["files"].values()]
+        if tree.get("archive"):
+            blobs.append(tree["archive"])
+        return blobs
+
+    def get_tree(self, game_id, version):
+        try:
+            with open(self._tree_path(game_id, version), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def versions(self, game_id):
+        """Stored versions of a game, oldest install first."""
+        game_tree_dir = os.path.join(self.tree_dir, game_id)
+        try:
+            names = [n for n in os.listdir(game_tree_dir) if n.endswith(".json")]
+        except OSError:
+            return []
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(game_tree_dir, n)))
+        return [n[:-len(".json")] for n in names]
+
+    def add_tree(self, game_id, version, tree):
+        """Record a version: {"archive": sha256 or None, "files": {path: {"sha256", "size"}}}."""
+        path = self._tree_path(game_id, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            old = self.get_tree(game_id, version)
+            with open(path + ".tmp", "w") as f:
+                json.dump(tree, f)
+            os.replace(path + ".tmp", path)
+            self._refs.update(self._tree_blobs(tree))
+            if old:
+                self._refs.subtract(self._tree_blobs(old))
+
+    def remove_tree(self, game_id, version):
+        with self._lock:
+            tree = self.get_tree(game_id, version)
+            if tree is None:
+                return
+            os.remove(self._tree_path(game_id, version))
+            self._refs.subtract(self._tree_blobs(tree))
+        try:
+            os.rmdir(os.path.join(self.tree_dir, game_id))
+        except OSError:
+            pass  # Other versions remain
+
+    def remove_game(self, game_id):
+        for version in self.versions(game_id):
+            self.remove_tree(game_id, version)
+
+    def load(self):
+        """Rebuild reference counts from the trees on disk. Returns the number of trees."""
+        refs = Counter()
+        count = 0
+        if os.path.isdir(self.tree_dir):
+            for game_id in os.listdir(self.tree_dir):
+                for version in self.versions(game_id):
+                    tree = self.get_tree(game_id, version)
+                    if tree is not None:
+                        refs.update(self._tree_blobs(tree))
+                        count += 1
+        with self._lock:
+            self._refs = refs
+        return count
+
+    # ---------- installs ----------
+
+    def materialize(self, tree, dest):
+        """Create dest with hard links to the tree's blobs (copies where links are unsupported)."""
+        os.makedirs(dest)
+        for rel, info in tree["files"].items():
+            target = os.path.join(dest, *rel.split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(self.blob_path(info["sha256"]), target)
+            except OSError:
+                shutil.copyfile(self.blob_path(info["sha256"]), target)
+
+    # ---------- garbage collection ----------
+
+    def collect(self):
+        """Delete blobs no tree references. Returns (blobs removed, bytes freed)."""
+        if not os.path.isdir(self.blob_dir):
+            return 0, 0
+        if not self.shared:
+            return self._collect()
+        try:
+            process_lock = self._process_lock(fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0, 0  # Another process is staging; try next time
+        try:
+            self.load()
+            return self._collect()
+        finally:
+            process_lock.close()
+
+    def _collect(self):
+        removed = 0
+        freed = 0
+        with self._lock:
+            for prefix in os.listdir(self.blob_dir):
+                prefix_dir = os.path.join(self.blob_dir, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue  # put_stream temp files
+                for sha in os.listdir(prefix_dir):
+                    if self._refs[sha] > 0 or self._pending[sha] > 0:
+                        continue
+                    path = os.path.join(prefix_dir, sha)
+                    size = os.path.getsize(path)
+                    try:
+                        os.remove(path)
+                    except PermissionError:
+                        os.chmod(path, stat.S_IWRITE)
+                        os.remove(path)
+                    removed += 1
+                    freed += size
+            self._refs += Counter()  # Drop entries that reached zero
+        return removed, freed
+
+    def usage(self):
+        """{"blobs", "bytes", "unreferenced"} for the admin console."""
+        blobs = 0
+        size = 0
+        unreferenced = 0
+        if os.path.isdir(self.blob_dir):
+            with self._lock:
+                for prefix in os.listdir(self.blob_dir):
+                    prefix_dir = os.path.join(self.blob_dir, prefix)
+                    if not os.path.isdir(prefix_dir):
+                        continue
+                    for sha in os.listdir(prefix_dir):
+                        blobs += 1
+                        size += os.path.getsize(os.path.join(prefix_dir, sha))
+                        if self._refs[sha] <= 0:
+                            unreferenced += 1
+        return {"blobs": blobs, "bytes": size, "unreferenced": unreferenced}
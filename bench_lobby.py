@@ -0,0 +1,814 @@
+# bench_lobby.py
+# Load generator for lobby_server.py (run db_server.py and lobby_server.py first)
+import socket
+import json
+import struct
+import threading
+import time
+import argparse
+import asyncio
+import os
+import sys
+import subprocess
+import tempfile
+import statistics
+import zipfile
+from client_config import LOBBY_HOST, LOBBY_PORT
+
+
+def recv_exact(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionResetError("Server closed connection")
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    length = struct.unpack("!I", recv_exact(sock, 4))[0]
+    return json.loads(recv_exact(sock, length).decode())
+
+
+def request(sock, msg):
+    payload = json.dumps(msg).encode()
+    sock.sendall(struct.pack("!I", len(payload)) + payload)
+    return recv_frame(sock)
+
+
+def bench_throughput(host, port, clients, requests_per_client):
+    """Each client opens its own connection and issues read-only lobby commands."""
+    commands = [
+        {"cmd": "list", "online_only": True},
+        {"cmd": "list_rooms"},
+        {"cmd": "get_store_list"},
+    ]
+    ok = 0
+    errors = 0
+    latencies = []
+    stats_lock = threading.Lock()
+    start_barrier = threading.Barrier(clients + 1)
+
+    throttled = 0
+
+    def worker():
+        nonlocal ok, errors, throttled
+        local_ok = 0
+        local_err = 0
+        local_throttled = 0
+        local_lat = []
+        try:
+            s = socket.create_connection((host, port), timeout=30)
+        except OSError:
+            start_barrier.wait()
+            with stats_lock:
+                errors += requests_per_client
+            return
+        start_barrier.wait()
+        try:
+            for i in range(requests_per_client):
+                t0 = time.perf_counter()
+                try:
+                    resp = request(s, commands[i % len(commands)])
+                    if resp.get("status") == "ok":
+                        local_ok += 1
+                    elif resp.get("throttled"):
+                        local_throttled += 1
+                    else:
+                        local_err += 1
+                except (OSError, ValueError):
+                    local_err += requests_per_client - i
+                    break
+                local_lat.append(time.perf_counter() - t0)
+        finally:
+            s.close()
+        with stats_lock:
+            ok += local_ok
+            errors += local_err
+            throttled += local_throttled
+            latencies.extend(local_lat)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    start_barrier.wait()
+    t_start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+
+    latencies.sort()
+    total = clients * requests_per_client
+    print(f"[BENCH] clients={clients} requests={total} elapsed={elapsed:.2f}s")
+    print(f"[BENCH] ok={ok} errors={errors} throttled={throttled} throughput={ok / elapsed:.0f} req/s")
+    if latencies:
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+        print(f"[BENCH] latency p50={p50:.1f}ms p99={p99:.1f}ms")
+    return ok / elapsed
+
+
+def bench_workers(host, port, counts, clients, requests_per_client):
+    """Throughput mode against lobby_server.py --workers N for each N in counts.
+
+    Starts and stops the lobby itself (db_server.py must be running and no
+    other lobby on the port). Only a machine with at least max(counts) cores
+    shows the scaling; with fewer, extra workers just compete for them.
+    """
+    lobby_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lobby_server.py")
+    print(f"[BENCH] {os.cpu_count()} CPU cores")
+    results = []
+    for count in counts:
+        proc = subprocess.Popen([sys.executable, lobby_script, "--workers", str(count)],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True)
+        ready = 0
+        for line in proc.stdout:
+            if "listening on" in line:
+                ready += 1
+                if ready == count:
+                    break
+        # Keep reading so the lobby never blocks on a full pipe
+        threading.Thread(target=lambda: proc.stdout.read(), daemon=True).start()
+        print(f"[BENCH] --- {count} lobby worker(s) ---")
+        results.append((count, bench_throughput(host, port, clients, requests_per_client)))
+        proc.stdin.write("shutdown\n")
+        proc.stdin.flush()
+        proc.wait(timeout=10)
+        time.sleep(1)  # Let the workers notice and release the port
+    base = results[0][1]
+    for count, rate in results:
+        print(f"[BENCH] workers={count} throughput={rate:.0f} req/s ({rate / base:.2f}x)")
+
+
+def read_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+async def _open_idle_session(host, port, index, with_listener):
+    """One logged-out menu connection (+ optional listener) that has made one request."""
+    conns = []
+    for attempt in range(20):
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            break
+        except OSError:
+            await asyncio.sleep(0.1 * (attempt + 1))
+    else:
+        raise ConnectionError("connect failed")
+    payload = json.dumps({"cmd": "list_rooms"}).encode()
+    writer.write(struct.pack("!I", len(payload)) + payload)
+    length = struct.unpack("!I", await reader.readexactly(4))[0]
+    await reader.readexactly(length)
+    conns.append(writer)
+    if with_listener:
+        reader, writer = await asyncio.open_connection(host, port)
+        payload = json.dumps({"cmd": "_listener", "user": f"idle_{index}"}).encode()
+        writer.write(struct.pack("!I", len(payload)) + payload)
+        await writer.drain()
+        conns.append(writer)
+    return conns
+
+
+async def _bench_idle(host, port, sessions, pid, with_listener, batch=500):
+    rss_before = read_rss_kb(pid) if pid else 0
+    opened = []
+    failed = 0
+    t_start = time.perf_counter()
+    for base in range(0, sessions, batch):
+        results = await asyncio.gather(
+            *(_open_idle_session(host, port, i, with_listener)
+              for i in range(base, min(base + batch, sessions))),
+            return_exceptions=True,
+        )
+        for r in results:
+            if isinstance(r, BaseException):
+                failed += 1
+            else:
+                opened.extend(r)
+    elapsed = time.perf_counter() - t_start
+    await asyncio.sleep(2)  # Let the server settle before sampling
+    rss_after = read_rss_kb(pid) if pid else 0
+
+    ok = sessions - failed
+    print(f"[BENCH] idle sessions={ok}/{sessions} connections={len(opened)} "
+          f"setup={elapsed:.1f}s")
+    if pid and ok:
+        per_session = (rss_after - rss_before) / ok
+        print(f"[BENCH] lobby RSS {rss_before / 1024:.1f} MiB -> {rss_after / 1024:.1f} MiB "
+              f"({per_session:.1f} KiB per session)")
+    for w in opened:
+        w.close()
+
+
+def bench_idle(host, port, sessions, pid, with_listener):
+    """Hold many idle sessions open and report the lobby's memory per session."""
+    asyncio.run(_bench_idle(host, port, sessions, pid, with_listener))
+
+
+BENCH_GAME_SERVER = """import socket, threading, random, os, sys, time
+PORT = int(os.environ.get("GAME_PORT", 60002))
+s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.bind(("0.0.0.0", PORT))
+s.listen()
+c, _ = s.accept()
+c.sendall(b"hi")
+c.close()
+"""
+
+
+def _wait_first_accept(port, deadline=10.0):
+    """Connect until the game server accepts and greets us; return the time it did."""
+    end = time.perf_counter() + deadline
+    while time.perf_counter() < end:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as c:
+                if c.recv(2):
+                    return time.perf_counter()
+        except OSError:
+            time.sleep(0.002)
+    raise TimeoutError("game server never accepted")
+
+
+def _start_worker(worker_script):
+    proc = subprocess.Popen([sys.executable, worker_script],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdout.readline()  # "idle"
+    return proc
+
+
+def _assign_worker(proc, game_dir, port):
+    job = {"cwd": game_dir, "entry": "game_server.py", "port": port}
+    proc.stdin.write((json.dumps(job) + "\n").encode())
+    proc.stdin.flush()
+    proc.stdout.readline()  # "listening"
+
+
+def bench_game_start(runs, port):
+    """Compare start_game paths: cold Popen (old) vs game_worker.py cold / pre-warmed.
+
+    'start->accept' runs from the start request to the first accepted client.
+    'broadcast->accept' runs from when the lobby would broadcast start_game:
+    right after Popen on the old path, after the worker reports it is
+    listening on the new one.
+    """
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_worker.py")
+    game_dir = tempfile.mkdtemp(prefix="bench_game_")
+    with open(os.path.join(game_dir, "game_server.py"), "w") as f:
+        f.write(BENCH_GAME_SERVER)
+
+    results = {"popen (old)": ([], []), "worker cold": ([], []), "worker warm": ([], [])}
+    for i in range(runs):
+        p = port + (i % 50)
+
+        t0 = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "game_server.py"], cwd=game_dir,
+                                env=dict(os.environ, GAME_PORT=str(p)))
+        t_accept = _wait_first_accept(p)
+        results["popen (old)"][0].append(t_accept - t0)
+        results["popen (old)"][1].append(t_accept - t0)
+        proc.wait()
+
+        t0 = time.perf_counter()
+        proc = _start_worker(worker_script)
+        _assign_worker(proc, game_dir, p)
+        t_broadcast = time.perf_counter()
+        t_accept = _wait_first_accept(p)
+        results["worker cold"][0].append(t_accept - t0)
+        results["worker cold"][1].append(t_accept - t_broadcast)
+        proc.wait()
+
+        proc = _start_worker(worker_script)
+        time.sleep(0.05)
+        t0 = time.perf_counter()
+        _assign_worker(proc, game_dir, p)
+        t_broadcast = time.perf_counter()
+        t_accept = _wait_first_accept(p)
+        results["worker warm"][0].append(t_accept - t0)
+        results["worker warm"][1].append(t_accept - t_broadcast)
+        proc.wait()
+
+    print(f"[BENCH] game start latency, median of {runs} runs")
+    for name, (total, after_broadcast) in results.items():
+        print(f"[BENCH] {name:<12} start->accept={statistics.median(total) * 1000:6.1f}ms  "
+              f"broadcast->accept={statistics.median(after_broadcast) * 1000:6.1f}ms")
+
+
+def _login(host, port, username, role):
+    s = socket.create_connection((host, port), timeout=30)
+    request(s, {"cmd": "register", "username": username, "password": "bench", "role": role})
+    resp = request(s, {"cmd": "login", "username": username, "password": "bench", "role": role})
+    if resp.get("status") != "ok":
+        raise RuntimeError(f"login failed: {resp}")
+    return s
+
+
+def _logout(s):
+    """Exit and wait for the reply, so the same user can log in again right away."""
+    request(s, {"cmd": "exit"})
+    s.close()
+
+
+def _open_data(host, ticket):
+    """Connect to the lobby's data port with a transfer token; returns (socket, first reply)."""
+    s = socket.create_connection((host, ticket["data_port"]), timeout=60)
+    return s, request(s, {"token": ticket["token"]})
+
+
+def _upload_bench_game(host, port, game_id, size_mb, name="Download Bench", description="",
+                       version="1.0.0", user="bench_dev", max_players=2):
+    """Upload a game padded with size_mb of random data (skipped if already on the server)."""
+    s = _login(host, port, user, "developer")
+    try:
+        zip_path = os.path.join(tempfile.mkdtemp(prefix="bench_dl_"), f"{game_id}.zip")
+        manifest = {"game_id": game_id, "name": name, "description": description, "version": version,
+                    "type": "cli", "min_players": 1, "max_players": max_players,
+                    "client_entry": "game_client.py", "server_entry": "game_server.py"}
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zf:
+            zf.writestr("manifest.json", json.dumps(manifest))
+            zf.writestr("game_server.py", BENCH_GAME_SERVER)
+            zf.writestr("game_client.py", "")
+            zf.writestr("assets.bin", os.urandom(size_mb * 1024 * 1024))
+        size = os.path.getsize(zip_path)
+        ack = request(s, {"cmd": "upload_game", "file_name": os.path.basename(zip_path),
+                          "file_size": size})
+        if ack.get("status") != "ready":
+            raise RuntimeError(f"upload refused: {ack}")
+        ds, ready = _open_data(host, ack)
+        with ds:
+            if ready.get("status") != "ready":
+                raise RuntimeError(f"upload refused: {ready}")
+            with open(zip_path, "rb") as f:
+                ds.sendfile(f)
+            resp = recv_frame(ds)
+        os.remove(zip_path)
+        if resp.get("status") != "ok" and "not greater" not in resp.get("msg", ""):
+            raise RuntimeError(f"upload failed: {resp}")
+    finally:
+        _logout(s)
+
+
+def _read_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def bench_download(host, port, clients, downloads, game_id, size_mb, pid):
+    """Many clients download the same game at once; reports aggregate throughput.
+
+    Run it once per server setting to compare paths, e.g. the default sendfile
+    path against the old one (USE_SENDFILE = False, DOWNLOAD_CHUNK_SIZE = 4096).
+    """
+    _upload_bench_game(host, port, game_id, size_mb)
+    total_bytes = 0
+    errors = 0
+    stats_lock = threading.Lock()
+    start_barrier = threading.Barrier(clients + 1)
+
+    def worker():
+        nonlocal total_bytes, errors
+        received = 0
+        try:
+            s = socket.create_connection((host, port), timeout=60)
+        except OSError:
+            start_barrier.wait()
+            with stats_lock:
+                errors += downloads
+            return
+        start_barrier.wait()
+        try:
+            for _ in range(downloads):
+                header = request(s, {"cmd": "download_game", "game_id": game_id})
+                if header.get("status") != "ok":
+                    raise RuntimeError(header.get("msg"))
+                ds, _ = _open_data(host, header)
+                with ds:
+                    remaining = header["file_size"]
+                    while remaining:
+                        chunk = ds.recv(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            raise ConnectionResetError("Server closed connection")
+                        remaining -= len(chunk)
+                received += header["file_size"]
+        except (OSError, ValueError, RuntimeError):
+            with stats_lock:
+                errors += 1
+        finally:
+            s.close()
+        with stats_lock:
+            total_bytes += received
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    cpu_before = _read_cpu_seconds(pid) if pid else 0
+    start_barrier.wait()
+    t_start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+    cpu_used = _read_cpu_seconds(pid) - cpu_before if pid else None
+
+    mib = total_bytes / (1024 * 1024)
+    print(f"[BENCH] clients={clients} downloads={clients * downloads} size={size_mb}MiB "
+          f"elapsed={elapsed:.2f}s errors={errors}")
+    print(f"[BENCH] transferred={mib:.0f} MiB throughput={mib / elapsed:.0f} MiB/s")
+    if cpu_used is not None:
+        print(f"[BENCH] lobby CPU {cpu_used:.2f}s ({cpu_used / max(mib, 1) * 1000:.1f} ms per MiB)")
+
+
+def bench_upload(host, port, uploads, size_mb):
+    """Run concurrent uploads while another client keeps issuing lobby commands.
+
+    Reports total upload time and the command latency seen during the uploads.
+    """
+    version = f"1.0.{int(time.time())}"  # Newer than any earlier run
+    errors = []
+    probe_latencies = []
+    done = threading.Event()
+
+    def uploader(i):
+        try:
+            _upload_bench_game(host, port, f"bench_upload_{i}", size_mb, version=version,
+                               user=f"bench_uploader_{i}")
+        except Exception as e:
+            errors.append(e)
+
+    def probe():
+        s = socket.create_connection((host, port), timeout=30)
+        while not done.is_set():
+            t0 = time.perf_counter()
+            request(s, {"cmd": "list_rooms"})
+            probe_latencies.append(time.perf_counter() - t0)
+            time.sleep(0.01)
+        s.close()
+
+    probe_thread = threading.Thread(target=probe, daemon=True)
+    probe_thread.start()
+    threads = [threading.Thread(target=uploader, args=(i,), daemon=True) for i in range(uploads)]
+    t_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+    done.set()
+    probe_thread.join()
+
+    probe_latencies.sort()
+    print(f"[BENCH] uploads={uploads} size={size_mb}MiB elapsed={elapsed:.2f}s errors={len(errors)}")
+    if errors:
+        print(f"[BENCH] first error: {errors[0]}")
+    if probe_latencies:
+        p50 = probe_latencies[len(probe_latencies) // 2] * 1000
+        p99 = probe_latencies[int(len(probe_latencies) * 0.99) - 1] * 1000
+        print(f"[BENCH] command latency during uploads p50={p50:.1f}ms p99={p99:.1f}ms "
+              f"max={probe_latencies[-1] * 1000:.1f}ms")
+
+
+def bench_slow_listener(host, port, toggles):
+    """Two players share a room; one never reads its listener connection while
+    the other keeps toggling ready, which pushes an event to the stuck player.
+
+    Reports the ready command latency the active player sees. A lobby that
+    waits on each recipient stalls once the stuck player's socket buffers fill.
+    """
+    stamp = int(time.time())
+    stuck = _login(host, port, f"bench_stuck_{stamp}", "player")
+    active = _login(host, port, f"bench_active_{stamp}", "player")
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    listener.connect((host, port))
+    payload = json.dumps({"cmd": "_listener", "user": f"bench_stuck_{stamp}"}).encode()
+    listener.sendall(struct.pack("!I", len(payload)) + payload)  # ...and never read from it again
+
+    room = f"bench_slow_{stamp}"
+    request(stuck, {"cmd": "create_room", "room_name": room, "game_id": "bench"})
+    request(active, {"cmd": "join_room", "room_name": room})
+    active.settimeout(10)
+    latencies = []
+    stalled = False
+    t_start = time.perf_counter()
+    for i in range(toggles):
+        t0 = time.perf_counter()
+        try:
+            request(active, {"cmd": "set_ready", "ready": i % 2 == 0})
+        except socket.timeout:
+            stalled = True
+            break
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - t_start
+
+    latencies.sort()
+    print(f"[BENCH] ready toggles={len(latencies)}/{toggles} elapsed={elapsed:.2f}s"
+          + (" STALLED (no reply within 10s)" if stalled else ""))
+    if latencies:
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000
+        print(f"[BENCH] set_ready latency p50={p50:.2f}ms p99={p99:.2f}ms max={latencies[-1] * 1000:.1f}ms")
+    listener.close()
+    stuck.close()
+    active.close()
+
+
+def bench_flood(host, port, clients, duration):
+    """Misbehaving clients loop DB-backed queries as fast as they can while
+    another client keeps logging in on fresh connections.
+
+    Reports how many flood requests were served or throttled and the login
+    latency meanwhile. Without admission control the flood fills the DB
+    connection pool and every login waits behind it.
+    """
+    request_counts = {"ok": 0, "throttled": 0, "error": 0}
+    counts_lock = threading.Lock()
+    login_latencies = []
+    failed_logins = []
+    done = threading.Event()
+    _logout(_login(host, port, "bench_prober", "player"))
+
+    def flooder():
+        s = socket.create_connection((host, port), timeout=30)
+        local = {"ok": 0, "throttled": 0, "error": 0}
+        try:
+            while not done.is_set():
+                resp = request(s, {"cmd": "list"})
+                if resp.get("status") == "ok":
+                    local["ok"] += 1
+                elif resp.get("throttled"):
+                    local["throttled"] += 1
+                else:
+                    local["error"] += 1
+        except OSError:
+            local["error"] += 1
+        finally:
+            s.close()
+        with counts_lock:
+            for k, v in local.items():
+                request_counts[k] += v
+
+    threads = [threading.Thread(target=flooder, daemon=True) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)  # Let the flood build up
+    t_end = time.perf_counter() + duration
+    while time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        try:
+            s = socket.create_connection((host, port), timeout=30)
+            resp = request(s, {"cmd": "login", "username": "bench_prober", "password": "bench", "role": "player"})
+            if resp.get("status") != "ok":
+                failed_logins.append(resp.get("msg"))
+            else:
+                login_latencies.append(time.perf_counter() - t0)
+            _logout(s)
+        except OSError as e:
+            failed_logins.append(str(e))
+        time.sleep(0.05)
+    done.set()
+    for t in threads:
+        t.join()
+
+    total = sum(request_counts.values())
+    print(f"[BENCH] flood clients={clients} duration={duration}s requests={total} "
+          f"({total / (duration + 0.5):.0f}/s) served={request_counts['ok']} "
+          f"throttled={request_counts['throttled']} errors={request_counts['error']}")
+    login_latencies.sort()
+    if login_latencies:
+        p50 = login_latencies[len(login_latencies) // 2] * 1000
+        p99 = login_latencies[max(int(len(login_latencies) * 0.99) - 1, 0)] * 1000
+        print(f"[BENCH] logins={len(login_latencies)} failed={len(failed_logins)} "
+              f"latency p50={p50:.1f}ms p99={p99:.1f}ms max={login_latencies[-1] * 1000:.1f}ms")
+    else:
+        print(f"[BENCH] no successful logins, failed={len(failed_logins)}")
+
+
+async def _async_request(reader, writer, msg):
+    payload = json.dumps(msg).encode()
+    writer.write(struct.pack("!I", len(payload)) + payload)
+    return await _async_frame(reader)
+
+
+async def _async_frame(reader):
+    length = struct.unpack("!I", await reader.readexactly(4))[0]
+    return json.loads(await reader.readexactly(length))
+
+
+async def _match_session(host, port, name):
+    """Log in with a listener connection; returns (menu reader, menu writer, listener reader, listener writer)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    await _async_request(reader, writer, {"cmd": "register", "username": name, "password": "bench", "role": "player"})
+    resp = await _async_request(reader, writer, {"cmd": "login", "username": name, "password": "bench",
+                                                 "role": "player"})
+    if resp.get("status") != "ok":
+        raise RuntimeError(f"login failed: {resp}")
+    l_reader, l_writer = await asyncio.open_connection(host, port)
+    payload = json.dumps({"cmd": "_listener", "user": name}).encode()
+    l_writer.write(struct.pack("!I", len(payload)) + payload)
+    return reader, writer, l_reader, l_writer
+
+
+async def _match_player(host, session, name, game_id, timeout):
+    """Queue for game_id; returns (seconds until matched, seconds until start_game or None)."""
+    reader, writer, l_reader, l_writer = session
+    t0 = time.perf_counter()
+    resp = await _async_request(reader, writer, {"cmd": "matchmake", "game_id": game_id})
+    if resp.get("status") != "ok":
+        raise RuntimeError(f"matchmake failed: {resp}")
+    matched = None
+
+    async def wait_events():
+        nonlocal matched
+        while True:
+            ev = await _async_frame(l_reader)
+            if ev.get("type") == "matchmaking" and ev.get("event") == "matched":
+                matched = time.perf_counter() - t0
+            elif ev.get("type") == "start_game":
+                if ev["players"][0] == name:
+                    # The bench game server exits after its first client, freeing the session slot
+                    try:
+                        c_reader, c_writer = await asyncio.open_connection(host, ev["game_port"])
+                        await c_reader.read(2)
+                        c_writer.close()
+                    except OSError:
+                        pass
+                return time.perf_counter() - t0
+
+    try:
+        started = await asyncio.wait_for(wait_events(), timeout)
+    except asyncio.TimeoutError:
+        started = None
+    if matched is None:
+        raise TimeoutError("never matched")
+    return matched, started
+
+
+async def _bench_matchmaking(host, port, players, match_size, timeout):
+    game_id = f"bench_match_{match_size}"
+    _upload_bench_game(host, port, game_id, 0, name="Match Bench", max_players=match_size)
+    stamp = int(time.time())
+    names = [f"bench_mm_{stamp}_{i}" for i in range(players)]
+    sessions = []
+    for base in range(0, players, 200):
+        sessions.extend(await asyncio.gather(*(_match_session(host, port, n) for n in names[base:base + 200])))
+
+    t_start = time.perf_counter()
+    results = await asyncio.gather(*(_match_player(host, s, n, game_id, timeout) for s, n in zip(sessions, names)),
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - t_start
+    for reader, writer, l_reader, l_writer in sessions:
+        writer.close()
+        l_writer.close()
+
+    matched = sorted(r[0] for r in results if not isinstance(r, BaseException))
+    started = sorted(r[1] for r in results if not isinstance(r, BaseException) and r[1] is not None)
+    print(f"[BENCH] matchmaking players={players} room size={match_size} matched={len(matched)} "
+          f"started={len(started)} elapsed={elapsed:.1f}s")
+    for label, values in (("queue->matched", matched), ("queue->start_game", started)):
+        if values:
+            print(f"[BENCH] {label:<17} p50={values[len(values) // 2] * 1000:.0f}ms "
+                  f"p95={values[max(int(len(values) * 0.95) - 1, 0)] * 1000:.0f}ms "
+                  f"max={values[-1] * 1000:.0f}ms")
+
+
+def bench_matchmaking(host, port, players, match_size, timeout):
+    """Queue many players for one game at once and report how long they wait
+    to be matched into rooms and to receive start_game. Game starts beyond
+    GAME_MAX_SESSIONS wait for a free slot, so queue->start_game includes
+    the supervisor's queue."""
+    asyncio.run(_bench_matchmaking(host, port, players, match_size, timeout))
+
+
+class CountingSocket:
+    """Socket wrapper that counts bytes on the wire, for main_client's framing helpers."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+        self.sent = 0
+
+    def recv(self, n):
+        data = self.sock.recv(n)
+        self.received += len(data)
+        return data
+
+    def sendall(self, data):
+        self.sent += len(data)
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def bench_compression(host, port, games, rounds, pid):
+    """Browse the store (list + every game's details) with each codec the client supports.
+
+    Seeds `games` store entries with descriptions and a few reviews each.
+    Reports bytes on the wire and CPU time on both ends per codec.
+    """
+    import main_client as mc
+
+    game_ids = [f"bench_store_{i:03d}" for i in range(games)]
+    for i, game_id in enumerate(game_ids):
+        _upload_bench_game(host, port, game_id, 0, name=f"Bench Game {i}",
+                           description="A benchmark game used to measure store browsing traffic. " * 3)
+    for r in range(5):
+        s = _login(host, port, f"bench_reviewer_{r}", "player")
+        for game_id in game_ids:
+            request(s, {"cmd": "add_review", "game_id": game_id, "user": f"bench_reviewer_{r}",
+                        "rating": 1 + (r % 5), "comment": f"Review {r}: fun with friends, a bit short."})
+        _logout(s)
+
+    print(f"[BENCH] store browsing: {games} games, {rounds} rounds of list + details")
+    for codec in [None] + mc.supported_codecs():
+        raw = socket.create_connection((host, port), timeout=30)
+        s = CountingSocket(raw)
+        mc.send_msg(s, {"cmd": "register", "username": "bench_browser", "password": "bench", "role": "player"})
+        mc.recv_msg(s)
+        mc.send_msg(s, {"cmd": "login", "username": "bench_browser", "password": "bench", "role": "player",
+                        "compression": [codec] if codec else []})
+        mc.enable_compression(s, mc.recv_msg(s).get("compression"))
+        s.received = s.sent = 0
+
+        cpu_before = _read_cpu_seconds(pid) if pid else 0
+        t_cpu = time.process_time()
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            mc.send_msg(s, {"cmd": "get_store_list"})
+            mc.recv_msg(s)
+            for game_id in game_ids:
+                mc.send_msg(s, {"cmd": "get_game_details", "game_id": game_id})
+                mc.recv_msg(s)
+        elapsed = time.perf_counter() - t_start
+        client_cpu = time.process_time() - t_cpu
+        server_cpu = _read_cpu_seconds(pid) - cpu_before if pid else None
+        mc.send_msg(s, {"cmd": "exit"})
+        mc.recv_msg(s)
+        s.close()
+
+        line = (f"[BENCH] {codec or 'none':<5} received={s.received / 1024:8.1f} KiB "
+                f"sent={s.sent / 1024:6.1f} KiB elapsed={elapsed:.2f}s client_cpu={client_cpu:.2f}s")
+        if server_cpu is not None:
+            line += f" lobby_cpu={server_cpu:.2f}s"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lobby server benchmark")
+    parser.add_argument("--host", default=LOBBY_HOST)
+    parser.add_argument("--port", type=int, default=LOBBY_PORT)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--mode", choices=["throughput", "idle", "game-start", "download", "compression", "upload",
+                                           "slow-listener", "flood", "workers", "matchmaking"],
+                        default="throughput")
+    parser.add_argument("--sessions", type=int, default=10000, help="idle mode: sessions to hold")
+    parser.add_argument("--listeners", action="store_true", help="idle mode: add a listener per session")
+    parser.add_argument("--pid", type=int, help="idle/download/compression mode: lobby_server PID to sample RSS/CPU from")
+    parser.add_argument("--runs", type=int, default=20, help="game-start mode: launches per path")
+    parser.add_argument("--game-port", type=int, default=61000, help="game-start mode: first local port to use")
+    parser.add_argument("--downloads", type=int, default=5, help="download mode: downloads per client")
+    parser.add_argument("--size-mb", type=int, default=50, help="download/upload mode: size of the bench game")
+    parser.add_argument("--uploads", type=int, default=8, help="upload mode: concurrent uploads")
+    parser.add_argument("--game-id", default="bench_download", help="download mode: game to upload and fetch")
+    parser.add_argument("--games", type=int, default=50, help="compression mode: store entries to seed")
+    parser.add_argument("--rounds", type=int, default=20, help="compression mode: times to browse the whole store")
+    parser.add_argument("--toggles", type=int, default=20000, help="slow-listener mode: ready changes to push")
+    parser.add_argument("--duration", type=int, default=10, help="flood mode: seconds to keep logging in")
+    parser.add_argument("--worker-counts", default="1,2,4", help="workers mode: lobby worker counts to compare")
+    parser.add_argument("--players", type=int, default=200, help="matchmaking mode: players to queue at once")
+    parser.add_argument("--match-size", type=int, default=4, help="matchmaking mode: max_players of the bench game")
+    args = parser.parse_args()
+
+    if args.mode == "matchmaking":
+        bench_matchmaking(args.host, args.port, args.players, args.match_size, 60)
+    elif args.mode == "workers":
+        bench_workers(args.host, args.port, [int(n) for n in args.worker_counts.split(",")],
+                      args.clients, args.requests)
+    elif args.mode == "flood":
+        bench_flood(args.host, args.port, args.clients, args.duration)
+    elif args.mode == "slow-listener":
+        bench_slow_listener(args.host, args.port, args.toggles)
+    elif args.mode == "upload":
+        bench_upload(args.host, args.port, args.uploads, args.size_mb)
+    elif args.mode == "compression":
+        bench_compression(args.host, args.port, args.games, args.rounds, args.pid)
+    elif args.mode == "download":
+        bench_download(args.host, args.port, args.clients, args.downloads,
+                       args.game_id, args.size_mb, args.pid)
+    elif args.mode == "game-start":
+        bench_game_start(args.runs, args.game_port)
+    elif args.mode == "idle":
+        bench_idle(args.host, args.port, args.sessions, args.pid, args.listeners)
+    else:
+        bench_throughput(args.host, args.port, args.clients, args.requests)
+
+
+if __name__ == "__main__":
+    main()
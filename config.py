@@ -2,6 +2,11 @@
 LOBBY_HOST = "0.0.0.0"
 LOBBY_PORT = 60001 # 或者是你設定的 Port
 
+# Lobby 的 worker process 數 (也可用 lobby_server.py --workers N 指定)。大於 1 時各 worker 以
+# SO_REUSEPORT 共用 LOBBY_PORT (僅 Linux/BSD)，檔案傳輸用 DATA_PORT + worker 編號，
+# Game Server 的 port 範圍與場數上限平均分給各 worker
+LOBBY_WORKERS = 1
+
 DB_HOST = "127.0.0.1" # DB 和 Lobby 在同一台機器，所以用 localhost
 DB_PORT = 10003
 
@@ -9,4 +14,101 @@ DB_PORT = 10003
 # 如果你在學校伺服器，這裡要填伺服器的 Public IP
 # 但 Server bind 時通常不需要這個變數，主要是 Client 需要
 GAME_HOST = "linux1.cs.nycu.edu.tw" 
-GAME_PORT = 60002
\ No newline at end of file
+GAME_PORT = 60002
+# 每個房間的 Game Server 從 GAME_PORT ~ GAME_PORT_MAX 之中分配一個空的 port
+GAME_PORT_MAX = 60101
+
+# Lobby -> DB 連線池大小 (同時進行的 DB 請求上限)
+DB_POOL_SIZE = 8
+
+# 預先啟動、等待分配房間的 Game Server worker 數量 (0 = 每次 start_game 才冷啟動)
+GAME_WORKER_POOL_SIZE = 2
+
+# Game Server 資源限制: 同時執行的場數上限 (超過則排隊)、
+# 單場最長秒數、CPU 秒數與記憶體上限 (CPU/記憶體限制僅 Linux 有效)
+GAME_MAX_SESSIONS = 20
+GAME_MAX_WALL_TIME = 1800
+GAME_CPU_LIMIT = 600
+GAME_MEMORY_LIMIT_MB = 1024
+
+
+# Lobby 端商店資料快取: 每筆快取存活秒數與最多筆數 (上傳/刪除/評論時會主動失效)
+STORE_CACHE_TTL = 30
+STORE_CACHE_SIZE = 256
+
+# 遊戲檔下載: 使用 sendfile 零複製傳送 (不支援時改用 DOWNLOAD_CHUNK_SIZE 大小的緩衝讀取)、
+# 同時進行的下載數量上限 (超過的下載會等待)
+USE_SENDFILE = True
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+MAX_CONCURRENT_TRANSFERS = 32
+
+# games_repo 內容定址儲存區: 每隔幾秒清除一次沒有任何遊戲版本引用的檔案
+ARTIFACT_GC_INTERVAL = 300
+
+# 每個遊戲在 games_repo/<game_id>/<version>/ 保留最近幾個版本 (執行中的版本一定保留)
+GAME_RETAIN_VERSIONS = 3
+
+# Lobby <-> Client 訊息壓縮: 登入時依序協商可用的演算法 (zstd 需另外安裝 zstandard 套件，
+# 清單留空則不壓縮)，只壓縮超過 COMPRESSION_MIN_SIZE bytes 的訊息；遊戲 zip 檔不再壓縮
+FRAME_COMPRESSION = ["zstd", "zlib"]
+COMPRESSION_MIN_SIZE = 1024
+
+# 上傳限制: zip 檔大小上限、解壓後總大小上限 (防止 zip bomb)，以及處理上傳 (寫檔/雜湊/解壓) 的背景執行緒數
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+MAX_GAME_INSTALL_SIZE = 2 * 1024 * 1024 * 1024
+INGEST_WORKERS = 2
+
+# 檔案傳輸走獨立的資料連線: Client 先在控制連線取得一次性 token，再連到 DATA_PORT 傳送檔案內容
+# (token 在 DATA_TICKET_TTL 秒內沒有使用就失效)
+DATA_PORT = 60102
+DATA_TICKET_TTL = 60
+# 資料連線閒置逾時: 上傳或下載超過 DATA_IDLE_TIMEOUT 秒沒有進展 (收不到資料或送不出去) 就中斷，
+# 上傳已收到的部分會保留供續傳
+DATA_IDLE_TIMEOUT = 60
+
+# 熱門遊戲檔記憶體快取: 總大小上限與單一檔案上限 (MB)，同一個遊戲版本的下載共用同一份資料 (0 = 停用)
+# 只在無法使用 sendfile 時啟用 (例如 Windows 或 USE_SENDFILE = False)，sendfile 直接由系統快取傳送更快
+HOT_CACHE_SIZE_MB = 256
+HOT_CACHE_MAX_ITEM_MB = 64
+
+# 推播給 listener 連線的訊息佇列上限: 超過這麼多則訊息或 bytes 還沒送出的 Client 視為卡住並中斷連線
+OUTBOX_MAX_FRAMES = 1024
+OUTBOX_MAX_BYTES = 1024 * 1024
+
+# 心跳: Client 每 HEARTBEAT_INTERVAL 秒在主連線與 listener 連線各送一次心跳；
+# 超過 SESSION_TIMEOUT 秒沒收到任何訊息的連線，會在每 REAP_INTERVAL 秒一次的清理中一併關閉
+# (離開房間、設為離線)
+HEARTBEAT_INTERVAL = 20
+SESSION_TIMEOUT = 90
+REAP_INTERVAL = 5
+
+# 流量控制: 每個連線各類指令的 token bucket 速率限制 (每秒補充次數, 最多可連續送出次數)，
+# 超過時回覆 throttled 與建議的重試秒數 (設為 {} 則不限制，例如跑 bench_lobby.py 壓力測試時)
+#   auth: 註冊/登入   query: 查詢類 (列表、商店、房間資訊)   action: 房間操作、評論
+#   expensive: 上傳/下載/開始遊戲   (heartbeat、logout、exit 不受限制)
+RATE_LIMITS = {
+    "auth": (2, 10),
+    "query": (20, 60),
+    "action": (10, 30),
+    "expensive": (2, 10),
+}
+# 全體 Client 同時進行的上傳/下載/開始遊戲總數上限，超過時請 Client 稍後再試
+MAX_EXPENSIVE_COMMANDS = 64
+# 查詢類指令最多同時佔用幾條 DB 連線 (須小於 DB_POOL_SIZE)，保留其餘給登入與房間操作，
+# 查詢暫時過多時多出的查詢最多等 1 秒，持續過量則回覆忙碌，登入不需排在查詢後面
+QUERY_DB_SLOTS = 6
+
+# 配對: 每 MATCH_INTERVAL 秒把排隊中的玩家依遊戲的 max_players 分組開房並自動開始遊戲；
+# 湊不滿一房時，等最久的玩家等超過 MATCH_FILL_WAIT 秒後，只要達到 min_players 就先開
+MATCH_INTERVAL = 1
+MATCH_FILL_WAIT = 10
+
+# 房間列表每頁筆數 (list_rooms 沒指定 limit 時使用)，單次最多 ROOM_PAGE_MAX 筆
+ROOM_PAGE_SIZE = 20
+ROOM_PAGE_MAX = 100
+
+# 監控: 以 Prometheus 文字格式在 http://METRICS_HOST:METRICS_PORT/metrics 提供統計數據
+# (多程序模式下第 i 個 worker 用 METRICS_PORT + i)，設為 None 則不開啟；
+# 預設只聽本機，要讓其他機器上的 Prometheus 來抓取時改成 "0.0.0.0"
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9400
@@ -5,14 +5,17 @@ import struct
 import threading
 import os
 import time
+import itertools
 
 DB_HOST = "0.0.0.0"
 DB_PORT = 10003
 
 DB_FILE = "db.json"
+MAX_MSG_SIZE = 16 * 1024 * 1024  # Must match lobby_server.MAX_FRAME_SIZE
 server_running = True
 
-lock = threading.Lock()
+# Re-entrant: handle_request runs under the lock and save_db() takes it again
+lock = threading.RLock()
 # [Modified] Added "Games" to store uploaded game information
 DB_TEMPLATE = {"User": {}, "Developer": {}, "Room": {}, "GameLog": {}, "Games": {}}
 
@@ -44,13 +47,148 @@ def save_db():
 db = load_db()
 
 
+class RoomIndex:
+    """Public rooms bucketed by (game_id, players, max_players, joinable) for list_rooms.
+
+    Every change to a room's members re-files it with update(), so a filtered
+    listing only visits the buckets that can match and slices the requested
+    page out of them instead of walking every room. Within a bucket, rooms
+    keep the order they were filed in. Callers hold the db lock.
+    """
+
+    def __init__(self, rooms):
+        self.buckets = {}  # key -> {room_name: None}, insertion ordered
+        self.keys = {}     # room_name -> its bucket key
+        for room_name, info in rooms.items():
+            self.update(room_name, info)
+
+    def update(self, room_name, info):
+        """File a created or changed room (private rooms are not listed)."""
+        self.remove(room_name)
+        if info["private"]:
+            return
+        players = len(info["members"])
+        limit = info.get("max_players", 2)
+        key = (info.get("game_id"), players, limit, info["open"] and players < limit)
+        self.buckets.setdefault(key, {})[room_name] = None
+        self.keys[room_name] = key
+
+    def remove(self, room_name):
+        key = self.keys.pop(room_name, None)
+        if key is not None:
+            bucket = self.buckets[key]
+            del bucket[room_name]
+            if not bucket:
+                del self.buckets[key]
+
+    def query(self, game_id=None, open_only=False, free_slots=False, sort="fullest", offset=0, limit=None):
+        """Return (room names on the page, rooms matching in total).
+
+        sort: "fullest" lists rooms with the most players first, "emptiest" the fewest.
+        """
+        keys = [k for k in self.buckets
+                if (game_id is None or k[0] == game_id)
+                and (not open_only or k[3])
+                and (not free_slots or k[1] < k[2])]
+        keys.sort(key=lambda k: (-k[1] if sort == "fullest" else k[1], str(k[0]), k[2], not k[3]))
+        total = sum(len(self.buckets[k]) for k in keys)
+        names = []
+        for k in keys:
+            if limit is not None and len(names) >= limit:
+                break
+            bucket = self.buckets[k]
+            if offset >= len(bucket):
+                offset -= len(bucket)
+                continue
+            stop = None if limit is None else offset + limit - len(names)
+            names.extend(itertools.islice(bucket, offset, stop))
+            offset = 0
+        return names, total
+
+
+room_index = RoomIndex(db["Room"])
+
+# Matchmaking queue, kept in memory only (players queue again after a restart):
+# game_id -> {user: time queued}, in queue order
+match_queue = {}
+# user -> game_id they are queued for
+match_users = {}
+# Numbers the rooms the matcher creates
+match_room_ids = itertools.count(1)
+
+
+def unqueue(user):
+    """Take a player out of the matchmaking queue. Returns the game_id they were queued for, or None."""
+    game_id = match_users.pop(user, None)
+    if game_id is not None:
+        queue = match_queue[game_id]
+        del queue[user]
+        if not queue:
+            del match_queue[game_id]
+    return game_id
+
+
+def form_matches(games, fill_wait):
+    """Group queued players into new rooms, in queue order, in one pass.
+
+    games: {game_id: [min_players, max_players]} of every playable game;
+    players queued for any other game are dropped. Full rooms are formed
+    first; the remaining players get a smaller room (at least min_players)
+    once the longest waiting of them has waited fill_wait seconds. Players
+    who went offline or joined a room meanwhile are skipped.
+    Returns (rooms, waits in seconds of the matched players, dropped [user, game_id]).
+    """
+    now = time.time()
+    in_room = {m for info in db["Room"].values() for m in info["members"]}
+    rooms, waits, dropped = [], [], []
+    for game_id in list(match_queue):
+        if game_id not in games:
+            for user in list(match_queue[game_id]):
+                unqueue(user)
+                dropped.append([user, game_id])
+            continue
+        min_players, max_players = games[game_id]
+        for user in [u for u in match_queue[game_id]
+                     if u in in_room or not db["User"].get(u, {}).get("online")]:
+            unqueue(user)
+        queue = match_queue.get(game_id, {})
+        users = list(queue)
+        full = len(users) - len(users) % max_players
+        groups = [users[i:i + max_players] for i in range(0, full, max_players)]
+        rest = users[full:]
+        if len(rest) >= min_players and now - queue[rest[0]] >= fill_wait:
+            groups.append(rest)
+        for group in groups:
+            room_name = f"match-{next(match_room_ids)}"
+            while room_name in db["Room"]:
+                room_name = f"match-{next(match_room_ids)}"
+            # Everyone is ready: the lobby starts the game right away
+            db["Room"][room_name] = {
+                "host": group[0],
+                "private": True,
+                "game_id": game_id,
+                "max_players": max_players,
+                "open": False,
+                "members": group,
+                "ready": {u: True for u in group},
+            }
+            room_index.update(room_name, db["Room"][room_name])
+            for user in group:
+                waits.append(now - queue[user])
+                unqueue(user)
+            rooms.append({"room_name": room_name, "room_info": dict(db["Room"][room_name], room_name=room_name)})
+    if rooms:
+        save_db()
+    return rooms, waits, dropped
+
+
 # Helper: Receive message with 4-byte length prefix
 def recv_msg(sock):
     raw_len = sock.recv(4)
     if not raw_len:
         return None
     msg_len = struct.unpack("!I", raw_len)[0]
-    if msg_len <= 0 or msg_len > 65536:
+    if msg_len <= 0 or msg_len > MAX_MSG_SIZE:
         return None
     data = b""
     while len(data) < msg_len:
@@ -67,6 +205,399 @@ def send_msg(sock, message):
     sock.sendall(struct.pack("!I", len(msg_bytes)) + msg_bytes)
 
 
+# Request dispatcher (caller must hold the DB lock)
+def handle_request(msg):
+    cmd = msg.get("cmd")
+    response = {"status": "error", "msg": "Unknown command"}
+    role = msg.get("role", "player")
+    target_table = "Developer" if role == "developer" else "User"
+
+    if cmd == "ping":
+        # Health check used by the lobby's connection pool
+        response = {"status": "ok"}
+
+    elif cmd == "create":
+        user = msg.get("user")
+        password = msg.get("password")
+        if user in db[target_table]:
+            response = {"status": "error", "msg": f"{role.capitalize()} account exists"}
+        else:
+            # Create account
+            db[target_table][user] = {"password": password, "online": False}
+            if role == "developer":
+                db[target_table][user]["owned_games"] = []  # Reserved field
+            save_db()
+            response = {"status": "ok"}
+
+    elif cmd == "read":
+        user = msg.get("user")
+        if user in db[target_table]:
+            response = {
+                "status": "ok",
+                "password": db[target_table][user]["password"],
+                "online": db[target_table][user].get("online", False),
+            }
+        else:
+            response = {"status": "error", "msg": "Account not found"}
+
+    elif cmd == "set_online":
+        user = msg.get("user")
+        online = msg.get("online", False)
+        if user in db[target_table]:
+            db[target_table][user]["online"] = online
+            if not online:
+                unqueue(user)
+            save_db()
+            response = {"status": "ok"}
+        else:
+            response = {"status": "error", "msg": "User not found"}
+
+    elif cmd == "list":
+        online_only = msg.get("online_only", False)
+        users = list(db["User"].keys())
+        if online_only:
+            users = [u for u in users if db["User"][u].get("online", False)]
+        response = {"status": "ok", "users": users}
+
+    # --- Store Related Commands ---
+    elif cmd == "update_game_info":
+        try:
+            # 1. Safety check: Ensure 'Games' table exists
+            if "Games" not in db:
+                print("[DB] 'Games' table missing, creating new one...")
+                db["Games"] = {}
+
+            game_id = msg.get("game_id")
+            new_info = msg.get("info")
+
+            if not game_id or not new_info:
+                print("[DB Error] Missing game_id or info")
+                response = {"status": "error", "msg": "Missing data"}
+            else:
+                # 2. Ensure the game entry exists
+                if game_id not in db["Games"]:
+                    db["Games"][game_id] = {}
+
+                # 3. Preserve existing reviews
+                existing_reviews = db["Games"][game_id].get("reviews", [])
+
+                # 4. Update info
+                db["Games"][game_id] = new_info
+                db["Games"][game_id]["reviews"] = existing_reviews
+
+                save_db()
+                print(f"[DB] Updated info for {game_id}")
+                response = {"status": "ok"}
+        except Exception as e:
+            print(f"[DB EXCEPTION] update_game_info failed: {e}")
+            response = {"status": "error", "msg": str(e)}
+
+    # Get detailed game info (including reviews)
+    elif cmd == "get_game_details":
+        game_id = msg.get("game_id")
+        if game_id in db["Games"]:
+            game_data = db["Games"][game_id]
+            response = {"status": "ok", "game_info": game_data}
+        else:
+            response = {"status": "error", "msg": "Game not found"}
+
+    # Add a review
+    elif cmd == "add_review":
+        game_id = msg.get("game_id")
+        user = msg.get("user")
+        rating = msg.get("rating")
+        comment = msg.get("comment")
+
+        if game_id in db["Games"]:
+            if "reviews" not in db["Games"][game_id]:
+                db["Games"][game_id]["reviews"] = []
+
+            reviews_list = db["Games"][game_id]["reviews"]
+
+            # --- Check if already reviewed, update if so (Upsert) ---
+            found = False
+            for r in reviews_list:
+                if r["user"] == user:
+                    r["rating"] = int(rating)
+                    r["comment"] = comment
+                    r["time"] = time.time()  # Update timestamp
+                    found = True
+                    msg_str = "Review updated"
+                    break
+
+            if not found:
+                review_entry = {
+                    "user": user,
+                    "rating": int(rating),
+                    "comment": comment,
+                    "time": time.time()
+                }
+                reviews_list.append(review_entry)
+                msg_str = "Review added"
+            # -----------------------------------------------
+
+            save_db()
+            response = {"status": "ok", "msg": msg_str}
+        else:
+            response = {"status": "error", "msg": "Game not found"}
+
+    elif cmd == "get_store_list":
+        # Return all uploaded games (metadata only)
+        games_list = []
+        for gid, info in db["Games"].items():
+            games_list.append(info)
+        response = {"status": "ok", "games": games_list}
+
+    elif cmd == "delete_game":
+        game_id = msg.get("game_id")
+        if game_id in db["Games"]:
+            del db["Games"][game_id]
+            save_db()
+            response = {"status": "ok", "msg": f"Game {game_id} deleted"}
+        else:
+            response = {"status": "error", "msg": "Game not found"}
+
+
+    elif cmd == "create_room":
+        room_name = msg.get("room_name")
+        host = msg.get("host")
+        private = msg.get("private", False)
+        game_id = msg.get("game_id")
+
+        if room_name in db["Room"]:
+            response = {"status": "error", "msg": "Room already exists"}
+        else:
+            db["Room"][room_name] = {
+                "host": host,
+                "private": private,
+                "game_id": game_id,
+                "max_players": msg.get("max_players", 2),
+                "open": True,
+                "members": [host],
+                "ready": {host: False},
+            }
+            room_index.update(room_name, db["Room"][room_name])
+            save_db()
+            response = {"status": "ok", "room_info": db["Room"][room_name]}
+
+    elif cmd == "list_rooms":
+        # Optional filters and paging; without them every public room is returned
+        offset = msg.get("offset", 0)
+        names, total = room_index.query(
+            game_id=msg.get("game_id"),
+            open_only=msg.get("open_only", False),
+            free_slots=msg.get("free_slots", False),
+            sort=msg.get("sort", "fullest"),
+            offset=offset,
+            limit=msg.get("limit"),
+        )
+        rooms = []
+        for name in names:
+            info = db["Room"][name]
+            limit = info.get("max_players", 2)
+            rooms.append(
+                {
+                    "name": name,
+                    "host": info["host"],
+                    "open": info["open"] and len(info["members"]) < limit,
+                    "private": info["private"],
+                    "game_id": info.get("game_id"),
+                    "players": len(info["members"]),
+                    "max_players": limit,
+                }
+            )
+        response = {"status": "ok", "rooms": rooms, "total": total, "offset": offset}
+
+    elif cmd == "join_room":
+        room_name = msg.get("room_name")
+        user = msg.get("user")
+        if room_name not in db["Room"]:
+            response = {"status": "error", "msg": "Room not found"}
+        else:
+            room = db["Room"][room_name]
+            limit = room.get("max_players", 2)
+            if len(room["members"]) >= limit:
+                response = {"status": "error", "msg": "Room is full"}
+            elif user in room["members"]:
+                response = {"status": "error", "msg": "Already in room"}
+            else:
+                room["members"].append(user)
+                room["ready"][user] = False
+                if len(room["members"]) >= limit:
+                    room["open"] = False
+                room_index.update(room_name, room)
+                save_db()
+                response = {"status": "ok", "room_info": room}
+
+    elif cmd == "leave_room":
+        user = msg.get("user")
+        for rn, info in list(db["Room"].items()):
+            if user in info["members"]:
+                info["members"].remove(user)
+                if "ready" in info and user in info["ready"]:
+                    del info["ready"][user]
+
+                host_changed = False
+                if len(info["members"]) == 0:
+                    del db["Room"][rn]
+                elif info["host"] == user:
+                    info["host"] = info["members"][0]
+                    host_changed = True
+
+                if rn in db["Room"]:
+                    db["Room"][rn]["open"] = True
+                    room_index.update(rn, info)
+                else:
+                    room_index.remove(rn)
+
+                save_db()
+                # The room as it is now (None once the last member left), so the lobby can notify members
+                response = {"status": "ok", "msg": f"Left room {rn}", "room_name": rn,
+                            "room_info": db["Room"].get(rn), "host_changed": host_changed}
+                break
+        else:
+            response = {"status": "error", "msg": "User not in any room"}
+
+    elif cmd == "get_user_room":
+        user = msg.get("user")
+        room_found = None
+        for rn, info in db["Room"].items():
+            if user in info.get("members", []):
+                room_found = rn
+                break
+        response = {"status": "ok", "room_name": room_found}
+
+    elif cmd == "get_room_info":
+        room_name = msg.get("room_name")
+        if room_name in db["Room"]:
+            info = db["Room"][room_name].copy()
+            info["room_name"] = room_name
+            response = {"status": "ok", "room_info": info}
+        else:
+            response = {"status": "error", "msg": "Room not found"}
+
+    elif cmd == "clear_invitations":
+        user = msg.get("user")
+        if user in db["User"]:
+            db["User"][user]["invitations"] = []
+            save_db()
+            response = {"status": "ok"}
+        else:
+            response = {"status": "error", "msg": "User not found"}
+
+    elif cmd == "get_invitations":
+        user = msg.get("user")
+        if user in db["User"]:
+            # Use .get() to avoid errors if field is missing in old data
+            invites = db["User"][user].get("invitations", [])
+            response = {"status": "ok", "invitations": invites}
+        else:
+            response = {"status": "error", "msg": "User not found"}
+
+    elif cmd == "invite":
+        target_user = msg.get("user")
+        room_name = msg.get("room_name")
+
+        if target_user not in db["User"]:
+            response = {"status": "error", "msg": "Target user not found"}
+        else:
+            # Ensure invitation list exists
+            if "invitations" not in db["User"][target_user]:
+                db["User"][target_user]["invitations"] = []
+
+            # Avoid duplicate invitations
+            if room_name not in db["User"][target_user]["invitations"]:
+                db["User"][target_user]["invitations"].append(room_name)
+                save_db()
+
+            response = {"status": "ok", "msg": f"Invitation sent to {target_user}"}
+
+    elif cmd == "respond_invitation":
+        user = msg.get("user")
+        room_name = msg.get("room_name")
+        accept = msg.get("accept")  # True or False
+
+        if user in db["User"]:
+            # 1. Remove from invite list regardless of acceptance
+            user_invites = db["User"][user].get("invitations", [])
+            if room_name in user_invites:
+                user_invites.remove(room_name)
+                db["User"][user]["invitations"] = user_invites
+                save_db()
+
+            # 2. If accepted, execute join room logic
+            if accept:
+                if room_name not in db["Room"]:
+                    response = {"status": "error", "msg": "Room no longer exists"}
+                else:
+                    room = db["Room"][room_name]
+                    limit = room.get("max_players", 2)
+                    if len(room["members"]) >= limit:
+                        response = {"status": "error", "msg": "Room is full"}
+                    elif user in room["members"]:
+                        response = {"status": "error", "msg": "Already in room"}
+                    else:
+                        room["members"].append(user)
+                        room["ready"][user] = False  # Default not ready
+                        if len(room["members"]) >= limit:
+                            room["open"] = False  # Close room if full
+                        room_index.update(room_name, room)
+                        save_db()
+                        response = {"status": "ok", "msg": f"Joined room {room_name}", "room_info": room}
+            else:
+                response = {"status": "ok", "msg": "Invitation declined"}
+        else:
+            response = {"status": "error", "msg": "User not found"}
+
+    elif cmd == "set_ready":
+        user = msg.get("user")
+        ready = msg.get("ready")
+        room_found = False
+
+        # Find user's room
+        for r_name, r_info in db["Room"].items():
+            if user in r_info["members"]:
+                r_info["ready"][user] = ready
+                room_found = True
+                save_db()
+                response = {"status": "ok", "msg": f"Set ready to {ready}", "room_name": r_name,
+                            "room_info": r_info}
+                break
+
+        if not room_found:
+            response = {"status": "error", "msg": "User not in any room"}
+
+    elif cmd == "matchmake":
+        user = msg.get("user")
+        game_id = msg.get("game_id")
+        if any(user in info["members"] for info in db["Room"].values()):
+            response = {"status": "error", "msg": "Leave your room before matchmaking."}
+        elif user in match_users:
+            response = {"status": "error", "msg": f"Already searching for a {match_users[user]} match."}
+        else:
+            match_queue.setdefault(game_id, {})[user] = time.time()
+            match_users[user] = game_id
+            response = {"status": "ok", "position": len(match_queue[game_id])}
+
+    elif cmd == "cancel_matchmake":
+        if unqueue(msg.get("user")) is None:
+            response = {"status": "error", "msg": "You are not in the matchmaking queue."}
+        else:
+            response = {"status": "ok", "msg": "Matchmaking cancelled."}
+
+    elif cmd == "match_players":
+        rooms, waits, dropped = form_matches(msg.get("games", {}), msg.get("fill_wait", 0))
+        response = {"status": "ok", "rooms": rooms, "waits": waits, "dropped": dropped,
+                    "queued": len(match_users)}
+
+    else:
+        # Fallback for unhandled commands (if any)
+        if response["msg"] == "Unknown command" and cmd in ["invite", "manage_invitations", "respond_invitation", "set_ready", "start_game"]:
+            pass
+
+    return response
+
+
 # Client Handler
 def handle_client(conn, addr):
     print(f"[DB CONNECTED] {addr}")
@@ -81,7 +612,7 @@ def handle_client(conn, addr):
                 raw_len += chunk
 
             msg_len = struct.unpack("!I", raw_len)[0]
-            if msg_len <= 0 or msg_len > 65536:
+            if msg_len <= 0 or msg_len > MAX_MSG_SIZE:
                 print(f"[ERROR] Invalid message length: {msg_len}")
                 break
 
@@ -94,345 +625,11 @@ def handle_client(conn, addr):
 
             msg = json.loads(data.decode())
             # print(f"[DB DEBUG] Received: {msg}") 
- 
-
-
-            cmd = msg.get("cmd")
-            response = {"status": "error", "msg": "Unknown command"}
-            role = msg.get("role", "player")
-            target_table = "Developer" if role == "developer" else "User"
-
-            if cmd == "create":
-                user = msg.get("user")
-                password = msg.get("password")
-                if user in db[target_table]:
-                    response = {"status": "error", "msg": f"{role.capitalize()} account exists"}
-                else:
-                    # Create account
-                    db[target_table][user] = {"password": password, "online": False}
-                    if role == "developer":
-                        db[target_table][user]["owned_games"] = []  # Reserved field
-                    save_db()
-                    response = {"status": "ok"}
-
-            elif cmd == "read":
-                user = msg.get("user")
-                if user in db[target_table]:
-                    response = {
-                        "status": "ok",
-                        "password": db[target_table][user]["password"],
-                        "online": db[target_table][user].get("online", False),
-                    }
-                else:
-                    response = {"status": "error", "msg": "Account not found"}
-
-            elif cmd == "set_online":
-                user = msg.get("user")
-                online = msg.get("online", False)
-                if user in db[target_table]:
-                    db[target_table][user]["online"] = online
-                    save_db()
-                    response = {"status": "ok"}
-                else:
-                    response = {"status": "error", "msg": "User not found"}
-
-            elif cmd == "list":
-                online_only = msg.get("online_only", False)
-                users = list(db["User"].keys())
-                if online_only:
-                    users = [u for u in users if db["User"][u].get("online", False)]
-                response = {"status": "ok", "users": users}
-
-            # --- Store Related Commands ---
-            elif cmd == "update_game_info":
-                try:
-                    # 1. Safety check: Ensure 'Games' table exists
-                    if "Games" not in db:
-                        print("[DB] 'Games' table missing, creating new one...")
-                        db["Games"] = {}
-
-                    game_id = msg.get("game_id")
-                    new_info = msg.get("info")
-
-                    if not game_id or not new_info:
-                        print("[DB Error] Missing game_id or info")
-                        response = {"status": "error", "msg": "Missing data"}
-                    else:
-                        # 2. Ensure the game entry exists
-                        if game_id not in db["Games"]:
-                            db["Games"][game_id] = {}
-
-                        # 3. Preserve existing reviews
-                        existing_reviews = db["Games"][game_id].get("reviews", [])
-
-                        # 4. Update info
-                        db["Games"][game_id] = new_info
-                        db["Games"][game_id]["reviews"] = existing_reviews
-
-                        save_db()
-                        print(f"[DB] Updated info for {game_id}")
-                        response = {"status": "ok"}
-                except Exception as e:
-                    print(f"[DB EXCEPTION] update_game_info failed: {e}")
-                    response = {"status": "error", "msg": str(e)}
-
-            # Get detailed game info (including reviews)
-            elif cmd == "get_game_details":
-                game_id = msg.get("game_id")
-                if game_id in db["Games"]:
-                    game_data = db["Games"][game_id]
-                    response = {"status": "ok", "game_info": game_data}
-                else:
-                    response = {"status": "error", "msg": "Game not found"}
-
-            # Add a review
-            elif cmd == "add_review":
-                game_id = msg.get("game_id")
-                user = msg.get("user")
-                rating = msg.get("rating")
-                comment = msg.get("comment")
-
-                if game_id in db["Games"]:
-                    if "reviews" not in db["Games"][game_id]:
-                        db["Games"][game_id]["reviews"] = []
-
-                    reviews_list = db["Games"][game_id]["reviews"]
-
-                    # --- Check if already reviewed, update if so (Upsert) ---
-                    found = False
-                    for r in reviews_list:
-                        if r["user"] == user:
-                            r["rating"] = int(rating)
-                            r["comment"] = comment
-                            r["time"] = time.time()  # Update timestamp
-                            found = True
-                            msg_str = "Review updated"
-                            break
-
-                    if not found:
-                        review_entry = {
-                            "user": user,
-                            "rating": int(rating),
-                            "comment": comment,
-                            "time": time.time()
-                        }
-                        reviews_list.append(review_entry)
-                        msg_str = "Review added"
-                    # -----------------------------------------------
-
-                    save_db()
-                    response = {"status": "ok", "msg": msg_str}
-                else:
-                    response = {"status": "error", "msg": "Game not found"}
-
-            elif cmd == "get_store_list":
-                # Return all uploaded games (metadata only)
-                games_list = []
-                for gid, info in db["Games"].items():
-                    games_list.append(info)
-                response = {"status": "ok", "games": games_list}
-
-            elif cmd == "delete_game":
-                game_id = msg.get("game_id")
-                if game_id in db["Games"]:
-                    del db["Games"][game_id]
-                    save_db()
-                    response = {"status": "ok", "msg": f"Game {game_id} deleted"}
-                else:
-                    response = {"status": "error", "msg": "Game not found"}
-
-
-            elif cmd == "create_room":
-                room_name = msg.get("room_name")
-                host = msg.get("host")
-                private = msg.get("private", False)
-                game_id = msg.get("game_id")
-
-                if room_name in db["Room"]:
-                    response = {"status": "error", "msg": "Room already exists"}
-                else:
-                    db["Room"][room_name] = {
-                        "host": host,
-                        "private": private,
-                        "game_id": game_id,
-                        "max_players": msg.get("max_players", 2),
-                        "open": True,
-                        "members": [host],
-                        "ready": {host: False},
-                    }
-                    save_db()
-                    response = {"status": "ok"}
-
-            elif cmd == "list_rooms":
-                rooms = []
-                for name, info in db["Room"].items():
-                    if not info["private"]:
-                        limit = info.get("max_players", 2)
-                        full = len(info["members"]) >= limit
-                        rooms.append(
-                            {
-                                "name": name,
-                                "host": info["host"],
-                                "open": info["open"] and not full,
-                                "private": info["private"],
-                            }
-                        )
-                response = {"status": "ok", "rooms": rooms}
-
-            elif cmd == "join_room":
-                room_name = msg.get("room_name")
-                user = msg.get("user")
-                if room_name not in db["Room"]:
-                    response = {"status": "error", "msg": "Room not found"}
-                else:
-                    room = db["Room"][room_name]
-                    limit = room.get("max_players", 2)
-                    if len(room["members"]) >= limit:
-                        response = {"status": "error", "msg": "Room is full"}
-                    elif user in room["members"]:
-                        response = {"status": "error", "msg": "Already in room"}
-                    else:
-                        room["members"].append(user)
-                        room["ready"][user] = False
-                        if len(room["members"]) >= limit:
-                            room["open"] = False
-                        save_db()
-                        response = {"status": "ok"}
-
-            elif cmd == "leave_room":
-                user = msg.get("user")
-                for rn, info in list(db["Room"].items()):
-                    if user in info["members"]:
-                        info["members"].remove(user)
-                        if "ready" in info and user in info["ready"]:
-                            del info["ready"][user]
-
-                        if len(info["members"]) == 0:
-                            del db["Room"][rn]
-                        elif info["host"] == user:
-                            info["host"] = info["members"][0]
-
-                        if rn in db["Room"]:
-                            db["Room"][rn]["open"] = True
-
-                        save_db()
-                        response = {"status": "ok", "msg": f"Left room {rn}"}
-                        break
-                else:
-                    response = {"status": "error", "msg": "User not in any room"}
-
-            elif cmd == "get_user_room":
-                user = msg.get("user")
-                room_found = None
-                for rn, info in db["Room"].items():
-                    if user in info.get("members", []):
-                        room_found = rn
-                        break
-                response = {"status": "ok", "room_name": room_found}
-
-            elif cmd == "get_room_info":
-                room_name = msg.get("room_name")
-                if room_name in db["Room"]:
-                    info = db["Room"][room_name].copy()
-                    info["room_name"] = room_name
-                    response = {"status": "ok", "room_info": info}
-                else:
-                    response = {"status": "error", "msg": "Room not found"}
-
-            elif cmd == "clear_invitations":
-                user = msg.get("user")
-                if user in db["User"]:
-                    db["User"][user]["invitations"] = []
-                    save_db()
-                    response = {"status": "ok"}
-                else:
-                    response = {"status": "error", "msg": "User not found"}
-
-            elif cmd == "get_invitations":
-                user = msg.get("user")
-                if user in db["User"]:
-                    # Use .get() to avoid errors if field is missing in old data
-                    invites = db["User"][user].get("invitations", [])
-                    response = {"status": "ok", "invitations": invites}
-                else:
-                    response = {"status": "error", "msg": "User not found"}
-
-            elif cmd == "invite":
-                target_user = msg.get("user")
-                room_name = msg.get("room_name")
-
-                if target_user not in db["User"]:
-                    response = {"status": "error", "msg": "Target user not found"}
-                else:
-                    # Ensure invitation list exists
-                    if "invitations" not in db["User"][target_user]:
-                        db["User"][target_user]["invitations"] = []
-
-                    # Avoid duplicate invitations
-                    if room_name not in db["User"][target_user]["invitations"]:
-                        db["User"][target_user]["invitations"].append(room_name)
-                        save_db()
-
-                    response = {"status": "ok", "msg": f"Invitation sent to {target_user}"}
-
-            elif cmd == "respond_invitation":
-                user = msg.get("user")
-                room_name = msg.get("room_name")
-                accept = msg.get("accept")  # True or False
-
-                if user in db["User"]:
-                    # 1. Remove from invite list regardless of acceptance
-                    user_invites = db["User"][user].get("invitations", [])
-                    if room_name in user_invites:
-                        user_invites.remove(room_name)
-                        db["User"][user]["invitations"] = user_invites
-                        save_db()
-
-                    # 2. If accepted, execute join room logic
-                    if accept:
-                        if room_name not in db["Room"]:
-                            response = {"status": "error", "msg": "Room no longer exists"}
-                        else:
-                            room = db["Room"][room_name]
-                            if len(room["members"]) >= 2:
-                                response = {"status": "error", "msg": "Room is full"}
-                            elif user in room["members"]:
-                                response = {"status": "error", "msg": "Already in room"}
-                            else:
-                                room["members"].append(user)
-                                room["ready"][user] = False  # Default not ready
-                                if len(room["members"]) >= 2:
-                                    room["open"] = False  # Close room if full
-                                save_db()
-                                response = {"status": "ok", "msg": f"Joined room {room_name}"}
-                    else:
-                        response = {"status": "ok", "msg": "Invitation declined"}
-                else:
-                    response = {"status": "error", "msg": "User not found"}
-
-            elif cmd == "set_ready":
-                user = msg.get("user")
-                ready = msg.get("ready")
-                room_found = False
-
-                # Find user's room
-                for r_name, r_info in db["Room"].items():
-                    if user in r_info["members"]:
-                        r_info["ready"][user] = ready
-                        room_found = True
-                        save_db()
-                        response = {"status": "ok", "msg": f"Set ready to {ready}"}
-                        break
-
-                if not room_found:
-                    response = {"status": "error", "msg": "User not in any room"}
-
-            else:
-                # Fallback for unhandled commands (if any)
-                if response["msg"] == "Unknown command" and cmd in ["invite", "manage_invitations", "respond_invitation", "set_ready", "start_game"]:
-                    pass
+            # Serialize under the lock: responses may reference live room records
+            with lock:
+                response = json.dumps(handle_request(msg))
 
-            send_msg(conn, json.dumps(response))
+            send_msg(conn, response)
 
     except Exception as e:
         if not isinstance(e, ConnectionResetError):
@@ -456,8 +653,9 @@ def admin_console(server_socket):
 
 
 def main():
-    global db
+    global db, room_index
     db = load_db()
+    room_index = RoomIndex(db["Room"])
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((DB_HOST, DB_PORT))
@@ -0,0 +1,74 @@
+# game_worker.py
+# Pre-warmed game server host. lobby_server.py starts a few of these ahead of
+# time; each one waits for a single assignment on stdin and then runs that
+# game's server_entry in-process, so start_game skips interpreter startup.
+import sys
+import os
+import json
+import socket
+import runpy
+
+# Modules game servers commonly import, loaded before any room needs them
+import threading  # noqa: F401
+import random  # noqa: F401
+import time  # noqa: F401
+import struct  # noqa: F401
+import select  # noqa: F401
+import queue  # noqa: F401
+
+
+def report_listening(status):
+    """Tell the lobby once the game's first listening socket is up."""
+    original_listen = socket.socket.listen
+
+    def listen(self, *args):
+        original_listen(self, *args)
+        socket.socket.listen = original_listen
+        status.write("listening\n")
+        status.flush()
+
+    socket.socket.listen = listen
+
+
+def apply_limits(job):
+    """Cap this game's CPU time and address space (POSIX only)."""
+    try:
+        import resource
+    except ImportError:
+        return  # Windows: only the lobby's wall-clock limit applies
+    cpu = job.get("cpu_limit")
+    if cpu:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 5))
+    mem = job.get("mem_limit")
+    if mem:
+        resource.setrlimit(resource.RLIMIT_AS, (mem, mem))
+
+
+def main():
+    # The original stdout becomes the status channel to the lobby; the game's
+    # own prints go to stderr (the lobby console) like a normal game server
+    status = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    status.write("idle\n")
+    status.flush()
+
+    line = sys.stdin.readline()
+    if not line:
+        return  # Lobby shut down before this worker was needed
+    job = json.loads(line)
+
+    game_dir = job["cwd"]
+    entry = job["entry"]
+    os.chdir(game_dir)
+    os.environ["GAME_PORT"] = str(job["port"])
+    sys.path.insert(0, game_dir)
+    sys.argv = [entry]
+
+    apply_limits(job)
+    report_listening(status)
+    runpy.run_path(entry, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
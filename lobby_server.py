@@ -1,354 +1,2017 @@
 # lobby_server.py
 import socket
 import threading
+import asyncio
 import json
 import os
 import sys
-import subprocess
 import struct
 import shutil
 import zipfile
-from config import LOBBY_HOST, LOBBY_PORT, DB_HOST, DB_PORT, GAME_HOST, GAME_PORT
+import time
+import re
+import hashlib
+import zlib
+import secrets
+import contextvars
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # Optional; zlib is always available
+from artifact_store import ArtifactStore, remove_dir
+from metrics import MetricsRegistry
+from config import (LOBBY_HOST, LOBBY_PORT, LOBBY_WORKERS, DB_HOST, DB_PORT, DB_POOL_SIZE, GAME_HOST, GAME_PORT,
+                    GAME_PORT_MAX, GAME_WORKER_POOL_SIZE, GAME_MAX_SESSIONS, GAME_MAX_WALL_TIME,
+                    GAME_CPU_LIMIT, GAME_MEMORY_LIMIT_MB, STORE_CACHE_TTL, STORE_CACHE_SIZE,
+                    USE_SENDFILE, DOWNLOAD_CHUNK_SIZE, MAX_CONCURRENT_TRANSFERS, ARTIFACT_GC_INTERVAL,
+                    GAME_RETAIN_VERSIONS, FRAME_COMPRESSION, COMPRESSION_MIN_SIZE, MAX_UPLOAD_SIZE,
+                    MAX_GAME_INSTALL_SIZE, INGEST_WORKERS, DATA_PORT, DATA_TICKET_TTL, DATA_IDLE_TIMEOUT,
+                    HOT_CACHE_SIZE_MB, HOT_CACHE_MAX_ITEM_MB, OUTBOX_MAX_FRAMES, OUTBOX_MAX_BYTES, SESSION_TIMEOUT, REAP_INTERVAL,
+                    RATE_LIMITS, MAX_EXPENSIVE_COMMANDS, QUERY_DB_SLOTS,
+                    MATCH_INTERVAL, MATCH_FILL_WAIT, ROOM_PAGE_SIZE, ROOM_PAGE_MAX, METRICS_HOST, METRICS_PORT)
 
 HOST = LOBBY_HOST
 PORT = LOBBY_PORT
 
 server_running = True
-db_socket = None
 game_server_process = None
 
-# Global client connection tracking (username -> socket object)
+# Largest frame accepted on the client and DB links
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# High bit of a frame's length: payload is compressed with the connection's codec
+COMPRESSED_FLAG = 0x80000000
+
+# Pending connections the listening socket may queue during login bursts
+LISTEN_BACKLOG = 1024
+# Pre-warmed game server host (see game_worker.py)
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_worker.py")
+# How long start_game waits for a game server to start listening
+GAME_START_TIMEOUT = 10
+
+# Global client connection tracking (username -> StreamWriter).
+# Only touched from the event loop thread, so no lock is needed.
 client_connections = {}
-connection_lock = threading.Lock()
+# Frame compression negotiated at login (StreamWriter -> FrameCodec)
+connection_codecs = {}
+# JSON bytes sent to clients before and after compression, for the admin 'stats' command
+frame_bytes = {"raw": 0, "wire": 0}
+# Listener connections closed because they stopped reading
+slow_listeners_dropped = 0
+# When each control/listener connection last sent a frame (heartbeats included): writer -> time.monotonic()
+last_seen = {}
+# Connections closed by reap_idle_connections()
+connections_reaped = 0
+# Rate-limit class of each client command (see RATE_LIMITS in config.py). Commands
+# mapped to None are never limited; unknown commands count as "action".
+COMMAND_CLASSES = {
+    "heartbeat": None, "_listener": None, "logout": None, "exit": None,
+    "register": "auth", "login": "auth",
+    "list": "query", "list_rooms": "query", "get_user_room": "query", "get_room_info": "query",
+    "manage_invitations": "query", "get_store_list": "query", "get_game_details": "query",
+    "get_file_index": "query",
+    "create_room": "action", "join_room": "action", "leave_room": "action", "invite": "action",
+    "invite_player": "action", "respond_invitation": "action", "set_ready": "action",
+    "add_review": "action", "delete_game": "action", "matchmake": "action", "cancel_matchmake": "action",
+    "upload_game": "expensive", "download_game": "expensive", "download_files": "expensive",
+    "start_game": "expensive",
+}
+# Class of the command the current handle_client task is serving; db_call reads it
+command_class = contextvars.ContextVar("command_class", default=None)
+# Commands running now, per class with a global cap ("query" counts DB calls in flight)
+in_flight = {"query": 0, "expensive": 0}
+# Requests refused for exceeding a session's rate ("rate") or a global cap ("busy")
+throttled_requests = {"rate": 0, "busy": 0}
+# Matchmaking totals for the admin 'stats' command ("queued" as of the last matcher run)
+matchmaking = {"queued": 0, "matched": 0, "rooms": 0}
+# Queue wait in seconds of the most recently matched players
+match_waits = deque(maxlen=10000)
+# Prometheus metrics of this process, served on METRICS_PORT and printed by the
+# admin 'metrics' command. Figures kept for 'stats' are exported as they are.
+metrics = MetricsRegistry()
+command_seconds = metrics.histogram(
+    "lobby_command_duration_seconds", "Time to handle a client command, by command.", ["command"])
+commands_handled = metrics.counter(
+    "lobby_commands_total", "Client commands handled, by command (throttled ones excluded).", ["command"])
+metrics.counter("lobby_throttled_requests_total", "Client commands refused by admission control, by reason.",
+                ["reason"], fn=lambda: {(reason,): n for reason, n in throttled_requests.items()})
+metrics.gauge("lobby_commands_in_flight", "Query DB calls and transfers/game starts in progress.",
+              ["class"], fn=lambda: {(cls,): n for cls, n in in_flight.items()})
+metrics.gauge("lobby_connections", "Open control and listener connections.", fn=lambda: len(last_seen))
+metrics.gauge("lobby_sessions", "Logged-in users connected to this process.",
+              fn=lambda: sum(not isinstance(c, Outbox) for c in client_connections.values()))
+metrics.gauge("lobby_listener_connections", "Listener connections receiving pushes.",
+              fn=lambda: sum(isinstance(c, Outbox) for c in client_connections.values()))
+metrics.gauge("lobby_listener_queued_messages", "Pushes waiting in listener outboxes.",
+              fn=lambda: sum(c.pending() for c in client_connections.values() if isinstance(c, Outbox)))
+metrics.counter("lobby_slow_listeners_dropped_total", "Listener connections closed for not reading.",
+                fn=lambda: slow_listeners_dropped)
+metrics.counter("lobby_connections_reaped_total", "Connections closed after SESSION_TIMEOUT without heartbeats.",
+                fn=lambda: connections_reaped)
+db_request_seconds = metrics.histogram(
+    "lobby_db_request_duration_seconds", "db_server requests including the wait for a pooled connection, "
+    "by DB command.", ["command"])
+db_retries = metrics.counter("lobby_db_retries_total", "DB requests retried on a new connection.")
+db_failures = metrics.counter("lobby_db_failures_total", "DB requests that failed, by reason.", ["reason"])
+download_bytes = metrics.counter(
+    "lobby_download_bytes_total", "Game artifact bytes sent to clients, by game and version.", ["game_id", "version"])
+upload_bytes = metrics.counter("lobby_upload_bytes_total", "Game upload bytes received.")
+metrics.counter("lobby_store_cache_requests_total", "Store list/details lookups, by cache result.", ["result"],
+                fn=lambda: {("hit",): store_cache.hits, ("miss",): store_cache.misses})
+metrics.counter("lobby_hot_cache_requests_total", "Artifact reads from memory, by cache result.", ["result"],
+                fn=lambda: {("hit",): hot_artifacts.hits, ("miss",): hot_artifacts.misses})
+metrics.gauge("lobby_game_sessions", "Game servers run by this process, by state.", ["state"],
+              fn=lambda: {("running",): len(supervisor.sessions), ("queued",): len(supervisor.pending)})
+game_launch_seconds = metrics.histogram(
+    "lobby_game_launch_duration_seconds", "Time until a launched game server listens, by pre-warmed (warm) "
+    "or newly started (cold) game worker.", ["start"])
+metrics.gauge("lobby_matchmaking_queued", "Players in the matchmaking queue at the last matcher run.",
+              fn=lambda: matchmaking["queued"])
+match_wait_seconds = metrics.histogram(
+    "lobby_matchmaking_wait_seconds", "Time matched players spent in the matchmaking queue.",
+    buckets=(0.5, 1, 2, 5, 10, 15, 20, 30, 60, 120, 300))
+# Strong references to fire-and-forget tasks so they are not garbage collected
+background_tasks = set()
+# Event loop running serve(); the admin console thread submits work to it
+main_loop = None
+# Limits how many game files are streamed to clients at once. Created in serve():
+# before Python 3.10 an asyncio primitive binds to the loop current when it is made
+transfer_slots = None
+# DB connections query commands may use (see db_call); created in serve() like transfer_slots
+query_db_slots = None
+# How long a query waits for one of those before it is refused as busy
+QUERY_DB_WAIT = 1.0
+# Partially received uploads, kept so an interrupted upload can resume
+INCOMING_DIR = os.path.join("games_repo", ".incoming")
+# Partial uploads nobody resumed within this many seconds are deleted at startup
+INCOMING_MAX_AGE = 24 * 3600
+# .part files currently being written, so two connections never append to one.
+# Per process: with several lobby workers a clash is caught by the checksum instead.
+active_uploads = set()
+# Received upload bytes are written and hashed in batches of this size
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+# Every zip starts with a local file header
+ZIP_MAGIC = b"PK\x03\x04"
+# Cleared once the event loop's transports turn out not to support sendfile
+sendfile_available = USE_SENDFILE
+# One-time data port tokens: token -> transfer prepared on a control connection
+data_tickets = {}
+# This process's data port; each lobby worker has its own, since tickets live in its memory
+data_port = DATA_PORT
+# Multi-process mode: this worker's index and its link to the other workers (see WorkerBus)
+worker_index = None
+bus = None
+# Multi-process mode, primary process: relays messages between the workers (see BusHub)
+bus_hub = None
+# file path -> (mtime, sha256) for artifacts uploaded before checksums were stored
+artifact_checksums = {}
+# Blobs and per-version trees for everything in games_repo (see artifact_store.py)
+artifacts = ArtifactStore("games_repo")
+# games_repo/<game_id>/.current holds the active version; versions sit side by side
+CURRENT_POINTER = ".current"
+
+
+class DBConnectionPool:
+    """Bounded, thread-safe pool of length-prefixed connections to db_server.
+
+    Each request checks out its own connection, so concurrent db_executor
+    threads never interleave bytes on a shared socket. Connections that sat
+    idle longer than `idle_check` seconds are pinged before reuse, and a
+    request that hits a dead connection is retried once on a fresh one.
+    """
+
+    def __init__(self, host, port, size=DB_POOL_SIZE, timeout=5, idle_check=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []  # [(socket, last_used)], used as a stack
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self.timeout)  # Connect and per-request timeout
+            s.connect((self.host, self.port))
+            return s
+        except Exception as e:
+            s.close()
+            print(f"[ERROR] Cannot connect to DB server at {self.host}:{self.port}")
+            print(f"[ERROR DETAIL] {type(e).__name__}: {e}")
+            raise ConnectionError("DB Connection Failed")
 
+    def _exchange(self, s, req_dict):
+        # Send using length-prefix format (matching db_server.py)
+        msg_bytes = json.dumps(req_dict).encode()
+        s.sendall(struct.pack("!I", len(msg_bytes)) + msg_bytes)
+
+        resp_len = struct.unpack("!I", self._recv_exact(s, 4))[0]
+        if resp_len <= 0 or resp_len > MAX_FRAME_SIZE:
+            raise ValueError(f"Invalid response length: {resp_len}")
+        return json.loads(self._recv_exact(s, resp_len).decode())
+
+    @staticmethod
+    def _recv_exact(s, n):
+        data = b""
+        while len(data) < n:
+            packet = s.recv(n - len(data))
+            if not packet:
+                raise ConnectionResetError("DB server closed connection")
+            data += packet
+        return data
+
+    def _is_healthy(self, s):
+        try:
+            return self._exchange(s, {"cmd": "ping"}).get("status") == "ok"
+        except (OSError, ValueError):
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                s, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.idle_check or self._is_healthy(s):
+                return s
+            s.close()
+        return self._connect()
+
+    def _checkin(self, s):
+        with self._lock:
+            self._idle.append((s, time.monotonic()))
+
+    def request(self, req_dict):
+        t_start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            print("[WARNING] DB pool exhausted, request dropped")
+            db_failures.inc("pool_exhausted")
+            return {"status": "error", "msg": "Database busy"}
+        try:
+            for attempt in range(2):
+                s = None
+                try:
+                    s = self._checkout() if attempt == 0 else self._connect()
+                    resp = self._exchange(s, req_dict)
+                    self._checkin(s)
+                    db_request_seconds.observe(time.perf_counter() - t_start, str(req_dict.get("cmd")))
+                    return resp
+                except (ConnectionError, OSError, ValueError) as e:
+                    if s is not None:
+                        s.close()
+                    if attempt == 0:
+                        print(f"[WARNING] DB connection lost: {e}. Reconnecting...")
+                        db_retries.inc()
+                    else:
+                        print(f"[ERROR] Failed to reconnect to DB: {e}")
+            db_failures.inc("connection")
+            return {"status": "error", "msg": "Database connection failed"}
+        finally:
+            self._slots.release()
+
+    def warm_up(self):
+        """Open one connection eagerly so startup fails fast if the DB is down."""
+        s = self._connect()
+        print(f"[SYSTEM] Connected to DB server at {self.host}:{self.port}")
+        self._checkin(s)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for s, _ in idle:
+            s.close()
 
-def connect_db_server():
-    global db_socket
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.settimeout(5)  # Set connection timeout
-        s.connect((DB_HOST, DB_PORT))
-        print(f"[SYSTEM] Connected to DB server at {DB_HOST}:{DB_PORT}")
-        s.settimeout(None)  # Remove timeout after successful connection
-        db_socket = s
-        return s
-    except Exception as e:
-        print(f"[ERROR] Cannot connect to DB server at {DB_HOST}:{DB_PORT}")
-        print(f"[ERROR DETAIL] {type(e).__name__}: {e}")
-        print(f"[ERROR] Cannot connect to DB server at {DB_HOST}:{DB_PORT}")
-        print(f"[ERROR DETAIL] {type(e).__name__}: {e}")
-        raise ConnectionError("DB Connection Failed")
 
+db_pool = DBConnectionPool(DB_HOST, DB_PORT)
+# One executor thread per pooled connection: DB calls never wait on the pool
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+# Upload writes, hashing and installs, kept off the default executor other commands use
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
 
 
 def db_request(req_dict):
-    global db_socket
-    try:
-        if db_socket is None:
-            connect_db_server()
+    return db_pool.request(req_dict)
 
-        # Send using length-prefix format (matching db_server.py)
-        msg_json = json.dumps(req_dict)
-        msg_bytes = msg_json.encode()
-        length_prefix = struct.pack("!I", len(msg_bytes))
-        db_socket.send(length_prefix + msg_bytes)
 
-        # Set receive timeout to avoid indefinite waiting
-        db_socket.settimeout(5)
+class PortPool:
+    """Hands out game server ports from [first, last], one per running session.
+
+    A port is only handed out if it can actually be bound right now, so ports
+    held by stray processes outside the lobby are skipped and retried later.
+    """
+
+    def __init__(self, first, last):
+        self._free = deque(range(first, last + 1))
+        self._in_use = {}  # port -> room_name
+
+    def acquire(self, room_name):
+        for _ in range(len(self._free)):
+            port = self._free.popleft()
+            if self._is_bindable(port):
+                self._in_use[port] = room_name
+                return port
+            self._free.append(port)
+        return None
+
+    def release(self, port):
+        if self._in_use.pop(port, None) is not None:
+            self._free.append(port)
+
+    def in_use(self):
+        return dict(self._in_use)
+
+    @staticmethod
+    def _is_bindable(port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            # Receive response length prefix (ensure 4 bytes are read)
-            raw_len = b""
-            while len(raw_len) < 4:
-                chunk = db_socket.recv(4 - len(raw_len))
-                if not chunk:
-                    raise ConnectionResetError("DB server closed connection")
-                raw_len += chunk
-
-            resp_len = struct.unpack("!I", raw_len)[0]
-            if resp_len <= 0 or resp_len > 65536:
-                raise ValueError(f"Invalid response length: {resp_len}")
-
-            resp_data = b""
-            while len(resp_data) < resp_len:
-                packet = db_socket.recv(resp_len - len(resp_data))
-                if not packet:
-                    raise ConnectionResetError(
-                        "DB server closed connection during read"
-                    )
-                resp_data += packet
+            if os.name != "nt":
+                # Match the game servers, which also bind with SO_REUSEADDR
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(("0.0.0.0", port))
+            return True
+        except OSError:
+            return False
         finally:
-            db_socket.settimeout(None)  # Restore blocking mode
+            s.close()
 
-        return json.loads(resp_data.decode())
-    except (ConnectionResetError, BrokenPipeError, OSError) as e:
-        print(f"[WARNING] DB connection lost: {e}. Reconnecting...")
-        db_socket = None
-        # Reconnect and retry once
-        try:
-            connect_db_server()
-            msg_json = json.dumps(req_dict)
-            msg_bytes = msg_json.encode()
-            length_prefix = struct.pack("!I", len(msg_bytes))
-            db_socket.send(length_prefix + msg_bytes)
-
-            # Set receive timeout
-            db_socket.settimeout(5)
+
+port_pool = PortPool(GAME_PORT, GAME_PORT_MAX)
+
+
+class GameWorkerPool:
+    """Keeps `size` idle game_worker.py processes started and imported ahead of time.
+
+    launch() hands a room to an idle worker (or a freshly spawned one when the
+    pool is empty), refills the pool in the background, and only returns once
+    the game server is listening, so the start_game broadcast never races it.
+    Idle workers exit on their own when the lobby goes away (stdin EOF).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = deque()
+        self._spawning = 0
+
+    async def _spawn(self):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, WORKER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        await proc.stdout.readline()  # "idle": imports are done
+        return proc
+
+    async def fill(self):
+        while len(self._idle) + self._spawning < self.size:
+            self._spawning += 1
             try:
-                # Receive response length prefix
-                raw_len = b""
-                while len(raw_len) < 4:
-                    chunk = db_socket.recv(4 - len(raw_len))
-                    if not chunk:
-                        raise ConnectionResetError("DB server closed connection")
-                    raw_len += chunk
-
-                resp_len = struct.unpack("!I", raw_len)[0]
-                resp_data = b""
-                while len(resp_data) < resp_len:
-                    packet = db_socket.recv(resp_len - len(resp_data))
-                    if not packet:
-                        raise ConnectionResetError("DB server closed connection")
-                    resp_data += packet
+                self._idle.append(await self._spawn())
+            except Exception as e:
+                print(f"[ERROR] Failed to pre-start game worker: {e}")
+                return
             finally:
-                db_socket.settimeout(None)
+                self._spawning -= 1
+
+    async def _take(self):
+        while self._idle:
+            proc = self._idle.popleft()
+            if proc.returncode is None:
+                return proc, True
+        return await self._spawn(), False
+
+    async def launch(self, game_dir, server_entry, port, limits=None):
+        proc, warm = await self._take()
+        spawn_background(self.fill())
+
+        job = {"cwd": os.path.abspath(game_dir), "entry": server_entry, "port": port}
+        job.update(limits or {})
+        proc.stdin.write((json.dumps(job) + "\n").encode())
+        await proc.stdin.drain()
+
+        # Wait until the game server binds and listens on its port
+        try:
+            line = await asyncio.wait_for(proc.stdout.readline(), GAME_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            line = b""
+        if line.strip() != b"listening":
+            if proc.returncode is None:
+                proc.kill()
+            raise RuntimeError("game server did not start listening")
+        return proc, warm
 
-            return json.loads(resp_data.decode())
-        except Exception as retry_e:
-            print(f"[ERROR] Failed to reconnect to DB: {retry_e}")
-            return {"status": "error", "msg": "Database connection failed"}
 
+worker_pool = GameWorkerPool(GAME_WORKER_POOL_SIZE)
 
-def handle_client(conn, addr):
+
+def read_proc_usage(pid):
+    """Return (cpu_seconds, rss_kb) for a process, or (None, None) if unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as f:
+            rss = next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), 0)
+        return cpu, rss
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None, None
+
+
+class GameSupervisor:
+    """Owns every running game server process.
+
+    At most `max_sessions` games run at once; further start requests wait in
+    a FIFO queue and are launched (and broadcast) as sessions end. Each game
+    runs under CPU/memory rlimits applied by its worker and a wall-clock
+    limit enforced here, and is reaped as soon as it exits.
+
+    In multi-process mode each lobby worker has its own supervisor; they
+    announce running and queued rooms over the worker bus so that no room
+    starts twice and no worker prunes a version another one is running.
+    """
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self.sessions = {}  # room_name -> {"game_id", "game_dir", "port", "proc", "started"}
+        self.pending = deque()  # (room_name, game_id, game_dir, server_entry)
+        self.remote = {}  # room_name -> (worker, game_dir) for games other lobby workers run
+
+    def dirs_in_use(self):
+        """Install directories of running and queued games; version pruning keeps these."""
+        return ({s["game_dir"] for s in self.sessions.values()} | {p[2] for p in self.pending}
+                | {d for _, d in self.remote.values()})
+
+    def is_active(self, room_name):
+        return (room_name in self.sessions or room_name in self.remote
+                or any(p[0] == room_name for p in self.pending))
+
+    def _announce(self, room_name, game_dir):
+        """Tell the other lobby workers a room's game is running or queued here (game_dir None: ended)."""
+        if bus:
+            bus.publish({"type": "session", "room_name": room_name, "game_dir": game_dir})
+
+    def announce_all(self):
+        for room_name, session in self.sessions.items():
+            self._announce(room_name, session["game_dir"])
+        for room_name, _, game_dir, _ in self.pending:
+            self._announce(room_name, game_dir)
+
+    def remote_update(self, worker, room_name, game_dir):
+        if game_dir is None:
+            self.remote.pop(room_name, None)
+        else:
+            self.remote[room_name] = (worker, game_dir)
+
+    def remote_worker_down(self, worker):
+        self.remote = {r: v for r, v in self.remote.items() if v[0] != worker}
+
+    async def request_start(self, room_name, game_id, game_dir, server_entry):
+        """Launch now and return ("started", port), or ("queued", position)."""
+        port = None
+        if len(self.sessions) < self.max_sessions:
+            port = port_pool.acquire(room_name)
+        if port is None:
+            self.pending.append((room_name, game_id, game_dir, server_entry))
+            self._announce(room_name, game_dir)
+            print(f"[SYSTEM] Room '{room_name}' queued for a game server (position {len(self.pending)}).")
+            return "queued", len(self.pending)
+        await self._launch(room_name, game_id, game_dir, server_entry, port)
+        return "started", port
+
+    async def _launch(self, room_name, game_id, game_dir, server_entry, port):
+        # Reserve the slot before awaiting so concurrent starts see it
+        session = {"game_id": game_id, "game_dir": game_dir, "port": port, "proc": None, "started": time.time()}
+        self.sessions[room_name] = session
+        self._announce(room_name, game_dir)
+        limits = {"cpu_limit": GAME_CPU_LIMIT, "mem_limit": GAME_MEMORY_LIMIT_MB * 1024 * 1024}
+        print(f"[SYSTEM] Launching Game Server for room '{room_name}' ({game_id}) on port {port}...")
+        try:
+            # Hand the room to a pre-warmed worker; the game reads its port from GAME_PORT
+            t_launch = time.perf_counter()
+            proc, warm = await worker_pool.launch(game_dir, server_entry, port, limits)
+            elapsed = time.perf_counter() - t_launch
+            game_launch_seconds.observe(elapsed, "warm" if warm else "cold")
+            print(f"[SYSTEM] Game server for '{room_name}' listening after "
+                  f"{elapsed * 1000:.0f} ms ({'warm' if warm else 'cold'}).")
+        except Exception:
+            del self.sessions[room_name]
+            port_pool.release(port)
+            self._announce(room_name, None)
+            raise
+        session["proc"] = proc
+        spawn_background(self._watch(room_name, proc, port))
+
+    async def _watch(self, room_name, proc, port):
+        try:
+            code = await asyncio.wait_for(proc.wait(), GAME_MAX_WALL_TIME)
+        except asyncio.TimeoutError:
+            print(f"[SYSTEM] Game in room '{room_name}' hit the {GAME_MAX_WALL_TIME}s limit, stopping it.")
+            proc.kill()
+            code = await proc.wait()
+        self.sessions.pop(room_name, None)
+        port_pool.release(port)
+        self._announce(room_name, None)
+        print(f"[SYSTEM] Game server for room '{room_name}' exited ({code}), port {port} released.")
+        await self._start_pending()
+
+    async def _start_pending(self):
+        while self.pending and len(self.sessions) < self.max_sessions:
+            room_name, game_id, game_dir, server_entry = self.pending.popleft()
+            room_resp = await db_call({"cmd": "get_room_info", "room_name": room_name})
+            if room_resp.get("status") != "ok":
+                self._announce(room_name, None)
+                continue  # Room was closed while waiting
+            port = port_pool.acquire(room_name)
+            if port is None:
+                self.pending.appendleft((room_name, game_id, game_dir, server_entry))
+                return
+            try:
+                await self._launch(room_name, game_id, game_dir, server_entry, port)
+            except Exception as e:
+                print(f"[ERROR] Failed to launch queued game for '{room_name}': {e}")
+                continue
+            players = room_resp["room_info"].get("members", [])
+            broadcast_game_start(room_name, game_id, port, players)
+
+    def usage(self):
+        rows = []
+        now = time.time()
+        for room_name, session in self.sessions.items():
+            proc = session["proc"]
+            cpu, rss = read_proc_usage(proc.pid) if proc else (None, None)
+            rows.append({
+                "room": room_name,
+                "game_id": session["game_id"],
+                "port": session["port"],
+                "pid": proc.pid if proc else None,
+                "uptime": now - session["started"],
+                "cpu": cpu,
+                "rss_kb": rss,
+            })
+        return rows
+
+
+supervisor = GameSupervisor(GAME_MAX_SESSIONS)
+
+
+class FrameCodec:
+    """Compresses frames for one connection with "zstd" or "zlib"."""
+
+    def __init__(self, name):
+        self.name = name
+        if name == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=3)
+            self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        if self.name == "zstd":
+            return self._compressor.compress(data)
+        return zlib.compress(data, 6)
+
+    def decompress(self, data):
+        # Bounded like an uncompressed frame, so a small frame cannot inflate without limit
+        if self.name == "zstd":
+            if zstandard.frame_content_size(data) > MAX_FRAME_SIZE:
+                raise ValueError("Decompressed frame too large")
+            return self._decompressor.decompress(data, max_output_size=MAX_FRAME_SIZE)
+        d = zlib.decompressobj()
+        out = d.decompress(data, MAX_FRAME_SIZE)
+        if d.unconsumed_tail:
+            raise ValueError("Decompressed frame too large")
+        return out
+
+
+def negotiate_codec(offered):
+    """Pick the first codec the client offers that this server allows, or None."""
+    available = [c for c in FRAME_COMPRESSION if c != "zstd" or zstandard is not None]
+    for name in offered or []:
+        if name in available:
+            return FrameCodec(name)
+    return None
+
+
+def spawn_background(coro):
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def read_frame(reader, codec=None):
+    """Return the next length-prefixed frame payload, or None on a clean close.
+
+    asyncio's StreamReader buffers whatever arrives past the current frame,
+    so coalesced frames and raw file data after a header are never lost.
+    Compressed frames are inflated with `codec`.
+    """
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionResetError("Connection closed mid-frame")
+    length = struct.unpack("!I", header)[0]
+    compressed = length & COMPRESSED_FLAG
+    length &= ~COMPRESSED_FLAG
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large: {length}")
+    if compressed and codec is None:
+        raise ValueError("Compressed frame on a connection without compression")
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("Connection closed mid-frame")
+    return codec.decompress(payload) if compressed else payload
+
+
+def pack_frame(payload, codec=None):
+    """Length-prefixed frame for a JSON payload, compressed with `codec` when that makes it smaller."""
+    frame_bytes["raw"] += len(payload)
+    if codec and len(payload) >= COMPRESSION_MIN_SIZE:
+        packed = codec.compress(payload)
+        if len(packed) < len(payload):
+            frame_bytes["wire"] += len(packed)
+            return struct.pack("!I", len(packed) | COMPRESSED_FLAG) + packed
+    frame_bytes["wire"] += len(payload)
+    return struct.pack("!I", len(payload)) + payload
+
+
+async def send_frame(writer, obj):
+    writer.write(pack_frame(json.dumps(obj).encode(), connection_codecs.get(writer)))
+    await writer.drain()
+
+
+class Outbox:
+    """Outbound queue of one listener connection, written by its own task.
+
+    Broadcasts only append here, so a slow or dead client never delays the
+    command that triggered the broadcast or the other recipients. A client
+    more than OUTBOX_MAX_FRAMES frames or OUTBOX_MAX_BYTES bytes behind is
+    disconnected instead of having messages dropped: room events are deltas,
+    and a client without a listener falls back to querying the lobby.
+    """
+
+    def __init__(self, writer, name):
+        self.writer = writer
+        self.name = name
+        self.closed = False
+        self._frames = deque()
+        self._bytes = 0
+        self._wakeup = asyncio.Event()
+        self._task = spawn_background(self._run())
+
+    def put(self, payload):
+        """Queue an encoded JSON message. Never blocks."""
+        global slow_listeners_dropped
+        if self.closed:
+            return
+        frame = pack_frame(payload, connection_codecs.get(self.writer))
+        if len(self._frames) >= OUTBOX_MAX_FRAMES or self._bytes + len(frame) > OUTBOX_MAX_BYTES:
+            print(f"[WARNING] {self.name} is not reading its messages, disconnecting it.")
+            slow_listeners_dropped += 1
+            self.close()
+            return
+        self._frames.append(frame)
+        self._bytes += len(frame)
+        self._wakeup.set()
+
+    def pending(self):
+        return len(self._frames)
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._frames:
+                    frame = self._frames.popleft()
+                    self._bytes -= len(frame)
+                    self.writer.write(frame)
+                await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            print(f"[ERROR] {self.name} send failed: {e}")
+            self.close()
+
+    def close(self):
+        """Stop sending and close the connection; the listener's read loop then ends."""
+        if self.closed:
+            return
+        self.closed = True
+        self._frames.clear()
+        self._bytes = 0
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        self.writer.close()
+
+
+async def data_drain(writer):
+    """drain() for a data connection: raises asyncio.TimeoutError once the
+    client has taken nothing for DATA_IDLE_TIMEOUT seconds (e.g. a half-open link)."""
+    await asyncio.wait_for(writer.drain(), DATA_IDLE_TIMEOUT)
+
+
+async def send_file(writer, path, offset=0, count=None):
+    """Stream `count` bytes of a file from `offset` (default: to EOF) to the client.
+
+    Uses zero-copy sendfile when possible and falls back to DOWNLOAD_CHUNK_SIZE
+    buffered reads when sendfile is disabled or the transport does not support
+    it (e.g. on Windows' proactor loop). Either way the file goes out in
+    DOWNLOAD_CHUNK_SIZE pieces that must each be sent within DATA_IDLE_TIMEOUT.
+    Returns the number of bytes sent.
+    """
+    global sendfile_available
+    if count == 0:
+        return 0
+    await data_drain(writer)
+    sent = 0
+    with open(path, 'rb') as f:
+        if sendfile_available:
+            loop = asyncio.get_running_loop()
+            try:
+                while count is None or sent < count:
+                    size = DOWNLOAD_CHUNK_SIZE if count is None else min(DOWNLOAD_CHUNK_SIZE, count - sent)
+                    n = await asyncio.wait_for(loop.sendfile(writer.transport, f, offset + sent, size,
+                                                             fallback=False), DATA_IDLE_TIMEOUT)
+                    sent += n
+                    if n < size:
+                        break
+                return sent
+            except (NotImplementedError, asyncio.SendfileNotAvailableError):
+                sendfile_available = False
+        f.seek(offset + sent)
+        while count is None or sent < count:
+            size = DOWNLOAD_CHUNK_SIZE if count is None else min(DOWNLOAD_CHUNK_SIZE, count - sent)
+            data = await run_blocking(f.read, size)
+            if not data:
+                break
+            writer.write(data)
+            await data_drain(writer)
+            sent += len(data)
+        return sent
+
+
+async def send_bytes(writer, data, offset=0, count=None):
+    """Stream part of an in-memory artifact to the client. Returns the number of bytes sent."""
+    view = memoryview(data)[offset:None if count is None else offset + count]
+    for start in range(0, len(view), DOWNLOAD_CHUNK_SIZE):
+        writer.write(view[start:start + DOWNLOAD_CHUNK_SIZE])
+        await data_drain(writer)
+    return len(view)
+
+
+async def send_artifact(writer, key, sha, path, size, offset, count):
+    """Send part of a game artifact: zero-copy from disk when sendfile works,
+    otherwise from the hot artifact cache so concurrent downloads share one
+    read instead of each reading the file in chunks."""
+    if not sendfile_available:
+        data = await hot_artifacts.get(key, sha, path, size)
+        if data is not None:
+            sent = await send_bytes(writer, data, offset, count)
+            hot_artifacts.bytes_served += sent
+            return sent
+    return await send_file(writer, path, offset, count)
+
+
+def issue_ticket(**transfer):
+    """Register a transfer for the data port; returns the token, valid once for DATA_TICKET_TTL seconds."""
+    token = secrets.token_urlsafe(24)
+    data_tickets[token] = transfer
+    asyncio.get_running_loop().call_later(DATA_TICKET_TTL, data_tickets.pop, token, None)
+    return token
+
+
+def broadcast_game_start(room_name, game_id, game_port, players):
+    game_start_msg = {
+        "type": "start_game",
+        "game_host": GAME_HOST,
+        "game_port": game_port,
+        "room_name": room_name,
+        "game_id": game_id,
+        "players": players,
+    }
+
+    notify_listeners(players, game_start_msg)
+
+
+def notify_listeners(users, msg):
+    """Queue a message on the listener connection of each user that has one.
+
+    Encodes once and only enqueues, so the cost is O(recipients) and nothing
+    waits for any client to read.
+    """
+    elsewhere = notify_listeners_local(users, msg)
+    # Their listener may be connected to another lobby worker
+    if bus and elsewhere:
+        bus.publish({"type": "notify", "users": elsewhere, "msg": msg})
+
+
+def notify_listeners_local(users, msg):
+    """notify_listeners() for listeners on this process. Returns the users without one here."""
+    payload = json.dumps(msg).encode()
+    elsewhere = []
+    for user in users:
+        outbox = client_connections.get(f"{user}_listener")
+        if outbox:
+            outbox.put(payload)
+        else:
+            elsewhere.append(user)
+    return elsewhere
+
+
+def invalidate_game(game_id, files_changed=False):
+    """Drop cached store data for a game after a write, in every lobby worker.
+    files_changed: the game was installed or deleted, so other workers also
+    re-read its manifest."""
+    store_cache.invalidate(game_id)
+    if files_changed:
+        hot_artifacts.invalidate(game_id)
+    if bus:
+        bus.publish({"type": "invalidate", "game_id": game_id, "files_changed": files_changed})
+
+
+def push_room_state(user, room_name, room_info):
+    """Send a user the full state of their room (room_name None: not in a room)."""
+    notify_listeners([user], {"type": "room_update", "event": "room_state",
+                              "room_name": room_name, "room_info": room_info})
+
+
+def push_room_event(room_info, event, room_name, exclude=None, **fields):
+    """Send a room change (member_joined, member_left, host_changed, ready_changed) to its members."""
+    members = [m for m in (room_info or {}).get("members", []) if m != exclude]
+    notify_listeners(members, {"type": "room_update", "event": event, "room_name": room_name, **fields})
+
+
+def publish_join(user, room_name, room_info):
+    push_room_event(room_info, "member_joined", room_name, exclude=user, user=user)
+    push_room_state(user, room_name, room_info)
+
+
+async def leave_room(user):
+    """Remove a user from their room in the DB and tell the remaining members."""
+    resp = await db_call({"cmd": "leave_room", "user": user})
+    if resp.get("status") == "ok" and resp.get("room_name"):
+        room_name = resp["room_name"]
+        room_info = resp.get("room_info")
+        push_room_event(room_info, "member_left", room_name, user=user)
+        if resp.get("host_changed"):
+            push_room_event(room_info, "host_changed", room_name, host=room_info["host"])
+        push_room_state(user, None, None)
+    return resp
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average and bursts of up to `burst`."""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self):
+        """Spend a token. Returns 0 if one was available, else seconds until one is."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ServerBusy(Exception):
+    """A global cap is reached; the command is refused instead of queued."""
+
+
+def rate_check(buckets, cmd_class):
+    """Charge a command to its session's bucket for the class. Returns 0 or the retry delay."""
+    limit = RATE_LIMITS.get(cmd_class)
+    if limit is None:
+        return 0
+    bucket = buckets.get(cmd_class)
+    if bucket is None:
+        bucket = buckets[cmd_class] = TokenBucket(*limit)
+    return bucket.take()
+
+
+def throttled(reason, retry_after):
+    """Response for a refused command; clients may retry after `retry_after` seconds."""
+    throttled_requests[reason] += 1
+    text = "Too many requests" if reason == "rate" else "Server is busy"
+    return {"status": "error", "throttled": True, "retry_after": round(retry_after, 2),
+            "msg": f"{text}, please retry in {retry_after:.1f}s."}
+
+
+async def db_call(req_dict):
+    """Run a blocking db_request on the DB executor without stalling the event loop.
+
+    Query commands may hold at most QUERY_DB_SLOTS of the pool's connections.
+    A burst waits up to QUERY_DB_WAIT for one, a sustained flood then fails
+    with ServerBusy, and logins and room changes never queue behind either."""
+    loop = asyncio.get_running_loop()
+    if command_class.get() != "query":
+        return await loop.run_in_executor(db_executor, db_request, req_dict)
+    try:
+        await asyncio.wait_for(query_db_slots.acquire(), QUERY_DB_WAIT)
+    except asyncio.TimeoutError:
+        raise ServerBusy()
+    in_flight["query"] += 1
+    try:
+        return await loop.run_in_executor(db_executor, db_request, req_dict)
+    finally:
+        in_flight["query"] -= 1
+        query_db_slots.release()
+
+
+async def run_blocking(func, *args):
+    """Run blocking file/zip work on the default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+async def run_ingest(func, *args):
+    """Run upload processing on the ingest executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ingest_executor, func, *args)
+
+
+class StoreCache:
+    """LRU + TTL read-through cache for store metadata served by db_server.
+
+    Keys are "catalog" for the full store list and ("details", game_id) for
+    get_game_details. Only successful DB responses are cached, and concurrent
+    misses on the same key share a single DB request. Only used from the event
+    loop thread, so no lock is needed.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, response)
+        self._inflight = {}            # key -> Future for a load in progress
+        self._generation = 0           # Bumped on invalidation; stale loads are not stored
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, req_dict):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        generation = self._generation
+        try:
+            resp = await db_call(req_dict)
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # Mark retrieved when nobody else was waiting
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        fut.set_result(resp)
+
+        if resp.get("status") == "ok" and generation == self._generation:
+            self._entries[key] = (time.monotonic() + self.ttl, resp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return resp
+
+    def invalidate(self, game_id):
+        """Drop the catalog and one game's details after a write to that game."""
+        self._generation += 1
+        self._entries.pop("catalog", None)
+        self._entries.pop(("details", game_id), None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": ratio,
+                "entries": len(self._entries)}
+
+
+store_cache = StoreCache(STORE_CACHE_SIZE, STORE_CACHE_TTL)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class HotArtifactCache:
+    """Size-bounded LRU of downloaded artifacts held in memory.
+
+    Keys are (game_id, version) for a game's zip and (game_id, version, path)
+    for single files sent by download_files. Each entry remembers the sha256
+    it was loaded for, so a game deleted and uploaded again under the same
+    version is never served stale. Concurrent misses on the same key share one
+    read, and every download of a cached artifact is served from the same
+    buffer. Files over max_item bytes are not cached. Event loop thread only.
+    """
+
+    def __init__(self, max_bytes, max_item):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self._entries = OrderedDict()  # key -> (sha256, bytes)
+        self._inflight = {}            # key -> (sha256, Future) for a read in progress
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+
+    async def get(self, key, sha, path, size):
+        """Contents of the artifact, or None when it should be streamed from disk."""
+        if size > min(self.max_item, self.max_bytes):
+            return None
+        entry = self._entries.get(key)
+        if entry and entry[0] == sha:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+        pending = self._inflight.get(key)
+        if pending and pending[0] == sha:
+            return await asyncio.shield(pending[1])
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (sha, fut)
+        try:
+            data = await run_blocking(read_file, path)
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # Mark retrieved when nobody else was waiting
+            raise
+        finally:
+            if self._inflight.get(key, (None, None))[1] is fut:
+                del self._inflight[key]
+        fut.set_result(data)
+
+        self._remove(key)
+        self._entries[key] = (sha, data)
+        self.used += len(data)
+        while self.used > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        return data
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.used -= len(entry[1])
+
+    def invalidate(self, game_id):
+        """Free every cached artifact of a deleted game."""
+        for key in [k for k in self._entries if k[0] == game_id]:
+            self._remove(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": ratio,
+                "entries": len(self._entries), "bytes": self.used, "served": self.bytes_served}
+
+
+hot_artifacts = HotArtifactCache(HOT_CACHE_SIZE_MB * 1024 * 1024, HOT_CACHE_MAX_ITEM_MB * 1024 * 1024)
+
+
+async def get_store_list():
+    return await store_cache.get("catalog", {"cmd": "get_store_list"})
+
+
+async def find_store_game(game_id):
+    """Store entry for game_id from the cached catalog, or None."""
+    games = (await get_store_list()).get("games", [])
+    return next((g for g in games if g["game_id"] == game_id), None)
+
+
+async def get_game_details(game_id):
+    return await store_cache.get(("details", game_id),
+                                 {"cmd": "get_game_details", "game_id": game_id})
+
+
+def read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def artifact_sha256(path, known=None):
+    """Checksum of a stored game zip; computed once for entries that predate checksums."""
+    if known:
+        return known
+    mtime = os.path.getmtime(path)
+    cached = artifact_checksums.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    digest = file_sha256(path)
+    artifact_checksums[path] = (mtime, digest)
+    return digest
+
+
+def incoming_part(file_name, file_size, checksum):
+    """Return (part path, bytes already received) for an upload.
+
+    Uploads that name their sha256 are kept under INCOMING_DIR by checksum, so
+    the same client retrying after a dropped connection resumes where it left
+    off. Uploads without a checksum always start from zero.
+    """
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    if not checksum:
+        return os.path.join(INCOMING_DIR, f"{file_name}.part"), 0
+    path = os.path.join(INCOMING_DIR, f"{checksum}.part")
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    if offset > file_size:
+        os.remove(path)
+        offset = 0
+    return path, offset
+
+
+def hash_prefix(path, length):
+    """sha256 object fed with the first `length` bytes of a file (a resumed upload's earlier part)."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while length > 0:
+            block = f.read(min(1024 * 1024, length))
+            if not block:
+                break
+            h.update(block)
+            length -= len(block)
+    return h
+
+
+def write_and_hash(f, hasher, data):
+    # hashlib releases the GIL on large buffers, so this overlaps with the event loop
+    hasher.update(data)
+    f.write(data)
+
+
+async def receive_upload(reader, part_path, offset, file_size):
+    """Stream an upload from `offset` into its .part file, hashing as it arrives.
+
+    Returns (bytes received, sha256 hex digest, error). On an early rejection
+    the rest of the upload is read and discarded so the connection stays in
+    sync, and the .part file is removed. A client that sends nothing for
+    DATA_IDLE_TIMEOUT seconds is treated like one that disconnected: what
+    arrived is kept for a resume.
+    """
+    hasher = await run_ingest(hash_prefix, part_path, offset) if offset else hashlib.sha256()
+    received = offset
+    error = None
+    buf = bytearray()
+    with open(part_path, 'r+b' if offset else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        while received < file_size:
+            # Calculate remaining size to avoid over-reading
+            try:
+                data_chunk = await asyncio.wait_for(reader.read(min(65536, file_size - received)),
+                                                    DATA_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            if not data_chunk:
+                break
+            received += len(data_chunk)
+            if error:
+                continue
+            buf += data_chunk
+            if offset == 0 and received - len(data_chunk) < len(ZIP_MAGIC) <= received:
+                if bytes(buf[:len(ZIP_MAGIC)]) != ZIP_MAGIC:
+                    error = "Invalid Game: upload is not a zip file."
+                    buf.clear()
+                    continue
+            if len(buf) >= UPLOAD_BUFFER_SIZE:
+                await run_ingest(write_and_hash, f, hasher, bytes(buf))
+                buf.clear()
+        if buf:
+            await run_ingest(write_and_hash, f, hasher, bytes(buf))
+    if error:
+        await run_ingest(os.remove, part_path)
+    return received, hasher.hexdigest(), error
+
+
+def prune_incoming():
+    """Delete partial uploads older than INCOMING_MAX_AGE. Returns how many were removed."""
+    if not os.path.isdir(INCOMING_DIR):
+        return 0
+    removed = 0
+    cutoff = time.time() - INCOMING_MAX_AGE
+    for name in os.listdir(INCOMING_DIR):
+        path = os.path.join(INCOMING_DIR, name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def load_file_index(game_id, version):
+    """{path: {"sha256", "size"}} of an installed version. Blocking."""
+    tree = artifacts.get_tree(game_id, version)
+    if tree is None:
+        tree = index_install(game_id, version, install_dir(game_id))
+    return tree["files"]
+
+
+def artifact_file(game_info):
+    """Path of a store entry's zip: its blob, or the raw zip kept by older uploads."""
+    checksum = game_info.get("sha256")
+    if checksum and artifacts.has_blob(checksum):
+        return artifacts.blob_path(checksum)
+    return os.path.join("games_repo", game_info.get("file_name") or "")
+
+
+def validate_manifest(manifest):
+    """Return an error message for a malformed manifest, or None if it is usable."""
+    if not isinstance(manifest, dict):
+        return "Manifest is not a JSON object"
+    game_id = manifest.get("game_id")
+    if not game_id or not isinstance(game_id, str):
+        return "Manifest missing 'game_id'"
+    if game_id.startswith(".") or "/" in game_id or "\\" in game_id:
+        return f"Invalid game_id '{game_id}'"
+    version = manifest.get("version", "0.0.0")
+    if not isinstance(version, str) or not re.fullmatch(r"[\w+-][\w.+-]*", version):
+        return "Manifest 'version' must be a string like 1.0.0"
+    min_players = manifest.get("min_players", 2)
+    max_players = manifest.get("max_players", min_players)
+    if not isinstance(min_players, int) or not isinstance(max_players, int):
+        return "Manifest player counts must be integers"
+    if min_players < 1 or max_players < min_players:
+        return f"Invalid player range {min_players}-{max_players}"
+    return None
+
+
+def game_root(game_id):
+    return os.path.join("games_repo", game_id)
+
+
+def version_dir(game_id, version):
+    return os.path.join("games_repo", game_id, version)
+
+
+def current_version(game_id):
+    """Active version named by games_repo/<game_id>/.current, or None for a flat older install."""
+    try:
+        with open(os.path.join(game_root(game_id), CURRENT_POINTER), 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def install_dir(game_id):
+    version = current_version(game_id)
+    return version_dir(game_id, version) if version else game_root(game_id)
+
+
+class ManifestRegistry:
+    """Parsed, validated manifest.json of every installed game, keyed by game_id.
+
+    Each game's active version lives in games_repo/<game_id>/<version>/, named
+    by the .current pointer. Manifests are read once (load_all at startup,
+    refresh after an install or delete) and each game's entry is replaced with
+    a single dict assignment, so readers on the event loop and installs on
+    executor threads never see a half-updated entry. get() also re-reads an
+    entry whose pointer or manifest mtime changed, to pick up edits made by
+    hand on the server.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._entries = {}  # game_id -> (stamp, manifest or None, error or None, install dir)
+
+    def _stamp(self, game_id, game_dir):
+        """mtimes of the .current pointer and the manifest; None if there is no manifest."""
+        try:
+            manifest_mtime = os.stat(os.path.join(game_dir, "manifest.json")).st_mtime_ns
+        except OSError:
+            return None
+        try:
+            pointer_mtime = os.stat(os.path.join(self.root, game_id, CURRENT_POINTER)).st_mtime_ns
+        except OSError:
+            pointer_mtime = None
+        return (pointer_mtime, manifest_mtime)
+
+    def _load(self, game_id):
+        version = current_version(game_id)
+        game_dir = install_dir(game_id)
+        stamp = self._stamp(game_id, game_dir)
+        if stamp is None:
+            return None
+        try:
+            manifest = read_json(os.path.join(game_dir, "manifest.json"))
+        except Exception as e:
+            return (stamp, None, f"Bad manifest: {e}", game_dir)
+        error = validate_manifest(manifest)
+        if not error and manifest["game_id"] != game_id:
+            error = f"Manifest game_id '{manifest['game_id']}' does not match directory '{game_id}'"
+        if not error and version and manifest.get("version", "0.0.0") != version:
+            error = f"Manifest version does not match installed version {version}"
+        if not error:
+            entry = manifest.get("server_entry")
+            if not entry:
+                error = "Invalid game manifest (no server_entry)."
+            elif not os.path.isfile(os.path.join(game_dir, entry)):
+                error = f"Server entry '{entry}' missing on server."
+        if error:
+            return (stamp, None, error, game_dir)
+        return (stamp, manifest, None, game_dir)
+
+    def refresh(self, game_id):
+        entry = self._load(game_id)
+        if entry is None:
+            self._entries.pop(game_id, None)
+        else:
+            self._entries[game_id] = entry
+
+    def load_all(self):
+        """Blocking; call through run_blocking(). Returns the number of valid games."""
+        entries = {}
+        if os.path.isdir(self.root):
+            for game_id in os.listdir(self.root):
+                if game_id.startswith("."):
+                    continue  # Store internals (.blobs, .trees, .incoming, staging dirs)
+                entry = self._load(game_id)
+                if entry is not None:
+                    entries[game_id] = entry
+        self._entries = entries
+        return sum(1 for e in entries.values() if e[1] is not None)
+
+    def _current(self, game_id):
+        entry = self._entries.get(game_id)
+        if entry is not None and self._stamp(game_id, entry[3]) != entry[0]:
+            self.refresh(game_id)
+            entry = self._entries.get(game_id)
+        return entry
+
+    def get(self, game_id):
+        """Return (manifest, error). Both are None if the game is not installed."""
+        entry = self._current(game_id)
+        if entry is None:
+            return None, None
+        return entry[1], entry[2]
+
+    def game_dir(self, game_id):
+        """Directory of the active version, as of the last get()."""
+        entry = self._entries.get(game_id)
+        return entry[3] if entry else None
+
+    def installed(self):
+        """{game_id: manifest} of every valid installed game."""
+        return {gid: e[1] for gid, e in self._entries.items() if e[1] is not None}
+
+    def version(self, game_id):
+        manifest, _ = self.get(game_id)
+        return manifest.get("version", "0.0.0") if manifest else None
+
+
+manifest_registry = ManifestRegistry("games_repo")
+
+
+def zip_member_path(name):
+    """Normalized path of a zip member, or None if it would land outside the game directory."""
+    parts = name.split("/")
+    if name.startswith("/") or "\\" in name or ".." in parts or ":" in parts[0]:
+        return None
+    return "/".join(p for p in parts if p not in ("", "."))
+
+
+def write_current_pointer(root, version):
+    pointer = os.path.join(root, CURRENT_POINTER)
+    with open(pointer + ".tmp", 'w') as f:
+        f.write(version)
+    os.replace(pointer + ".tmp", pointer)
+
+
+def activate_version(game_id, version, tree):
+    """Install a version next to the existing ones, then make it current.
+
+    The version directory is built under a temporary name and renamed into
+    place, and the .current pointer is swapped with os.replace, so start_game
+    only ever sees a complete install of either the old or the new version.
+    """
+    target = version_dir(game_id, version)
+    if not os.path.isdir(target):
+        os.makedirs(game_root(game_id), exist_ok=True)
+        staging_dir = os.path.join(game_root(game_id), f".{version}.new")
+        remove_dir(staging_dir)
+        artifacts.materialize(tree, staging_dir)
+        os.rename(staging_dir, target)
+    write_current_pointer(game_root(game_id), version)
+
+
+def prune_versions(game_id, in_use):
+    """Delete versions beyond the newest GAME_RETAIN_VERSIONS. The current
+    version and versions in `in_use` (install dirs of running or queued games)
+    are always kept. Blocking. Returns the removed versions.
+    """
+    current = current_version(game_id)
+    if current is None:
+        return []
+    versions = artifacts.versions(game_id)
+    keep = set(versions[-GAME_RETAIN_VERSIONS:]) | {current}
+    removed = []
+    for version in versions:
+        if version in keep or version_dir(game_id, version) in in_use:
+            continue
+        remove_dir(version_dir(game_id, version))
+        artifacts.remove_tree(game_id, version)
+        removed.append(version)
+    return removed
+
+
+def install_game_zip(upload_path, checksum):
+    """Store an uploaded zip and each file in it in the artifact store, then
+    install that version at games_repo/<game_id>/<version> and activate it.
+
+    Files already stored (unchanged across versions or shared with other
+    games) are not written again. Blocking; call through run_ingest().
+    Returns (manifest, error message).
+    """
+    with artifacts.staging() as pinned:
+        artifacts.put_file(upload_path, checksum, pinned)
+
+        # Read zip content without extracting first
+        with zipfile.ZipFile(artifacts.blob_path(checksum), 'r') as zip_ref:
+            # Find manifest.json
+            if "manifest.json" not in zip_ref.namelist():
+                return None, "Invalid Game: No manifest.json found."
+
+            with zip_ref.open("manifest.json") as mf:
+                manifest = json.load(mf)
+
+            error = validate_manifest(manifest)
+            if error:
+                return None, f"Invalid Game: {error}"
+            game_id = manifest["game_id"]
+            new_version = manifest.get("version", "0.0.0")
+
+            # 1. Look up the installed version (a broken old manifest is simply overwritten)
+            old_version = manifest_registry.version(game_id)
+            if old_version is not None:
+                # 2. Compare versions: If new <= old, reject upload
+                # (the stored zip is unreferenced and removed by the next GC)
+                if new_version <= old_version:
+                    msg = f"Upload rejected: Version {new_version} is not greater than server version {old_version}."
+                    print(f"[SYSTEM] {msg}")
+                    return None, msg
+
+            # 3. Check every entry in the central directory before extracting anything
+            members = []
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                rel = zip_member_path(info.filename)
+                if not rel:
+                    return None, f"Invalid Game: unsafe path '{info.filename}' in zip."
+                members.append((rel, info))
+            total_size = sum(info.file_size for _, info in members)
+            if total_size > MAX_GAME_INSTALL_SIZE:
+                return None, f"Invalid Game: extracts to {total_size} bytes (limit {MAX_GAME_INSTALL_SIZE})."
+
+            # 4. Store every file as a blob
+            files = {}
+            for rel, info in members:
+                with zip_ref.open(info) as src:
+                    sha, size, _ = artifacts.put_stream(src, pinned)
+                files[rel] = {"sha256": sha, "size": size}
+
+        # --- [Critical] Install to games_repo/{game_id}/{version} and activate it ---
+        tree = {"archive": checksum, "files": files}
+        artifacts.add_tree(game_id, new_version, tree)
+        activate_version(game_id, new_version, tree)
+    manifest_registry.refresh(game_id)
+
+    return manifest, None
+
+
+def index_install(game_id, version, game_dir):
+    """Store the files of an installed directory and record them as a version. Returns the tree."""
+    with artifacts.staging() as pinned:
+        files = {}
+        for root, _, names in os.walk(game_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    sha, size, _ = artifacts.put_stream(f, pinned)
+                files[os.path.relpath(path, game_dir).replace(os.sep, "/")] = {"sha256": sha, "size": size}
+        tree = {"archive": None, "files": files}
+        artifacts.add_tree(game_id, version, tree)
+    return tree
+
+
+def import_legacy_install(game_id, version):
+    """Convert a flat games_repo/<game_id> install from older releases to
+    games_repo/<game_id>/<version> plus the .current pointer.
+    """
+    tree = artifacts.get_tree(game_id, version) or index_install(game_id, version, game_root(game_id))
+    staging_dir = os.path.join("games_repo", f".{game_id}.new")
+    old_dir = os.path.join("games_repo", f".{game_id}.old")
+    remove_dir(staging_dir)
+    artifacts.materialize(tree, os.path.join(staging_dir, version))
+    write_current_pointer(staging_dir, version)
+    os.rename(game_root(game_id), old_dir)
+    os.rename(staging_dir, game_root(game_id))
+    remove_dir(old_dir)
+    manifest_registry.refresh(game_id)
+
+
+def load_artifacts():
+    """Rebuild blob reference counts and convert installs from older releases. Blocking."""
+    trees = artifacts.load()
+    imported = 0
+    for game_id, manifest in manifest_registry.installed().items():
+        if current_version(game_id) is None:
+            import_legacy_install(game_id, manifest.get("version", "0.0.0"))
+            imported += 1
+    remove_dir(os.path.join("games_repo", ".index"))  # Replaced by trees
+    return trees, imported
+
+
+async def artifact_gc_loop():
+    while True:
+        # Old versions whose last game session has ended can go now
+        in_use = supervisor.dirs_in_use()
+        for game_id in list(manifest_registry.installed()):
+            pruned = await run_blocking(prune_versions, game_id, in_use)
+            if pruned:
+                print(f"[SYSTEM] Pruned {game_id} versions: {', '.join(pruned)}")
+        removed, freed = await run_blocking(artifacts.collect)
+        if removed:
+            print(f"[SYSTEM] Artifact GC removed {removed} unreferenced blobs ({freed / 1024 / 1024:.1f} MiB).")
+        await asyncio.sleep(ARTIFACT_GC_INTERVAL)
+
+
+def remove_game_files(game_id, zip_path):
+    if os.path.exists(zip_path): os.remove(zip_path) # Raw zip kept by uploads from before the artifact store
+    remove_dir(game_root(game_id))
+    # Blobs no other game or version uses are freed by the next GC
+    artifacts.remove_game(game_id)
+    manifest_registry.refresh(game_id)
+
+
+async def receive_game_upload(reader, writer, addr, ticket):
+    """Data port side of upload_game: receive the zip, install it and reply with the result."""
+    file_name = ticket["file_name"]
+    file_size = ticket["file_size"]
+    checksum = ticket["checksum"]
+    part_path, offset = await run_blocking(incoming_part, file_name, file_size, checksum)
+    if part_path in active_uploads:
+        await send_frame(writer, {"status": "error", "msg": "This file is already being uploaded."})
+        return
+
+    # Tell Client ready to receive, and from which byte
+    await send_frame(writer, {"status": "ready", "offset": offset})
+    if offset:
+        print(f"[SYSTEM] Resuming upload of {file_name} from {addr} at byte {offset}")
+
+    # Receive File (appending to what an earlier attempt left behind)
+    active_uploads.add(part_path)
+    try:
+        received_size, actual, error = await receive_upload(reader, part_path, offset, file_size)
+    finally:
+        active_uploads.discard(part_path)
+    upload_bytes.inc(amount=received_size - offset)
+
+    if received_size < file_size:
+        print(f"[SYSTEM] Upload of {file_name} from {addr} interrupted at "
+              f"{received_size}/{file_size} bytes, kept for resume")
+        return
+    if error:
+        await send_frame(writer, {"status": "error", "msg": error})
+        return
+    if checksum and actual != checksum:
+        await run_ingest(os.remove, part_path)
+        await send_frame(writer, {"status": "error", "msg": "Checksum mismatch, upload discarded."})
+        return
+    print(f"[SYSTEM] Received {file_name} from {addr}")
+
+    # Validation and Registration (unzip to permanent dir)
+    try:
+        manifest, error = await run_ingest(install_game_zip, part_path, actual)
+        if error:
+            await send_frame(writer, {"status": "error", "msg": error})
+            return
+
+        # Add file info
+        manifest["file_name"] = file_name
+        manifest["file_size"] = file_size
+        manifest["sha256"] = actual
+        manifest["uploader"] = ticket["user"]
+
+        # Write to DB
+        db_resp = await db_call({
+            "cmd": "update_game_info",
+            "game_id": manifest["game_id"],
+            "info": manifest
+        })
+
+        if db_resp["status"] == "ok":
+            invalidate_game(manifest["game_id"], files_changed=True)
+            await run_blocking(prune_versions, manifest["game_id"], supervisor.dirs_in_use())
+            msg = f"Game '{manifest.get('name')}' v{manifest.get('version')} uploaded & installed."
+            await send_frame(writer, {"status": "ok", "msg": msg})
+        else:
+            await send_frame(writer, {"status": "error", "msg": "DB update failed"})
+
+    except Exception as e:
+        print(f"[ERROR] Upload process failed: {e}")
+        await send_frame(writer, {"status": "error", "msg": str(e)})
+
+
+async def handle_metrics(reader, writer):
+    """Minimal HTTP/1.0 endpoint: GET /metrics returns this process's metrics in
+    the Prometheus text format."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass  # Headers are not needed
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] in ("GET", "HEAD") and parts[1].split("?")[0] in ("/", "/metrics"):
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+            body = metrics.render().encode()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", b"Not found, try /metrics\n"
+        head = (f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode()
+        writer.write(head if parts[:1] == ["HEAD"] else head + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, OSError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
+
+
+async def reap_idle_connections():
+    """Every REAP_INTERVAL seconds, close all connections that have been silent
+    for SESSION_TIMEOUT seconds in one pass. Clients send heartbeats, so this
+    only catches dead or half-open peers; each closed connection's handler then
+    runs its normal cleanup (leave room, drop listener, mark offline)."""
+    global connections_reaped
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        cutoff = time.monotonic() - SESSION_TIMEOUT
+        expired = [w for w, seen in last_seen.items() if seen < cutoff]
+        for w in expired:
+            del last_seen[w]
+            w.transport.abort()
+        if expired:
+            connections_reaped += len(expired)
+            print(f"[SYSTEM] Closed {len(expired)} connections silent for over {SESSION_TIMEOUT}s.")
+
+
+async def matchmaker_loop():
+    """Every MATCH_INTERVAL seconds, have db_server group the whole matchmaking
+    queue into rooms in one request, then start each new room's game. A lobby
+    runs one matcher (worker 0 in multi-process mode), so every queued player
+    is in the same batch."""
+    while True:
+        await asyncio.sleep(MATCH_INTERVAL)
+        games = {}
+        for game_id, manifest in manifest_registry.installed().items():
+            min_players = manifest.get("min_players", 2)
+            games[game_id] = [min_players, manifest.get("max_players", min_players)]
+        try:
+            resp = await db_call({"cmd": "match_players", "games": games, "fill_wait": MATCH_FILL_WAIT})
+        except Exception as e:
+            print(f"[ERROR] Matchmaking failed: {e}")
+            continue
+        if resp.get("status") != "ok":
+            continue
+        matchmaking["queued"] = resp["queued"]
+        for user, game_id in resp["dropped"]:
+            notify_listeners([user], {"type": "matchmaking", "event": "cancelled",
+                                      "msg": f"Matchmaking cancelled, {game_id} is no longer available."})
+        for wait in resp["waits"]:
+            match_wait_seconds.observe(wait)
+        if resp["rooms"]:
+            match_waits.extend(resp["waits"])
+            matchmaking["matched"] += len(resp["waits"])
+            matchmaking["rooms"] += len(resp["rooms"])
+            print(f"[SYSTEM] Matchmaking formed {len(resp['rooms'])} rooms, {resp['queued']} players still queued.")
+        for room in resp["rooms"]:
+            spawn_background(start_match(room["room_name"], room["room_info"]))
+
+
+async def start_match(room_name, room_info):
+    """Put matched players in their new room and start its game like start_game does."""
+    members = room_info["members"]
+    game_id = room_info["game_id"]
+    for user in members:
+        push_room_state(user, room_name, room_info)
+    notify_listeners(members, {"type": "matchmaking", "event": "matched", "room_name": room_name,
+                               "msg": f"Match found: room {room_name} with {', '.join(members)}."})
+    manifest, error = manifest_registry.get(game_id)
+    if not manifest:
+        notify_listeners(members, {"type": "matchmaking", "event": "failed",
+                                   "msg": error or f"{game_id} is no longer available."})
+        return
+    try:
+        outcome, detail = await supervisor.request_start(room_name, game_id, manifest_registry.game_dir(game_id),
+                                                         manifest["server_entry"])
+    except Exception as e:
+        print(f"[ERROR] Failed to launch game server for '{room_name}': {e}")
+        notify_listeners(members, {"type": "matchmaking", "event": "failed",
+                                   "msg": "Failed to launch game server, the host can try Start game again."})
+        return
+    if outcome == "started":
+        broadcast_game_start(room_name, game_id, detail, members)
+    # "queued": the supervisor starts and broadcasts it once a slot frees up
+
+
+async def handle_data(reader, writer):
+    """Data port: a single file transfer per connection, authorized by a token
+    the client got on its control connection. Keeps bulk bytes off the control
+    connection so the client can go on sending commands meanwhile."""
+    addr = writer.get_extra_info("peername")
+    try:
+        data = await asyncio.wait_for(read_frame(reader), DATA_TICKET_TTL)
+        msg = json.loads(data.decode()) if data else None
+        token = msg.get("token") if isinstance(msg, dict) else None
+        ticket = data_tickets.pop(token, None) if isinstance(token, str) else None
+        if ticket is None:
+            await send_frame(writer, {"status": "error", "msg": "Invalid or expired transfer token"})
+        else:
+            in_flight["expensive"] += 1
+            try:
+                if ticket["kind"] == "upload":
+                    await receive_game_upload(reader, writer, addr, ticket)
+                else:
+                    await send_frame(writer, {"status": "ok"})
+                    print(f"[SYSTEM] Sending {ticket['label']} to {addr}...")
+                    async with transfer_slots:
+                        for entry in ticket["files"]:
+                            sent = await send_artifact(writer, *entry)
+                            download_bytes.inc(*entry[0][:2], amount=sent)  # key: (game_id, version[, path])
+                    print(f"[SYSTEM] Sent {ticket['label']} complete.")
+            finally:
+                in_flight["expensive"] -= 1
+    except asyncio.TimeoutError:
+        # Nothing moved (ticket never sent, or the client stopped reading); abort
+        # so close() does not wait on a write buffer that will never drain
+        print(f"[SYSTEM] Data connection {addr} timed out, closing.")
+        writer.transport.abort()
+    except Exception as e:
+        print(f"[ERROR] Data connection {addr}: {e}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info("peername")
     print(f"[CONNECTED] {addr}")
     current_user = None
     current_role = "player"
-    is_listener = False  # Flag to indicate if this is a listener thread connection
+    is_listener = False  # Flag to indicate if this is a listener connection
+    buckets = {}  # This session's token buckets: command class -> TokenBucket
+    last_seen[writer] = time.monotonic()
 
     while True:
+        started = None  # Set once a command is admitted, for the command metrics
         try:
-            # Use longer timeout for listener thread to avoid frequent timeouts
-            if is_listener:
-                conn.settimeout(30)  # 30 seconds for listener
-            else:
-                conn.settimeout(None)  # No timeout for main connection
-
-            data = conn.recv(1024).decode()
-            if not data:
+            data = await read_frame(reader, connection_codecs.get(writer))
+            if data is None:
                 break
+            last_seen[writer] = time.monotonic()
             # print(f"[DEBUG] Received from {addr}: {data}")
 
-
-            
-            # Parse only the first valid JSON object
+            # Frames are self-delimiting, so a bad payload only costs this message
             try:
-                msg = json.loads(data)
-            except json.JSONDecodeError as e:
+                msg = json.loads(data.decode())
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
                 print(f"[ERROR] {addr}: JSON parse failed - {e}")
                 print(f"[DEBUG] Received data: {data[:100]}")
                 if not is_listener:  # Only respond for non-listener connections
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "Invalid JSON format"}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "Invalid JSON format"})
                 continue
 
             cmd = msg.get("cmd")
 
+            # Keep-alive only; no reply, so it never interleaves with a command's response
+            if cmd == "heartbeat":
+                continue
+
+            # Admission control: refuse right away rather than queue behind the flood,
+            # then stop reading this session until it may retry, so a client that
+            # ignores retry_after is slowed down by TCP backpressure
+            cmd_class = COMMAND_CLASSES.get(cmd, "action")
+            command_class.set(cmd_class)
+            retry_after = rate_check(buckets, cmd_class)
+            if retry_after:
+                await send_frame(writer, throttled("rate", retry_after))
+                await asyncio.sleep(retry_after)
+                continue
+            if cmd_class == "expensive" and in_flight["expensive"] >= MAX_EXPENSIVE_COMMANDS:
+                await send_frame(writer, throttled("busy", 1.0))
+                await asyncio.sleep(1.0)
+                continue
+            if cmd != "_listener":  # A listener's command lasts as long as the connection
+                started = time.perf_counter()
+
             # Handle listener thread connection
             if cmd == "_listener":
                 # This connection is used to listen for game start notifications
                 username = msg.get("user")
                 is_listener = True  # Mark as listener
+                outbox = None
                 if username:
-                    with connection_lock:
-                        client_connections[f"{username}_listener"] = conn
-                    print(f"[SYSTEM] Listener thread connected for user {username}")
+                    outbox = client_connections[f"{username}_listener"] = Outbox(writer, f"Listener for {username}")
+                    print(f"[SYSTEM] Listener connected for user {username}")
+                    # Agree on a codec as login does. The reply is too small to be compressed
+                    # and is queued first, so the client applies it before any compressed push
+                    codec = negotiate_codec(msg.get("compression"))
+                    if codec:
+                        outbox.put(json.dumps({"type": "compression", "compression": codec.name}).encode())
+                        connection_codecs[writer] = codec
+                    # Start the client's room model from the current state; room_update events follow
+                    room_resp = await db_call({"cmd": "get_user_room", "user": username})
+                    room_name = room_resp.get("room_name")
+                    room_info = None
+                    if room_name:
+                        room_info = (await db_call({"cmd": "get_room_info", "room_name": room_name})).get("room_info")
+                    push_room_state(username, room_name, room_info)
                 
-                # Listener thread enters infinite listening loop
-                # Use blocking receive (no timeout) to wait for broadcasts
-                conn.settimeout(None)
+                # Listener connection stays open to receive broadcasts; the
+                # client only sends heartbeats and a post-game set_ready here
                 while True:
                     try:
-                        data = conn.recv(1024).decode()
-                        if not data:
+                        data = await read_frame(reader, connection_codecs.get(writer))
+                        if data is None:
                             # Connection closed
-                            print(f"[SYSTEM] Listener thread for {username} disconnected")
+                            print(f"[SYSTEM] Listener for {username} disconnected")
                             break
+                        last_seen[writer] = time.monotonic()
                         
                         try:
-                            l_msg = json.loads(data)
+                            l_msg = json.loads(data.decode())
                             if l_msg.get("cmd") == "set_ready":
                                 ready = l_msg.get("ready")
-                                db_request({"cmd": "set_ready", "user": username, "ready": ready})
+                                resp = await db_call({"cmd": "set_ready", "user": username, "ready": ready})
+                                if resp.get("status") == "ok":
+                                    push_room_event(resp.get("room_info"), "ready_changed",
+                                                    resp.get("room_name"), user=username, ready=ready)
                                 # No response needed to client here, listener only expects start_game
-                        except json.JSONDecodeError:
+                        except (UnicodeDecodeError, json.JSONDecodeError):
                             pass
                         
                     except (ConnectionResetError, OSError):
                         # Normal disconnection
-                        print(f"[SYSTEM] Listener thread for {username} disconnected (connection closed)")
+                        print(f"[SYSTEM] Listener for {username} disconnected (connection closed)")
                         break
                     except Exception as e:
-                        print(f"[WARNING] Listener thread exception: {e}")
+                        print(f"[WARNING] Listener exception: {e}")
                         break
                 # Listener loop ended, cleanup connection
+                if outbox:
+                    if client_connections.get(f"{username}_listener") is outbox:
+                        del client_connections[f"{username}_listener"]
+                    outbox.close()
                 break
 
             elif cmd == "register":
                 username = msg["username"]
                 password = msg["password"]
                 role = msg.get("role", "player")
-                resp = db_request(
+                resp = await db_call(
                     {"cmd": "create", "user": username, "password": password, "role": role}
                 )
                 if resp["status"] == "ok":
-                    conn.send(
-                        json.dumps({"status": "ok", "msg": "Register success"}).encode()
-                    )
+                    await send_frame(writer, {"status": "ok", "msg": "Register success"})
                     current_role = role
                 else:
-                    conn.send(
-                        json.dumps(
-                            {
-                                "status": "error",
-                                "msg": resp.get("msg", "Register failed"),
-                            }
-                        ).encode()
-                    )
+                    await send_frame(writer, {
+                        "status": "error",
+                        "msg": resp.get("msg", "Register failed"),
+                    })
 
             elif cmd == "login":
                 username = msg["username"]
                 password = msg["password"]
                 role = msg.get("role", "player")
-                resp = db_request({"cmd": "read", "user": username, "role": role})
+                resp = await db_call({"cmd": "read", "user": username, "role": role})
                 if resp["status"] == "error":
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "Login failed: user not found"}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "Login failed: user not found"})
                 elif resp.get("online", False):
-                    conn.send(
-                        json.dumps(
-                            {
-                                "status": "error",
-                                "msg": "Login failed: already logged in",
-                            }
-                        ).encode()
-                    )
+                    await send_frame(writer, {
+                        "status": "error",
+                        "msg": "Login failed: already logged in",
+                    })
                 elif resp["password"] != password:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "Login failed: wrong password"}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "Login failed: wrong password"})
                 else:
                     current_user = username
                     current_role = role
-                    db_request({"cmd": "set_online", "user": username, "online": True, "role": role})
+                    await db_call({"cmd": "set_online", "user": username, "online": True, "role": role})
                     # Record client connection
-                    with connection_lock:
-                        client_connections[username] = conn
-                    conn.send(
-                        json.dumps({"status": "ok", "msg": "Login success"}).encode()
-                    )
+                    client_connections[username] = writer
+                    # Frames after this reply may be compressed with the agreed codec
+                    codec = negotiate_codec(msg.get("compression"))
+                    await send_frame(writer, {"status": "ok", "msg": "Login success",
+                                              "compression": codec.name if codec else None})
+                    if codec:
+                        connection_codecs[writer] = codec
+                    else:
+                        connection_codecs.pop(writer, None)
 
             elif cmd == "logout":
                 if current_user:
-                    db_request({"cmd": "leave_room", "user": current_user})
-                    db_request({"cmd": "clear_invitations", "user": current_user})
-                    db_request({"cmd": "set_online", "user": current_user, "online": False, "role": current_role})
+                    await leave_room(current_user)
+                    await db_call({"cmd": "clear_invitations", "user": current_user})
+                    await db_call({"cmd": "set_online", "user": current_user, "online": False, "role": current_role})
                     # Remove client connection record
-                    with connection_lock:
-                        if current_user in client_connections:
-                            del client_connections[current_user]
+                    if current_user in client_connections:
+                        del client_connections[current_user]
                     current_user = None
-                    conn.send(
-                        json.dumps({"status": "ok", "msg": "Logout success"}).encode()
-                    )
+                    await send_frame(writer, {"status": "ok", "msg": "Logout success"})
                 else:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You are not logged in"}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You are not logged in"})
 
             elif cmd == "list":
                 online_only = msg.get("online_only", False)
-                resp = db_request({"cmd": "list", "online_only": online_only})
+                resp = await db_call({"cmd": "list", "online_only": online_only})
                 users = resp.get("users", [])
-                conn.send(
-                    json.dumps(
-                        {"status": "ok", "msg": "User list", "users": users}
-                    ).encode()
-                )
+                await send_frame(writer, {"status": "ok", "msg": "User list", "users": users})
 
             elif cmd == "create_room":
                 room_name = msg.get("room_name")
                 private = msg.get("private", False)
                 game_id = msg.get("game_id")
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
-                    resp = db_request(
+                    # The room holds as many players as the game allows (2 if it is not installed)
+                    manifest, _ = manifest_registry.get(game_id) if game_id else (None, None)
+                    max_players = 2
+                    if manifest:
+                        max_players = manifest.get("max_players", manifest.get("min_players", 2))
+                    resp = await db_call(
                         {
                             "cmd": "create_room",
                             "room_name": room_name,
                             "host": current_user,
                             "private": private,
                             "game_id": game_id,
+                            "max_players": max_players,
                         }
                     )
                     if resp["status"] == "ok":
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "status": "ok",
-                                    "msg": f"Room '{room_name}' created successfully.",
-                                }
-                            ).encode()
-                        )
+                        push_room_state(current_user, room_name, resp.get("room_info"))
+                        await send_frame(writer, {
+                            "status": "ok",
+                            "msg": f"Room '{room_name}' created successfully.",
+                        })
                     else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "status": "error",
-                                    "msg": f"Failed to create room: {resp.get('msg')}",
-                                }
-                            ).encode()
-                        )
+                        await send_frame(writer, {
+                            "status": "error",
+                            "msg": f"Failed to create room: {resp.get('msg')}",
+                        })
 
             elif cmd == "list_rooms":
-                resp = db_request({"cmd": "list_rooms"})
+                # Filters: game_id, open_only, free_slots; paging: offset, limit; sort: fullest/emptiest
+                try:
+                    offset = max(int(msg.get("offset", 0)), 0)
+                    limit = min(max(int(msg.get("limit") or ROOM_PAGE_SIZE), 1), ROOM_PAGE_MAX)
+                except (TypeError, ValueError):
+                    await send_frame(writer, {"status": "error", "msg": "offset and limit must be numbers."})
+                    continue
+                sort = msg.get("sort", "fullest")
+                if sort not in ("fullest", "emptiest"):
+                    await send_frame(writer, {"status": "error", "msg": "sort must be 'fullest' or 'emptiest'."})
+                    continue
+                resp = await db_call({"cmd": "list_rooms", "game_id": msg.get("game_id"),
+                                      "open_only": bool(msg.get("open_only")),
+                                      "free_slots": bool(msg.get("free_slots")),
+                                      "sort": sort, "offset": offset, "limit": limit})
                 if resp["status"] == "ok":
-                    rooms = resp.get("rooms", [])
-                    conn.send(
-                        json.dumps(
-                            {"status": "ok", "msg": "Room list", "rooms": rooms}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "ok", "msg": "Room list", "rooms": resp["rooms"],
+                                              "total": resp["total"], "offset": offset, "limit": limit})
                 else:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "Failed to fetch room list."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "Failed to fetch room list."})
 
             elif cmd == "join_room":
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
                     room_name = msg.get("room_name")
-                    resp = db_request(
+                    resp = await db_call(
                         {
                             "cmd": "join_room",
                             "room_name": room_name,
@@ -356,142 +2019,95 @@ def handle_client(conn, addr):
                         }
                     )
                     if resp["status"] == "ok":
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "status": "ok",
-                                    "msg": f"Joined room '{room_name}' successfully.",
-                                }
-                            ).encode()
-                        )
+                        publish_join(current_user, room_name, resp.get("room_info"))
+                        await send_frame(writer, {
+                            "status": "ok",
+                            "msg": f"Joined room '{room_name}' successfully.",
+                        })
                     else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "status": "error",
-                                    "msg": f"Failed to join room: {resp.get('msg')}",
-                                }
-                            ).encode()
-                        )
+                        await send_frame(writer, {
+                            "status": "error",
+                            "msg": f"Failed to join room: {resp.get('msg')}",
+                        })
 
             elif cmd == "leave_room":
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
-                    resp = db_request({"cmd": "leave_room", "user": current_user})
+                    resp = await leave_room(current_user)
                     if resp["status"] == "ok":
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "status": "ok",
-                                    "msg": resp.get("msg", "Left room successfully"),
-                                }
-                            ).encode()
-                        )
+                        await send_frame(writer, {
+                            "status": "ok",
+                            "msg": resp.get("msg", "Left room successfully"),
+                        })
                     else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "status": "error",
-                                    "msg": f"Failed to leave room: {resp.get('msg')}",
-                                }
-                            ).encode()
-                        )
+                        await send_frame(writer, {
+                            "status": "error",
+                            "msg": f"Failed to leave room: {resp.get('msg')}",
+                        })
 
             elif cmd == "get_user_room":
                 user = msg.get("user")
-                resp = db_request({"cmd": "get_user_room", "user": user})
-                conn.send(json.dumps(resp).encode())
+                resp = await db_call({"cmd": "get_user_room", "user": user})
+                await send_frame(writer, resp)
 
             elif cmd == "get_room_info":
                 user = msg.get("user")
-                resp = db_request({"cmd": "get_user_room", "user": user})
+                resp = await db_call({"cmd": "get_user_room", "user": user})
                 room_name = resp.get("room_name")
                 if room_name:
-                    room_resp = db_request(
+                    room_resp = await db_call(
                         {"cmd": "get_room_info", "room_name": room_name}
                     )
-                    conn.send(json.dumps(room_resp).encode())
+                    await send_frame(writer, room_resp)
                 else:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "User not in any room"}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "User not in any room"})
 
             elif cmd == "invite_player":
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
-                    resp = db_request({"cmd": "list", "online_only": True})
+                    resp = await db_call({"cmd": "list", "online_only": True})
                     users = resp.get("users", [])
-                    room_resp = db_request(
+                    room_resp = await db_call(
                         {"cmd": "get_user_room", "user": current_user}
                     )
                     room_name = room_resp.get("room_name")
                     if room_name:
                         filtered = [u for u in users if u != current_user]
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "status": "ok",
-                                    "available_users": filtered,
-                                    "room_name": room_name,
-                                }
-                            ).encode()
-                        )
+                        await send_frame(writer, {
+                            "status": "ok",
+                            "available_users": filtered,
+                            "room_name": room_name,
+                        })
                     else:
-                        conn.send(
-                            json.dumps(
-                                {"status": "error", "msg": "You are not in a room"}
-                            ).encode()
-                        )
+                        await send_frame(writer, {"status": "error", "msg": "You are not in a room"})
 
             elif cmd == "manage_invitations":
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
-                    resp = db_request({"cmd": "get_invitations", "user": current_user})
-                    conn.send(json.dumps(resp).encode())
+                    resp = await db_call({"cmd": "get_invitations", "user": current_user})
+                    await send_frame(writer, resp)
 
             elif cmd == "invite":
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
                     target_user = msg.get("user")
                     room_name = msg.get("room_name")
-                    resp = db_request(
+                    resp = await db_call(
                         {"cmd": "invite", "user": target_user, "room_name": room_name}
                     )
-                    conn.send(json.dumps(resp).encode())
+                    await send_frame(writer, resp)
 
             elif cmd == "respond_invitation":
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
                     room_name = msg.get("room_name")
                     accept = msg.get("accept", False)
-                    resp = db_request(
+                    resp = await db_call(
                         {
                             "cmd": "respond_invitation",
                             "user": current_user,
@@ -499,60 +2115,57 @@ def handle_client(conn, addr):
                             "accept": accept,
                         }
                     )
-                    conn.send(json.dumps(resp).encode())
+                    if resp.get("room_info"):
+                        publish_join(current_user, room_name, resp.pop("room_info"))
+                    await send_frame(writer, resp)
 
             elif cmd == "set_ready":
                 if not current_user:
-                    conn.send(
-                        json.dumps(
-                            {"status": "error", "msg": "You must login first."}
-                        ).encode()
-                    )
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
                 else:
                     ready = msg.get("ready")
-                    resp = db_request(
+                    resp = await db_call(
                         {"cmd": "set_ready", "user": current_user, "ready": ready}
                     )
-                    conn.send(json.dumps(resp).encode())
+                    if resp.get("status") == "ok":
+                        push_room_event(resp.pop("room_info"), "ready_changed", resp.pop("room_name"),
+                                        user=current_user, ready=ready)
+                    await send_frame(writer, resp)
 
             elif cmd == "start_game":
                 if not current_user:
-                    conn.send(json.dumps({"status":"error","msg":"You must login first."}).encode())
+                    await send_frame(writer, {"status":"error","msg":"You must login first."})
                     continue
 
-                room_info = db_request({"cmd":"get_user_room","user":current_user})
+                room_info = await db_call({"cmd":"get_user_room","user":current_user})
                 room_name = room_info.get("room_name")
                 if not room_name:
-                    conn.send(json.dumps({"status":"error","msg":"You are not in any room."}).encode())
+                    await send_frame(writer, {"status":"error","msg":"You are not in any room."})
                     continue
 
-                room_data = db_request({"cmd":"get_room_info","room_name":room_name})
+                room_data = await db_call({"cmd":"get_room_info","room_name":room_name})
                 room_info = room_data.get("room_info", {})
 
                 # Check host identity
                 if room_info.get("host") != current_user:
-                    conn.send(json.dumps({"status":"error","msg":"Only the host can start the game."}).encode())
+                    await send_frame(writer, {"status":"error","msg":"Only the host can start the game."})
                     continue
                 
                 # --- [Modified] Read Manifest first to get min_players ---
                 game_id = room_info.get("game_id")
                 if not game_id:
-                    conn.send(json.dumps({"status":"error","msg":"Room has no game assigned."}).encode())
+                    await send_frame(writer, {"status":"error","msg":"Room has no game assigned."})
                     continue
 
-                game_dir = os.path.join("games_repo", game_id)
-                manifest_path = os.path.join(game_dir, "manifest.json")
-                
-                if not os.path.exists(manifest_path):
-                     conn.send(json.dumps({"status":"error","msg":"Game files missing on server."}).encode())
-                     continue
-                
-                try:
-                    with open(manifest_path, 'r') as f:
-                        manifest = json.load(f)
-                except Exception as e:
-                    conn.send(json.dumps({"status":"error","msg":f"Bad manifest: {e}"}).encode())
+                manifest, error = manifest_registry.get(game_id)
+                if error:
+                    await send_frame(writer, {"status":"error","msg":error})
                     continue
+                if not manifest:
+                     await send_frame(writer, {"status":"error","msg":"Game files missing on server."})
+                     continue
+                # The session keeps this version's directory even if a newer one is activated
+                game_dir = manifest_registry.game_dir(game_id)
 
                 # Read min_players from manifest, default to 2
                 min_players = manifest.get("min_players", 2)
@@ -560,327 +2173,583 @@ def handle_client(conn, addr):
                 # --- [Modified] Dynamic player count check ---
                 current_players = len(room_info.get("members", []))
                 if current_players < min_players:
-                    conn.send(json.dumps({
+                    await send_frame(writer, {
                         "status":"error",
                         "msg":f"Need at least {min_players} players to start (Current: {current_players})."
-                    }).encode())
+                    })
                     continue
                 # ----------------------------------------------
 
                 # Check ready status
                 not_ready = [u for u in room_info.get("members", []) if not room_info.get("ready", {}).get(u, False)]
                 if not_ready:
-                    conn.send(json.dumps({"status":"error","msg":f"Cannot start game, not ready: {', '.join(not_ready)}"}).encode())
+                    await send_frame(writer, {"status":"error","msg":f"Cannot start game, not ready: {', '.join(not_ready)}"})
                     continue
 
-                server_script = manifest.get("server_entry")
-                if not server_script:
-                     conn.send(json.dumps({"status":"error","msg":"Invalid game manifest (no server_entry)."}).encode())
-                     continue
+                server_script = manifest["server_entry"]
 
-                print(f"[SYSTEM] Launching Game Server for room '{room_name}' ({game_id})...")
-                
+                if supervisor.is_active(room_name):
+                    await send_frame(writer, {"status":"error","msg":"A game is already running in this room."})
+                    continue
+
+                in_flight["expensive"] += 1
                 try:
-                    # Launch child process
-                    proc = subprocess.Popen([sys.executable, server_script], cwd=game_dir)
+                    outcome, detail = await supervisor.request_start(room_name, game_id, game_dir, server_script)
                 except Exception as e:
                     print(f"[ERROR] Failed to launch game server: {e}")
-                    conn.send(json.dumps({"status":"error","msg":"Failed to launch game server."}).encode())
+                    await send_frame(writer, {"status":"error","msg":"Failed to launch game server."})
+                    continue
+                finally:
+                    in_flight["expensive"] -= 1
+
+                if outcome == "queued":
+                    await send_frame(writer, {
+                        "status": "queued",
+                        "msg": f"All game servers are busy. Queued at position {detail}, the game starts automatically."
+                    })
                     continue
 
                 # Broadcast game start info
-                players = room_info.get("members", [])
-                game_start_msg = json.dumps({
-                    "type": "start_game",
-                    "game_host": GAME_HOST,
-                    "game_port": GAME_PORT,
-                    "room_name": room_name,
-                    "game_id": game_id,
-                    "players": players,
-                })
-
-                with connection_lock:
-                    for p in players:
-                        listener_key = f"{p}_listener"
-                        if listener_key in client_connections:
-                            try:
-                                client_connections[listener_key].send(game_start_msg.encode())
-                            except Exception as e:
-                                print(f"[ERROR] Notify {p} failed: {e}")
-                                if listener_key in client_connections:
-                                    del client_connections[listener_key]
-
-                conn.send(json.dumps({"status": "ok", "msg": "Game started"}).encode())
+                broadcast_game_start(room_name, game_id, detail, room_info.get("members", []))
 
-            elif cmd == "upload_game":
-                # 1. Read Header Info
-                file_name = msg.get("file_name")
-                file_size = msg.get("file_size")
-                
-                # Tell Client ready to receive
-                conn.send("READY".encode())
+                await send_frame(writer, {"status": "ok", "msg": "Game started"})
 
-                # 2. Receive File
-                save_path = os.path.join("games_repo", file_name)
-                received_size = 0
-                
-                # Ensure games_repo exists
-                if not os.path.exists("games_repo"):
-                    os.makedirs("games_repo")
-
-                with open(save_path, 'wb') as f:
-                    while received_size < file_size:
-                        # Calculate remaining size to avoid over-reading
-                        chunk_size = min(4096, file_size - received_size)
-                        data_chunk = conn.recv(chunk_size)
-                        if not data_chunk:
-                            break
-                        f.write(data_chunk)
-                        received_size += len(data_chunk)
-                
-                print(f"[SYSTEM] Received {file_name} from {addr}")
+            elif cmd == "matchmake":
+                if not current_user:
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
+                    continue
+                game_id = msg.get("game_id")
+                manifest, error = manifest_registry.get(game_id)
+                if not manifest:
+                    await send_frame(writer, {"status": "error", "msg": error or "Game not found"})
+                    continue
+                resp = await db_call({"cmd": "matchmake", "user": current_user, "game_id": game_id})
+                if resp.get("status") == "ok":
+                    resp["msg"] = (f"Searching for {manifest.get('name', game_id)} players (position "
+                                   f"{resp['position']}), the game starts automatically.")
+                await send_frame(writer, resp)
 
-                # 3. Validation and Registration (Modified: unzip to permanent dir)
-                try:
-                    # Read zip content without extracting first
-                    with zipfile.ZipFile(save_path, 'r') as zip_ref:
-                        # Find manifest.json
-                        if "manifest.json" not in zip_ref.namelist():
-                             conn.send(json.dumps({"status": "error", "msg": "Invalid Game: No manifest.json found."}).encode())
-                             continue
-                        
-                        with zip_ref.open("manifest.json") as mf:
-                            manifest = json.load(mf)
-                    
-                    game_id = manifest.get("game_id")
-                    new_version = manifest.get("version", "0.0.0")
-                    if not game_id:
-                         conn.send(json.dumps({"status": "error", "msg": "Manifest missing 'game_id'"}).encode())
-                         continue
-
-                    # 1. Define old game directory path
-                    current_game_dir = os.path.join("games_repo", game_id)
-                    old_manifest_path = os.path.join(current_game_dir, "manifest.json")
-                    
-                    # 2. If old file exists, read its version
-                    if os.path.exists(old_manifest_path):
-                        try:
-                            with open(old_manifest_path, 'r') as f:
-                                old_manifest = json.load(f)
-                            old_version = old_manifest.get("version", "0.0.0")
-                            
-                            # 3. Compare versions: If new <= old, reject upload
-                            if new_version <= old_version:
-                                msg = f"Upload rejected: Version {new_version} is not greater than server version {old_version}."
-                                print(f"[SYSTEM] {msg}")
-                                conn.send(json.dumps({"status": "error", "msg": msg}).encode())
-                                
-                                # Important: Delete received zip and skip extraction
-                                os.remove(save_path) 
-                                continue 
-                        except:
-                            # If reading old file fails, proceed to overwrite
-                            pass
+            elif cmd == "cancel_matchmake":
+                if not current_user:
+                    await send_frame(writer, {"status": "error", "msg": "You must login first."})
+                else:
+                    await send_frame(writer, await db_call({"cmd": "cancel_matchmake", "user": current_user}))
 
-                    # --- [Critical] Extract to games_repo/{game_id} ---
-                    game_dir = os.path.join("games_repo", game_id)
-                    if os.path.exists(game_dir):
-                        shutil.rmtree(game_dir) # Overwrite old version
-                    os.makedirs(game_dir)
-                    
-                    with zipfile.ZipFile(save_path, 'r') as zip_ref:
-                        zip_ref.extractall(game_dir)
-
-                    # Add file info
-                    manifest["file_name"] = file_name
-                    manifest["file_size"] = file_size
-                    manifest["uploader"] = current_user or "anonymous"
-
-                    # Write to DB
-                    db_resp = db_request({
-                        "cmd": "update_game_info", 
-                        "game_id": game_id,
-                        "info": manifest
-                    })
-                    
-                    if db_resp["status"] == "ok":
-                        msg = f"Game '{manifest.get('name')}' v{manifest.get('version')} uploaded & installed."
-                        conn.send(json.dumps({"status": "ok", "msg": msg}).encode())
-                    else:
-                        conn.send(json.dumps({"status": "error", "msg": "DB update failed"}).encode())
+            elif cmd == "upload_game":
+                # 1. Read Header Info, reject bad uploads before any byte is sent
+                file_name = os.path.basename(msg.get("file_name") or "")
+                file_size = msg.get("file_size")
+                checksum = msg.get("sha256")
+                if not file_name or not isinstance(file_size, int) or file_size < 0:
+                    await send_frame(writer, {"status": "error", "msg": "Invalid upload header"})
+                    continue
+                if file_size > MAX_UPLOAD_SIZE:
+                    await send_frame(writer, {"status": "error", "msg": f"Upload too large (limit {MAX_UPLOAD_SIZE // (1024 * 1024)} MiB)."})
+                    continue
+                if checksum is not None and not (isinstance(checksum, str) and re.fullmatch(r"[0-9a-f]{64}", checksum)):
+                    await send_frame(writer, {"status": "error", "msg": "Invalid sha256"})
+                    continue
 
-                except Exception as e:
-                    print(f"[ERROR] Upload process failed: {e}")
-                    conn.send(json.dumps({"status": "error", "msg": str(e)}).encode())
+                # 2. The bytes go over the data port (see receive_game_upload)
+                token = issue_ticket(kind="upload", file_name=file_name, file_size=file_size,
+                                     checksum=checksum, user=current_user or "anonymous")
+                await send_frame(writer, {"status": "ready", "token": token, "data_port": data_port})
 
             elif cmd == "get_store_list":
-                resp = db_request({"cmd": "get_store_list"})
-                conn.send(json.dumps(resp).encode())
+                resp = await get_store_list()
+                await send_frame(writer, resp)
             
             elif cmd == "delete_game":
                 game_id = msg.get("game_id")
-                # 1. Verify ownership via DB
-                store_resp = db_request({"cmd": "get_store_list"})
-                games = store_resp.get("games", [])
-                target_game = next((g for g in games if g["game_id"] == game_id), None)
+                # 1. Verify ownership via the store catalog
+                target_game = await find_store_game(game_id)
                 
                 if not target_game:
-                    conn.send(json.dumps({"status": "error", "msg": "Game not found"}).encode())
+                    await send_frame(writer, {"status": "error", "msg": "Game not found"})
                 elif target_game.get("uploader") != current_user:
-                     conn.send(json.dumps({"status": "error", "msg": "Permission denied: You are not the owner."}).encode())
+                     await send_frame(writer, {"status": "error", "msg": "Permission denied: You are not the owner."})
                 else:
                     # 2. Remove from DB
-                    db_resp = db_request({"cmd": "delete_game", "game_id": game_id})
+                    db_resp = await db_call({"cmd": "delete_game", "game_id": game_id})
                     if db_resp["status"] == "ok":
+                        invalidate_game(game_id, files_changed=True)
                         # 3. Remove files from server
                         file_name = target_game.get("file_name")
                         # 4. Remove file from games_repo
                         zip_path = os.path.join("games_repo", file_name)
-                        game_dir = os.path.join("games_repo", game_id)
                         
                         try:
-                            if os.path.exists(zip_path): os.remove(zip_path) # Though we delete zip after extract, check just in case
-                            if os.path.exists(game_dir): shutil.rmtree(game_dir)
-                            conn.send(json.dumps({"status": "ok", "msg": f"Game {game_id} deleted."}).encode())
+                            await run_blocking(remove_game_files, game_id, zip_path)
+                            await send_frame(writer, {"status": "ok", "msg": f"Game {game_id} deleted."})
                         except Exception as e:
-                             conn.send(json.dumps({"status": "error", "msg": f"DB deleted but file error: {e}"}).encode())
+                             await send_frame(writer, {"status": "error", "msg": f"DB deleted but file error: {e}"})
                     else:
-                        conn.send(json.dumps(db_resp).encode())
+                        await send_frame(writer, db_resp)
 
             
             elif cmd == "download_game":
                 game_id = msg.get("game_id")
-                # 1. Query DB for filename
-                store_resp = db_request({"cmd": "get_store_list"})
-                games = store_resp.get("games", [])
-                target_game = next((g for g in games if g["game_id"] == game_id), None)
+                # 1. Look up filename in the store catalog
+                target_game = await find_store_game(game_id)
                 
                 if not target_game:
-                    conn.send(json.dumps({"status": "error", "msg": "Game not found"}).encode())
+                    await send_frame(writer, {"status": "error", "msg": "Game not found"})
                     continue
                     
                 file_name = target_game.get("file_name")
-                file_path = os.path.join("games_repo", file_name)
+                file_path = artifact_file(target_game)
                 
-                if not os.path.exists(file_path):
-                    conn.send(json.dumps({"status": "error", "msg": "Game file missing on server"}).encode())
+                if not os.path.isfile(file_path):
+                    await send_frame(writer, {"status": "error", "msg": "Game file missing on server"})
                     continue
                     
                 file_size = os.path.getsize(file_path)
-                
-                # 2. Send Header
+                checksum = await run_blocking(artifact_sha256, file_path, target_game.get("sha256"))
+
+                # Optional byte range. A resuming client also sends the checksum of
+                # the copy it holds; if the artifact changed since, start over.
+                offset = msg.get("offset", 0)
+                length = msg.get("length")
+                if msg.get("if_sha256") not in (None, checksum):
+                    offset = 0
+                if not isinstance(offset, int) or not 0 <= offset <= file_size:
+                    await send_frame(writer, {"status": "error", "msg": "Invalid offset"})
+                    continue
+                count = file_size - offset
+                if isinstance(length, int) and 0 <= length < count:
+                    count = length
+
+                # 2. Send Header; the client fetches the bytes from the data port with the token
+                key = (game_id, target_game.get("version"))
+                token = issue_ticket(kind="download", files=[(key, checksum, file_path, file_size, offset, count)],
+                                     label=f"{file_name} (bytes {offset}-{offset + count})")
                 header = {
                     "status": "ok",
                     "file_name": file_name,
                     "file_size": file_size,
-                    "game_info": target_game
+                    "sha256": checksum,
+                    "offset": offset,
+                    "length": count,
+                    "game_info": target_game,
+                    "token": token,
+                    "data_port": data_port
                 }
-                conn.send(json.dumps(header).encode())
-                
-                # Wait for Client Ready
-                ack = conn.recv(1024).decode()
-                if "READY" not in ack:
-                    print(f"[SYSTEM] Download cancelled by client")
+                await send_frame(writer, header)
+
+            elif cmd == "get_file_index":
+                # Per-file hashes of the installed version, so clients can fetch only what changed
+                game_id = msg.get("game_id")
+                manifest, error = manifest_registry.get(game_id)
+                if not manifest:
+                    await send_frame(writer, {"status": "error", "msg": error or "Game not found"})
                     continue
-                    
-                # 3. Send File
-                print(f"[SYSTEM] Sending {file_name} to {addr}...")
-                with open(file_path, 'rb') as f:
-                    while True:
-                        bytes_read = f.read(4096)
-                        if not bytes_read:
-                            break
-                        conn.sendall(bytes_read)
-                print(f"[SYSTEM] Sent {file_name} complete.")
+                version = manifest.get("version", "0.0.0")
+                files = await run_blocking(load_file_index, game_id, version)
+                await send_frame(writer, {"status": "ok", "game_id": game_id, "version": version, "files": files})
+
+            elif cmd == "download_files":
+                # Stream selected files of the installed version back to back, in request order
+                game_id = msg.get("game_id")
+                manifest, error = manifest_registry.get(game_id)
+                if not manifest:
+                    await send_frame(writer, {"status": "error", "msg": error or "Game not found"})
+                    continue
+                version = manifest.get("version", "0.0.0")
+                if msg.get("version") != version:
+                    await send_frame(writer, {"status": "error", "msg": f"Game was updated to v{version}, please retry."})
+                    continue
+                files = await run_blocking(load_file_index, game_id, version)
+                wanted = msg.get("files") or []
+                unknown = [p for p in wanted if p not in files]
+                if unknown:
+                    await send_frame(writer, {"status": "error", "msg": f"Unknown files: {', '.join(unknown[:5])}"})
+                    continue
+
+                entries = [{"path": p, "size": files[p]["size"], "sha256": files[p]["sha256"]} for p in wanted]
+                token = issue_ticket(kind="download",
+                                     files=[((game_id, version, e["path"]), e["sha256"], artifacts.blob_path(e["sha256"]),
+                                             e["size"], 0, e["size"]) for e in entries],
+                                     label=f"{len(entries)} changed files of {game_id} v{version}")
+                await send_frame(writer, {"status": "ok", "version": version, "files": entries,
+                                          "total_size": sum(e["size"] for e in entries),
+                                          "token": token, "data_port": data_port})
 
             elif cmd == "get_game_details":
                 game_id = msg.get("game_id")
-                resp = db_request({"cmd": "get_game_details", "game_id": game_id})
-                conn.send(json.dumps(resp).encode())
+                resp = await get_game_details(game_id)
+                await send_frame(writer, resp)
 
             elif cmd == "add_review":
                 # Forward all parameters
-                resp = db_request(msg) 
-                conn.send(json.dumps(resp).encode())
+                resp = await db_call(msg) 
+                if resp.get("status") == "ok":
+                    invalidate_game(msg.get("game_id"))
+                await send_frame(writer, resp)
 
             elif cmd == "exit":
                 if current_user:
-                    db_request(
-                        {"cmd": "set_online", "user": current_user, "online": False}
+                    await db_call(
+                        {"cmd": "set_online", "user": current_user, "online": False, "role": current_role}
                     )
-                    db_request({"cmd": "leave_room", "user": current_user})
+                    await leave_room(current_user)
                     # Remove client connection record
-                    with connection_lock:
-                        if current_user in client_connections:
-                            del client_connections[current_user]
+                    if current_user in client_connections:
+                        del client_connections[current_user]
                     current_user = None
-                conn.send(json.dumps({"status": "ok", "msg": "Goodbye!"}).encode())
+                await send_frame(writer, {"status": "ok", "msg": "Goodbye!"})
                 break
 
             else:
-                conn.send(
-                    json.dumps({"status": "error", "msg": "Unknown command"}).encode()
-                )
+                await send_frame(writer, {"status": "error", "msg": "Unknown command"})
 
+        except ServerBusy:
+            started = None  # Counted as throttled instead
+            await send_frame(writer, throttled("busy", 0.5))
+            await asyncio.sleep(0.5)
         except Exception as e:
             print(f"[ERROR] {addr}: {e}")
             break
+        finally:
+            # Back to unclassified, so the disconnect cleanup below (and anything
+            # else run between commands) is never refused as a busy query
+            command_class.set(None)
+            if started is not None:
+                label = cmd if cmd in COMMAND_CLASSES else "unknown"
+                commands_handled.inc(label)
+                command_seconds.observe(time.perf_counter() - started, label)
 
     # Cleanup client connection
+    connection_codecs.pop(writer, None)
+    last_seen.pop(writer, None)
     if current_user:
-        with connection_lock:
-            if current_user in client_connections:
-                del client_connections[current_user]
-            # Also cleanup listener connection
-            listener_key = f"{current_user}_listener"
-            if listener_key in client_connections:
-                del client_connections[listener_key]
-        db_request({"cmd": "set_online", "user": current_user, "online": False, "role": current_role})
-        db_request({"cmd": "leave_room", "user": current_user})
-
-    conn.close()
+        if current_user in client_connections:
+            del client_connections[current_user]
+        # Also cleanup listener connection
+        listener_key = f"{current_user}_listener"
+        if listener_key in client_connections:
+            del client_connections[listener_key]
+        await db_call({"cmd": "set_online", "user": current_user, "online": False, "role": current_role})
+        await leave_room(current_user)
+
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
     print(f"[DISCONNECTED] {addr}")
 
 
-def admin_console(server_socket):
+class WorkerBus:
+    """A lobby worker's connection to the primary process, which relays every
+    message to all other workers. Used for what one worker does that affects
+    clients or state held by another: room pushes to listeners connected
+    elsewhere, store invalidations and running game sessions. publish() only
+    enqueues, like notify_listeners."""
+
+    def __init__(self, index):
+        self.index = index
+        self.writer = None
+
+    async def connect(self, port):
+        reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.publish({"type": "worker_up"})
+        spawn_background(self._run(reader))
+
+    def publish(self, msg):
+        msg["worker"] = self.index
+        data = json.dumps(msg).encode()
+        self.writer.write(struct.pack("!I", len(data)) + data)
+
+    async def _run(self, reader):
+        try:
+            while True:
+                data = await read_frame(reader)
+                if data is None:
+                    break
+                await handle_bus_message(json.loads(data.decode()))
+        except Exception as e:
+            print(f"[ERROR] Worker bus: {e}")
+        # The primary process is gone (shutdown or crash); so is this worker
+        print(f"[SYSTEM] Lobby worker {self.index} lost the primary process, exiting.")
+        os._exit(1)
+
+
+async def handle_bus_message(msg):
+    kind = msg.get("type")
+    if kind == "notify":
+        notify_listeners_local(msg["users"], msg["msg"])
+    elif kind == "invalidate":
+        store_cache.invalidate(msg["game_id"])
+        if msg.get("files_changed"):
+            hot_artifacts.invalidate(msg["game_id"])
+            await run_blocking(manifest_registry.refresh, msg["game_id"])
+    elif kind == "session":
+        supervisor.remote_update(msg["worker"], msg["room_name"], msg["game_dir"])
+    elif kind == "worker_up":
+        supervisor.announce_all()  # A (re)started worker knows of no running games yet
+    elif kind == "worker_down":
+        supervisor.remote_worker_down(msg["worker"])
+    elif kind == "admin":
+        # Written in one piece so the workers' reports do not interleave.
+        # The reports wait on the event loop, so build them off it.
+        report = await run_blocking(ADMIN_REPORTS[msg["cmd"]])
+        sys.stdout.write(f"[SYSTEM] ----- Lobby worker {worker_index} -----\n{report}")
+        sys.stdout.flush()
+
+
+class BusHub:
+    """Primary process side of the worker bus: relays each frame a worker sends
+    to every other worker, and reports workers that disconnect."""
+
+    def __init__(self):
+        self.workers = {}  # worker index -> StreamWriter
+
+    def relay(self, data, sender=None):
+        frame = struct.pack("!I", len(data)) + data
+        for index, writer in self.workers.items():
+            if index != sender:
+                writer.write(frame)
+
+    async def handle(self, reader, writer):
+        index = None
+        try:
+            data = await read_frame(reader)
+            index = json.loads(data.decode())["worker"]
+            self.workers[index] = writer
+            while data is not None:
+                self.relay(data, index)
+                data = await read_frame(reader)
+        except Exception as e:
+            print(f"[ERROR] Worker bus, worker {index}: {e}")
+        if index is not None and self.workers.get(index) is writer:
+            del self.workers[index]
+            self.relay(json.dumps({"type": "worker_down", "worker": index}).encode())
+        writer.close()
+
+
+def configure_worker(index, count):
+    """Give worker `index` of `count` its own data port and an equal, disjoint
+    share of the game ports, game sessions and pre-warmed game servers."""
+    global worker_index, data_port, port_pool
+    worker_index = index
+    data_port = DATA_PORT + index
+    share = (GAME_PORT_MAX - GAME_PORT + 1) // count
+    first = GAME_PORT + index * share
+    port_pool = PortPool(first, first + share - 1)
+    supervisor.max_sessions = max(1, GAME_MAX_SESSIONS // count)
+    worker_pool.size = -(-GAME_WORKER_POOL_SIZE // count)  # Rounded up
+    artifacts.shared = True
+
+
+async def keep_worker_running(index, count, bus_port):
+    """Run lobby worker `index` and restart it if it exits while the lobby is up."""
+    while server_running:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            "--worker", str(index), "--workers", str(count), "--bus-port", str(bus_port),
+            stdin=asyncio.subprocess.DEVNULL,
+        )
+        code = await proc.wait()
+        if server_running:
+            print(f"[ERROR] Lobby worker {index} exited ({code}), restarting it.")
+            await asyncio.sleep(1)
+
+
+async def serve_primary(count):
+    """Multi-process mode: do the one-time startup work, then run `count` lobby
+    workers that all accept on LOBBY_PORT (SO_REUSEPORT) and relay between them."""
+    global main_loop, bus_hub
+    main_loop = asyncio.get_running_loop()
+
+    pruned = await run_blocking(prune_incoming)
+    if pruned:
+        print(f"[SYSTEM] Removed {pruned} abandoned partial uploads.")
+    await run_blocking(manifest_registry.load_all)
+    trees, imported = await run_blocking(load_artifacts)
+    print(f"[SYSTEM] Artifact store: {trees} versions" + (f", imported {imported} older installs." if imported else "."))
+
+    bus_hub = BusHub()
+    bus_server = await asyncio.start_server(bus_hub.handle, "127.0.0.1", 0)
+    bus_port = bus_server.sockets[0].getsockname()[1]
+    for index in range(count):
+        spawn_background(keep_worker_running(index, count, bus_port))
+    print(f"[SYSTEM] Started {count} lobby workers on {HOST}:{PORT}, "
+          f"file transfers on ports {DATA_PORT}-{DATA_PORT + count - 1}")
+
+    print("Type 'sessions' to list running games, 'stats' for cache statistics, "
+          "'metrics' for Prometheus metrics, 'shutdown' to safely close the server.")
+    threading.Thread(target=admin_console, daemon=True).start()
+
+    async with bus_server:
+        await bus_server.serve_forever()
+
+
+def sessions_report():
+    """Running and queued game sessions, as text for the admin console."""
+    async def snapshot():
+        return supervisor.usage(), len(supervisor.pending)
+
+    rows, queued = asyncio.run_coroutine_threadsafe(snapshot(), main_loop).result(timeout=5)
+    lines = [f"[SYSTEM] {len(rows)}/{supervisor.max_sessions} game sessions running, {queued} queued"]
+    for r in rows:
+        cpu = f"{r['cpu']:.1f}s" if r["cpu"] is not None else "n/a"
+        rss = f"{r['rss_kb'] / 1024:.1f}MiB" if r["rss_kb"] is not None else "n/a"
+        lines.append(f"  {r['room']:<16} {r['game_id']:<16} port={r['port']} pid={r['pid']} "
+                     f"up={r['uptime']:.0f}s cpu={cpu} rss={rss}")
+    return "\n".join(lines) + "\n"
+
+
+def stats_report():
+    """Cache, listener, admission, matchmaking and artifact store figures, as text for the admin console."""
+    async def snapshot():
+        outboxes = [c for c in client_connections.values() if isinstance(c, Outbox)]
+        return (store_cache.stats(), hot_artifacts.stats(), len(outboxes), sum(o.pending() for o in outboxes),
+                dict(matchmaking), sorted(match_waits))
+
+    st, hot, listeners, queued, mm, waits = asyncio.run_coroutine_threadsafe(snapshot(), main_loop).result(timeout=5)
+    lines = [
+        f"[SYSTEM] Store cache: {st['hits']} hits, {st['misses']} misses "
+        f"({st['hit_ratio']:.1f}% hit), {st['entries']} entries",
+        f"[SYSTEM] Hot artifact cache: {hot['hits']} hits, {hot['misses']} misses "
+        f"({hot['hit_ratio']:.1f}% hit), {hot['entries']} entries, {hot['bytes'] / 1024 / 1024:.1f} MiB held, "
+        f"{hot['served'] / 1024 / 1024:.1f} MiB served from memory",
+    ]
+    if frame_bytes["raw"]:
+        lines.append(f"[SYSTEM] Frames: {frame_bytes['raw']} bytes of JSON sent as {frame_bytes['wire']} bytes "
+                     f"({frame_bytes['wire'] / frame_bytes['raw'] * 100:.0f}%)")
+    lines.append(f"[SYSTEM] Listeners: {listeners} connected, {queued} messages queued, "
+                 f"{slow_listeners_dropped} disconnected for not reading")
+    lines.append(f"[SYSTEM] Heartbeats: {connections_reaped} silent connections reaped")
+    lines.append(f"[SYSTEM] Admission: {throttled_requests['rate']} requests over their session's rate limit, "
+                 f"{throttled_requests['busy']} refused as busy; in flight: {in_flight['query']} query DB calls, "
+                 f"{in_flight['expensive']} transfers/game starts")
+    if mm["matched"] or mm["queued"]:
+        line = f"[SYSTEM] Matchmaking: {mm['queued']} queued, {mm['matched']} players matched into {mm['rooms']} rooms"
+        if waits:
+            line += (f", queue wait p50={waits[len(waits) // 2]:.1f}s p95={waits[int(len(waits) * 0.95)]:.1f}s "
+                     f"max={waits[-1]:.1f}s")
+        lines.append(line)
+    usage = artifacts.usage()
+    lines.append(f"[SYSTEM] Artifact store: {usage['blobs']} blobs, {usage['bytes'] / 1024 / 1024:.1f} MiB, "
+                 f"{usage['unreferenced']} awaiting GC")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_report():
+    """This process's metrics in the Prometheus text format."""
+    async def snapshot():
+        return metrics.render()
+
+    return asyncio.run_coroutine_threadsafe(snapshot(), main_loop).result(timeout=5)
+
+
+# Admin console commands answered with a report; in multi-process mode each worker sends its own
+ADMIN_REPORTS = {"sessions": sessions_report, "stats": stats_report, "metrics": metrics_report}
+
+
+def admin_console():
     global server_running
     while True:
         cmd = input()
-        if cmd.strip().lower() in ("shutdown", "s"):
+        if bus_hub and cmd.strip().lower() in ADMIN_REPORTS:
+            # Multi-process mode: every worker prints its own figures
+            data = json.dumps({"type": "admin", "cmd": cmd.strip().lower()}).encode()
+            main_loop.call_soon_threadsafe(bus_hub.relay, data)
+        elif cmd.strip().lower() in ADMIN_REPORTS:
+            print(ADMIN_REPORTS[cmd.strip().lower()](), end="")
+        elif cmd.strip().lower() in ("shutdown", "s"):
             print("[SYSTEM] Shutting down server...")
             server_running = False
-            server_socket.close()
             os._exit(0)
 
 
-def main():
-    _ = connect_db_server()  # Test DB connection
-    global server_running
-    
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen()
-    print(f"[SYSTEM] Server listening on {HOST}:{PORT}")
-
-    resp = db_request({"cmd": "list"})
-    if resp["status"] == "ok":
-        print(f"[SYSTEM] {len(resp['users'])} registered users loaded.")
+async def serve(worker=None, workers=1, bus_port=None):
+    """Run the lobby in this process, or as lobby worker `worker` of `workers`
+    when started by serve_primary() (startup maintenance and the admin console
+    are then left to the primary process)."""
+    global main_loop, bus, transfer_slots, query_db_slots
+    loop = main_loop = asyncio.get_running_loop()
+    transfer_slots = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
+    query_db_slots = asyncio.Semaphore(QUERY_DB_SLOTS)
+    await loop.run_in_executor(db_executor, db_pool.warm_up)  # Test DB connection
+    if worker is not None:
+        configure_worker(worker, workers)
+        bus = WorkerBus(worker)
+        await bus.connect(bus_port)
+
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT, reuse_address=True, reuse_port=worker is not None, backlog=LISTEN_BACKLOG
+    )
+    data_server = await asyncio.start_server(
+        handle_data, HOST, data_port, reuse_address=True, backlog=LISTEN_BACKLOG
+    )
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_port = METRICS_PORT + (worker or 0)
+        try:
+            metrics_server = await asyncio.start_server(handle_metrics, METRICS_HOST, metrics_port,
+                                                        reuse_address=True)
+            print(f"[SYSTEM] Metrics on http://{METRICS_HOST}:{metrics_port}/metrics")
+        except OSError as e:
+            print(f"[WARNING] Metrics endpoint not started on port {metrics_port}: {e}")
+    if worker is not None:
+        print(f"[SYSTEM] Lobby worker {worker} (pid {os.getpid()}) listening on {HOST}:{PORT}, "
+              f"file transfers on port {data_port}")
+        await run_blocking(manifest_registry.load_all)
+        await run_blocking(artifacts.load)
     else:
-        print("[SYSTEM] Failed to load user list.")
-
-    print("Type 'shutdown' to safely close the server.")
+        print(f"[SYSTEM] Server listening on {HOST}:{PORT}, file transfers on port {data_port}")
+
+        pruned = await run_blocking(prune_incoming)
+        if pruned:
+            print(f"[SYSTEM] Removed {pruned} abandoned partial uploads.")
+        installed = await run_blocking(manifest_registry.load_all)
+        print(f"[SYSTEM] {installed} installed games loaded from {manifest_registry.root}.")
+        trees, imported = await run_blocking(load_artifacts)
+        print(f"[SYSTEM] Artifact store: {trees} versions" + (f", imported {imported} older installs." if imported else "."))
+
+        resp = await db_call({"cmd": "list"})
+        if resp["status"] == "ok":
+            print(f"[SYSTEM] {len(resp['users'])} registered users loaded.")
+        else:
+            print("[SYSTEM] Failed to load user list.")
+
+        print("Type 'sessions' to list running games, 'stats' for cache statistics, "
+              "'metrics' for Prometheus metrics, 'shutdown' to safely close the server.")
+        threading.Thread(target=admin_console, daemon=True).start()
+
+    spawn_background(worker_pool.fill())
+    if not worker:
+        spawn_background(artifact_gc_loop())  # One collector for the shared store
+        spawn_background(matchmaker_loop())  # One matcher for the shared queue
+    spawn_background(reap_idle_connections())
+
+    async with server, data_server:
+        try:
+            await server.serve_forever()
+        finally:
+            if metrics_server:
+                metrics_server.close()
 
-    threading.Thread(target=admin_console, args=(server,), daemon=True).start()
 
+def main():
+    parser = argparse.ArgumentParser(description="Game lobby server")
+    parser.add_argument("--workers", type=int, default=LOBBY_WORKERS,
+                        help="lobby processes sharing LOBBY_PORT (needs SO_REUSEPORT)")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--bus-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("[ERROR] --workers needs SO_REUSEPORT (Linux/BSD); starting a single lobby process.")
+        args.workers = 1
     try:
-        while server_running:
-            try:
-                conn, addr = server.accept()
-                threading.Thread(target=handle_client, args=(conn, addr)).start()
-            except OSError:
-                break
-    finally:
+        if args.worker is not None:
+            asyncio.run(serve(args.worker, args.workers, args.bus_port))
+        elif args.workers > 1:
+            asyncio.run(serve_primary(args.workers))
+        else:
+            asyncio.run(serve())
+    except KeyboardInterrupt:
         pass
 
 
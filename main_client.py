@@ -8,8 +8,16 @@ import sys
 import threading
 import subprocess
 import zipfile
-import io
 import time
+import struct
+import weakref
+import copy
+import hashlib
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # 沒安裝時只用 zlib
 from client_config import LOBBY_HOST, LOBBY_PORT
 
 HOST = LOBBY_HOST
@@ -21,30 +29,164 @@ game_event = threading.Event()
 game_process_event = threading.Event()
 game_info = {}
 listen_socket = None
+# 背景下載中的遊戲: game_id -> thread
+active_downloads = {}
+# 本地房間狀態: 由 listener 連線收到的 room_update 事件更新，選單不必每次向伺服器查詢
+# (synced = 已收到伺服器的初始狀態；沒有 listener 時退回查詢)
+room_state = {"synced": False, "room_name": None, "info": None}
+room_cond = threading.Condition()
+# 快速配對中的遊戲名稱 (沒有在排隊時為 None)，listener 收到配對結果後清除
+matching_game = None
+
+# 單一 frame 的大小上限 (與 lobby_server.MAX_FRAME_SIZE 一致)
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# 長度欄位最高位元 = 這個 frame 經過壓縮 (演算法在登入時協商)
+COMPRESSED_FLAG = 0x80000000
+# 只壓縮超過這個大小的訊息
+COMPRESSION_MIN_SIZE = 1024
+# 每隔幾秒送一次心跳 (與 config.HEARTBEAT_INTERVAL 一致)，伺服器會關閉太久沒有訊息的連線
+HEARTBEAT_INTERVAL = 20
+_frame_readers = weakref.WeakKeyDictionary()
 
 # ============================
 #      共用工具函式
 # ============================
 
-def send_and_recv(sock, msg, silent=False):
-    try:
-        if not silent: pass # print(f"[DEBUG] Sending: {msg}")
-        sock.send(json.dumps(msg).encode())
-        if not silent: pass # print("[DEBUG] Waiting for response...")
-        while True:
-
-
-            data = sock.recv(1024).decode()
-            if not data:
+class FrameCodec:
+    """單一連線的 frame 壓縮 ("zstd" 或 "zlib")"""
+
+    def __init__(self, name):
+        self.name = name
+        if name == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=3)
+            self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        if self.name == "zstd":
+            return self._compressor.compress(data)
+        return zlib.compress(data, 6)
+
+    def decompress(self, data):
+        # 解壓後同樣受 MAX_FRAME_SIZE 限制
+        if self.name == "zstd":
+            if zstandard.frame_content_size(data) > MAX_FRAME_SIZE:
+                raise ValueError("Decompressed frame too large")
+            return self._decompressor.decompress(data, max_output_size=MAX_FRAME_SIZE)
+        d = zlib.decompressobj()
+        out = d.decompress(data, MAX_FRAME_SIZE)
+        if d.unconsumed_tail:
+            raise ValueError("Decompressed frame too large")
+        return out
+
+def supported_codecs():
+    """登入時提供給伺服器的壓縮演算法 (依偏好排序)"""
+    return ["zstd", "zlib"] if zstandard else ["zlib"]
+
+class FrameReader:
+    """4-byte length-prefix 的串流解碼器。
+
+    多讀進來的位元組會留在 buffer，黏在一起的訊息或緊接在 header
+    後面的檔案資料都不會遺失。登入協商出壓縮後 codec 會被設定。
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.codec = None
+        self._buf = bytearray()
+        # 心跳執行緒與主執行緒會同時送訊息，整個 frame 要一次送完
+        self.send_lock = threading.Lock()
+
+    def _fill(self, n):
+        while len(self._buf) < n:
+            chunk = self.sock.recv(max(n - len(self._buf), 65536))
+            if not chunk:
                 raise ConnectionResetError("Server closed connection")
+            self._buf += chunk
+
+    def read_frame(self):
+        self._fill(4)
+        length = struct.unpack("!I", self._buf[:4])[0]
+        compressed = length & COMPRESSED_FLAG
+        length &= ~COMPRESSED_FLAG
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame too large: {length}")
+        if compressed and self.codec is None:
+            raise ValueError("Compressed frame without negotiated compression")
+        del self._buf[:4]
+        self._fill(length)
+        data = bytes(self._buf[:length])
+        del self._buf[:length]
+        return self.codec.decompress(data) if compressed else data
+
+    def read_some(self, max_n):
+        if not self._buf:
+            return self.sock.recv(max_n)
+        data = bytes(self._buf[:max_n])
+        del self._buf[:max_n]
+        return data
 
+def _reader(sock):
+    r = _frame_readers.get(sock)
+    if r is None:
+        r = _frame_readers[sock] = FrameReader(sock)
+    return r
+
+def send_msg(sock, msg):
+    payload = json.dumps(msg).encode()
+    reader = _reader(sock)
+    frame = struct.pack("!I", len(payload)) + payload
+    if reader.codec and len(payload) >= COMPRESSION_MIN_SIZE:
+        packed = reader.codec.compress(payload)
+        if len(packed) < len(payload):
+            frame = struct.pack("!I", len(packed) | COMPRESSED_FLAG) + packed
+    with reader.send_lock:
+        sock.sendall(frame)
+
+def heartbeat_loop(sock):
+    """連線期間定期在主連線 (以及 listener 連線) 送心跳，伺服器不會回應"""
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        try:
+            send_msg(sock, {"cmd": "heartbeat"})
+        except OSError:
+            return  # 主連線已關閉
+        listener = listen_socket
+        if listener:
             try:
-                temp_json = json.loads(data)
-                # 忽略遊戲開始的廣播，避免干擾同步回應
-                if temp_json.get("type") == "start_game":
-                    continue
-            except json.JSONDecodeError:
+                send_msg(listener, {"cmd": "heartbeat"})
+            except OSError:
                 pass
+
+def enable_compression(sock, name):
+    """套用伺服器在登入回應中選定的壓縮演算法"""
+    if name in supported_codecs():
+        _reader(sock).codec = FrameCodec(name)
+
+def recv_msg(sock):
+    return json.loads(_reader(sock).read_frame().decode())
+
+def recv_raw(sock, max_n):
+    return _reader(sock).read_some(max_n)
+
+def open_data_channel(sock, ticket):
+    """用控制連線拿到的一次性 token 連到資料 port，回傳 (資料連線, 伺服器的第一個回應)。
+    檔案內容只走資料連線，控制連線可以繼續送其他指令。"""
+    ds = socket.create_connection((sock.getpeername()[0], ticket["data_port"]))
+    send_msg(ds, {"token": ticket["token"]})
+    ack = recv_msg(ds)
+    if ack.get("status") not in ("ok", "ready"):
+        ds.close()
+        raise ConnectionError(ack.get("msg", "Data channel refused"))
+    return ds, ack
+
+def send_and_recv(sock, msg, silent=False):
+    try:
+        send_msg(sock, msg)
+        while True:
+            resp = recv_msg(sock)
+            # 忽略遊戲開始的廣播，避免干擾同步回應
+            if resp.get("type") == "start_game":
+                continue
             break
     except (ConnectionResetError, BrokenPipeError, OSError) as e:
         if not silent:
@@ -52,60 +194,54 @@ def send_and_recv(sock, msg, silent=False):
         raise
 
     if silent:
-        return data
+        return resp
 
-    pass # print(f"[DEBUG] Received raw: {data}")
-    
     # 統一顯示邏輯
-    try:
-
-        resp = json.loads(data)
-
-        if "room_info" in resp:
-            info = resp["room_info"]
-            ready_status = [
-                f"{u}({'ready' if info['ready'].get(u, False) else 'not ready'})"
-                for u in info["members"]
-            ]
-            print("\n--- ROOM INFO ---")
-            print(f"Room Name: {info.get('room_name', 'Unknown')}")
-            print(f"Host: {info.get('host', 'Unknown')}")
-            print(f"Members: {', '.join(ready_status)}")
-            print(f"Game: {info.get('game_id', 'Unknown')}")
-            print(f"Private: {'Yes' if info.get('private') else 'No'}")
-            print(f"Open: {'Yes' if info.get('open') else 'No'}")
-        elif "rooms" in resp:
-            rooms = resp.get("rooms", [])
-            if rooms:
-                print("\n--- PUBLIC ROOMS ---")
-                for i, room in enumerate(rooms, 1):
-                    status = "Open" if room.get("open", False) else "Closed"
-                    print(f"{i}. {room['name']} (Host: {room['host']}, {status})")
-            else:
-                print("\nNo public rooms available.")
-        elif "users" in resp:
-            users = resp.get("users", [])
-            if users:
-                print("\n--- ONLINE USERS ---")
-                for i, user in enumerate(users, 1):
-                    print(f"{i}. {user}")
-            else:
-                print("\nNo users online.")
-        elif "invitations" in resp: # [新增] 支援邀請列表顯示
-            invites = resp.get("invitations", [])
-            # 這裡只做純資料回傳，顯示邏輯在 handle_invitations
+    if "room_info" in resp:
+        print_room_info(resp["room_info"])
+    elif "rooms" in resp:
+        rooms = resp.get("rooms", [])
+        if rooms:
+            print("\n--- PUBLIC ROOMS ---")
+            for i, room in enumerate(rooms, 1):
+                status = "Open" if room.get("open", False) else "Closed"
+                print(f"{i}. {room['name']} (Host: {room['host']}, {status})")
         else:
-            msg_text = resp.get("msg", data)
-            status = resp.get("status", "unknown")
-            if status == "error":
-                print(f"\n[Server Error] {msg_text}")
-            elif "success" in msg_text.lower() or status == "ok":
-                print(f"\n[Server] ✓ {msg_text}")
-            else:
-                print(f"\n[Server] {msg_text}")
-    except json.JSONDecodeError:
-        print(f"\n[Server] {data}")
-    return data
+            print("\nNo public rooms available.")
+    elif "users" in resp:
+        users = resp.get("users", [])
+        if users:
+            print("\n--- ONLINE USERS ---")
+            for i, user in enumerate(users, 1):
+                print(f"{i}. {user}")
+        else:
+            print("\nNo users online.")
+    elif "invitations" in resp: # [新增] 支援邀請列表顯示
+        invites = resp.get("invitations", [])
+        # 這裡只做純資料回傳，顯示邏輯在 handle_invitations
+    else:
+        msg_text = resp.get("msg", "")
+        status = resp.get("status", "unknown")
+        if status == "error":
+            print(f"\n[Server Error] {msg_text}")
+        elif "success" in msg_text.lower() or status == "ok":
+            print(f"\n[Server] ✓ {msg_text}")
+        else:
+            print(f"\n[Server] {msg_text}")
+    return resp
+
+def print_room_info(info):
+    ready_status = [
+        f"{u}({'ready' if info['ready'].get(u, False) else 'not ready'})"
+        for u in info["members"]
+    ]
+    print("\n--- ROOM INFO ---")
+    print(f"Room Name: {info.get('room_name', 'Unknown')}")
+    print(f"Host: {info.get('host', 'Unknown')}")
+    print(f"Members: {', '.join(ready_status)}")
+    print(f"Game: {info.get('game_id', 'Unknown')}")
+    print(f"Private: {'Yes' if info.get('private') else 'No'}")
+    print(f"Open: {'Yes' if info.get('open') else 'No'}")
 
 def get_yes_no(prompt):
     while True:
@@ -131,6 +267,13 @@ def zip_game(game_dir_path):
     output_path = shutil.make_archive(zip_filename, 'zip', game_dir_path)
     return output_path
 
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
 def upload_game(sock, game_dir, username):
     # 1. Select / Input Game Directory
     if not game_dir:
@@ -240,24 +383,38 @@ def upload_game(sock, game_dir, username):
         "cmd": "upload_game",
         "file_name": file_name,
         "file_size": file_size,
+        "sha256": file_sha256(zip_path),
         "user": username 
     }
-    sock.send(json.dumps(req).encode())
+    send_msg(sock, req)
     
-    ack = sock.recv(1024).decode()
-    if "READY" not in ack:
-        print(f"Server rejected upload: {ack}")
+    ack = recv_msg(sock)
+    if ack.get("status") != "ready":
+        print(f"Server rejected upload: {ack.get('msg', ack)}")
         os.remove(zip_path)
         return
 
-    with open(zip_path, 'rb') as f:
-        while True:
-            bytes_read = f.read(4096)
-            if not bytes_read: break
-            sock.sendall(bytes_read)
-    
-    print("File sent. Waiting for confirmation...")
-    resp = json.loads(sock.recv(1024).decode())
+    try:
+        data_sock, ready = open_data_channel(sock, ack)
+    except OSError as e:
+        print(f"Server rejected upload: {e}")
+        os.remove(zip_path)
+        return
+
+    with data_sock:
+        # 伺服器已收到前一次中斷上傳的部分，從該位置續傳
+        offset = ready.get("offset", 0)
+        if offset:
+            print(f"Resuming upload at {offset}/{file_size} bytes...")
+        with open(zip_path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                bytes_read = f.read(65536)
+                if not bytes_read: break
+                data_sock.sendall(bytes_read)
+
+        print("File sent. Waiting for confirmation...")
+        resp = recv_msg(data_sock)
     if resp['status'] == 'ok':
         print(f"SUCCESS: {resp['msg']}")
     else:
@@ -269,8 +426,7 @@ def remove_game(sock, username):
     """Developer: Remove a game from the store (Interactive)"""
     print("\n--- Remove Game ---")
     try:
-        data = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True)
-        resp = json.loads(data)
+        resp = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True)
         all_games = resp.get("games", [])
         
         # Filter games owned by this user
@@ -463,15 +619,28 @@ def ensure_download_dir(username):
     if not os.path.exists(base): os.makedirs(base)
     return base
 
-def download_game(sock, game_id, username):
-    print(f"\n[System] Requesting download for {game_id}...")
+def download_game(sock, game_id, username, background=False):
+    """下載並安裝遊戲。background=True 時檔案在背景執行緒下載，選單可以繼續使用"""
+    if game_id in active_downloads:
+        print(f"[System] {game_id} is already downloading.")
+        return
+    user_download_dir = ensure_download_dir(username)
+    # 下載中的檔案先寫到 .part，中斷後再次下載時從已收到的位置續傳
+    part_path = os.path.join(user_download_dir, f"{game_id}.zip.part")
+    sha_path = part_path + ".sha256"
+
     req = {"cmd": "download_game", "game_id": game_id}
-    sock.send(json.dumps(req).encode())
+    if os.path.exists(part_path) and os.path.exists(sha_path):
+        with open(sha_path, 'r') as f:
+            req["if_sha256"] = f.read().strip()
+        req["offset"] = os.path.getsize(part_path)
+
+    print(f"\n[System] Requesting download for {game_id}...")
+    send_msg(sock, req)
     
-    header_data = sock.recv(1024).decode()
     try:
-        header = json.loads(header_data)
-    except:
+        header = recv_msg(sock)
+    except ValueError:
         print("[Error] Invalid header")
         return
 
@@ -479,44 +648,166 @@ def download_game(sock, game_id, username):
         print(f"[Error] Server refused: {header.get('msg')}")
         return
 
+    with open(sha_path, 'w') as f:
+        f.write(header.get("sha256") or "")
+
+    if background:
+        def run():
+            try:
+                receive_game(sock, header, game_id, username, False)
+            finally:
+                active_downloads.pop(game_id, None)
+        t = threading.Thread(target=run, daemon=True)
+        active_downloads[game_id] = t
+        t.start()
+        print(f"[System] Downloading {header['game_info'].get('name', game_id)} in the background, "
+              "you will be notified when it is installed.")
+        return
+    receive_game(sock, header, game_id, username, True)
+
+def receive_game(sock, header, game_id, username, show_progress):
+    """從資料連線接收遊戲 zip、驗證後解壓安裝"""
+    user_download_dir = ensure_download_dir(username)
+    part_path = os.path.join(user_download_dir, f"{game_id}.zip.part")
+    sha_path = part_path + ".sha256"
+
     file_size = header["file_size"]
+    offset = header.get("offset", 0)
+    length = header.get("length", file_size - offset)
+    checksum = header.get("sha256")
     game_name = header["game_info"].get("name", game_id)
-    print(f"[System] Downloading {game_name} ({file_size} bytes)...")
-    
-    sock.send("READY".encode())
-
-    received_size = 0
-    buffer = io.BytesIO()
-    while received_size < file_size:
-        chunk_size = min(4096, file_size - received_size)
-        data = sock.recv(chunk_size)
-        if not data: break
-        buffer.write(data)
-        received_size += len(data)
-        sys.stdout.write(f"\rProgress: {int(received_size/file_size*100)}%")
-        sys.stdout.flush()
-    
-    print("\n[System] Extracting...")
-    user_download_dir = ensure_download_dir(username)
+    if offset:
+        print(f"[System] Resuming {game_name} at {offset}/{file_size} bytes...")
+    elif show_progress:
+        print(f"[System] Downloading {game_name} ({file_size} bytes)...")
+
+    try:
+        data_sock, _ = open_data_channel(sock, header)
+    except OSError as e:
+        print(f"\n[Error] Download of {game_name} failed: {e}")
+        return
+
+    received_size = offset
+    with data_sock, open(part_path, 'r+b' if offset else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        try:
+            while received_size < offset + length:
+                chunk_size = min(65536, offset + length - received_size)
+                data = recv_raw(data_sock, chunk_size)
+                if not data: break
+                f.write(data)
+                received_size += len(data)
+                if show_progress:
+                    sys.stdout.write(f"\rProgress: {int(received_size/file_size*100)}%")
+                    sys.stdout.flush()
+        except OSError as e:
+            print(f"\n[Error] Download interrupted: {e}")
+        if received_size < file_size:
+            print(f"\n[Error] Download of {game_name} incomplete ({received_size}/{file_size} bytes). "
+                  "Download again to resume.")
+            return
+
+    if checksum and file_sha256(part_path) != checksum:
+        print(f"\n[Error] Checksum mismatch, discarding download of {game_name}. Please try again.")
+        os.remove(part_path)
+        os.remove(sha_path)
+        return
+
+    if show_progress:
+        print("\n[System] Extracting...")
     game_install_dir = os.path.join(user_download_dir, game_id)
     
     if os.path.exists(game_install_dir): shutil.rmtree(game_install_dir)
     os.makedirs(game_install_dir)
     
     try:
-        with zipfile.ZipFile(buffer) as zf:
+        with zipfile.ZipFile(part_path) as zf:
             zf.extractall(game_install_dir)
-        print(f"[System] Installed at {game_install_dir}")
+        if show_progress:
+            print(f"[System] Installed at {game_install_dir}")
+        else:
+            print(f"\n[System] {game_name} installed at {game_install_dir}")
     except Exception as e:
         print(f"[Error] Install failed: {e}")
+    os.remove(part_path)
+    os.remove(sha_path)
+
+def update_game(sock, game_id, username):
+    """只下載與伺服器版本不同的檔案來更新已安裝的遊戲 (沒有本地安裝時改為完整下載)"""
+    game_install_dir = os.path.join(ensure_download_dir(username), game_id)
+    if not os.path.isdir(game_install_dir):
+        download_game(sock, game_id, username)
+        return
+
+    index = send_and_recv(sock, {"cmd": "get_file_index", "game_id": game_id}, silent=True)
+    if index.get("status") != "ok":
+        print(f"[Error] {index.get('msg')}")
+        return
+    files = index["files"]
+    for rel in files:
+        parts = rel.split("/")
+        if os.path.isabs(rel) or ".." in parts:
+            print(f"[Error] Unsafe path from server: {rel}")
+            return
+
+    # 比對本地檔案的 hash，找出需要下載與需要刪除的檔案
+    local = {}
+    for root, _, names in os.walk(game_install_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            local[os.path.relpath(path, game_install_dir).replace(os.sep, "/")] = path
+    changed = [rel for rel, info in files.items()
+               if rel not in local or file_sha256(local[rel]) != info["sha256"]]
+    obsolete = [rel for rel in local if rel not in files]
+
+    if changed:
+        send_msg(sock, {"cmd": "download_files", "game_id": game_id,
+                        "version": index["version"], "files": changed})
+        header = recv_msg(sock)
+        if header.get("status") != "ok":
+            print(f"[Error] Server refused: {header.get('msg')}")
+            return
+        print(f"[System] Updating to v{header['version']}: {len(changed)} changed files "
+              f"({header['total_size']} bytes)...")
+
+        # 先全部下載到暫存目錄並驗證，再逐一替換，避免中斷時留下半更新的遊戲
+        staging_dir = os.path.join(ensure_download_dir(username), f".{game_id}.patch")
+        if os.path.exists(staging_dir): shutil.rmtree(staging_dir)
+        data_sock, _ = open_data_channel(sock, header)
+        with data_sock:
+            for entry in header["files"]:
+                staged = os.path.join(staging_dir, *entry["path"].split("/"))
+                os.makedirs(os.path.dirname(staged), exist_ok=True)
+                remaining = entry["size"]
+                with open(staged, 'wb') as f:
+                    while remaining > 0:
+                        data = recv_raw(data_sock, min(65536, remaining))
+                        if not data: raise ConnectionResetError("Server closed connection")
+                        f.write(data)
+                        remaining -= len(data)
+                if file_sha256(staged) != entry["sha256"]:
+                    print(f"[Error] Checksum mismatch on {entry['path']}, update aborted.")
+                    shutil.rmtree(staging_dir)
+                    return
+
+        for entry in header["files"]:
+            target = os.path.join(game_install_dir, *entry["path"].split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(os.path.join(staging_dir, *entry["path"].split("/")), target)
+        shutil.rmtree(staging_dir)
+
+    for rel in obsolete:
+        os.remove(local[rel])
+    print(f"[System] {game_id} updated to v{index['version']} "
+          f"({len(changed)} files downloaded, {len(obsolete)} removed).")
 
 def show_game_details(sock, username, game_id):
     """顯示遊戲詳情與評論頁面"""
     while True:
         try:
             # 獲取詳情
-            data = send_and_recv(sock, {"cmd": "get_game_details", "game_id": game_id}, silent=True)
-            resp = json.loads(data)
+            resp = send_and_recv(sock, {"cmd": "get_game_details", "game_id": game_id}, silent=True)
             
             if resp.get("status") != "ok":
                 print(f"[Error] {resp.get('msg')}")
@@ -570,8 +861,7 @@ def show_game_details(sock, username, game_id):
             sel = input("Choice: ")
             
             if sel == "1":
-                download_game(sock, game_id, username)
-                print("\n[System] Installation complete.")
+                download_game(sock, game_id, username, background=True)
                 input("Press Enter to return to Main Menu...")
                 return "back_to_main"
             
@@ -608,8 +898,7 @@ def view_store(sock, username):
     """瀏覽商城列表"""
     while True:
         try:
-            data = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True)
-            resp = json.loads(data)
+            resp = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True)
             games = resp.get("games", [])
             
             print("\n=== GAME STORE ===")
@@ -641,19 +930,156 @@ def view_store(sock, username):
             print(f"[Error] Store error: {e}")
             break
 
+def quick_match(sock, username):
+    """快速配對: 選一款遊戲排隊，湊滿人數後伺服器自動開房並開始遊戲"""
+    global matching_game
+    games = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True).get("games", [])
+    if not games:
+        print("No games available.")
+        return
+    print("\nSelect a game to match:")
+    for i, g in enumerate(games, 1):
+        print(f"{i}. {g['name']}")
+    sel = input("Enter game number: ")
+    if not sel.isdigit() or int(sel) < 1 or int(sel) > len(games):
+        print("Invalid choice.")
+        return
+    game = games[int(sel) - 1]
+    game_id = game["game_id"]
+    if game_id in active_downloads:
+        print(f"[System] {game_id} is still downloading, please wait.")
+        return
+
+    # 配對成功後遊戲會直接開始，所以先確認本地安裝的是最新版本
+    local_manifest = os.path.join("downloads", username, game_id, "manifest.json")
+    local_ver = "0.0.0"
+    if os.path.exists(local_manifest):
+        try:
+            with open(local_manifest, 'r') as f:
+                local_ver = json.load(f).get("version", "0.0.0")
+        except: pass
+    if not os.path.exists(local_manifest) or local_ver < game.get("version", "0.0.0"):
+        print(f"[System] Installing the latest {game['name']} before matching...")
+        update_game(sock, game_id, username)
+        if not os.path.exists(local_manifest):
+            print("[Error] Install failed, cannot start matching.")
+            return
+
+    matching_game = game["name"]  # 先設定，避免配對結果比回應早到
+    resp = send_and_recv(sock, {"cmd": "matchmake", "game_id": game_id})
+    if resp.get("status") != "ok":
+        matching_game = None
+
+def browse_rooms(sock, join=False):
+    """分頁瀏覽公開房間，可先選遊戲篩選；join=True 時只列出可加入的房間並回傳玩家選的房間名稱"""
+    req = {"cmd": "list_rooms", "open_only": join}
+    games = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True).get("games", [])
+    names = {g["game_id"]: g["name"] for g in games}
+    if games:
+        print("\nFilter by game:")
+        for i, g in enumerate(games, 1):
+            print(f"{i}. {g['name']}")
+        sel = input("Enter game number (Enter for all games): ").strip()
+        if sel.isdigit() and 1 <= int(sel) <= len(games):
+            req["game_id"] = games[int(sel) - 1]["game_id"]
+
+    offset = 0
+    while True:
+        resp = send_and_recv(sock, dict(req, offset=offset), silent=True)
+        if resp.get("status") != "ok":
+            print(f"\n[Server Error] {resp.get('msg')}")
+            return None
+        rooms = resp.get("rooms", [])
+        total = resp.get("total", len(rooms))
+        if not rooms:
+            print("\nNo open rooms." if join else "\nNo public rooms available.")
+            return None
+        # 伺服器依人數由多到少排序，快滿的房間排在前面
+        print(f"\n--- {'OPEN' if join else 'PUBLIC'} ROOMS {offset + 1}-{offset + len(rooms)} of {total} ---")
+        for i, r in enumerate(rooms, 1):
+            status = "Open" if r.get("open", False) else "Full"
+            game = names.get(r.get("game_id"), r.get("game_id"))
+            print(f"{i}. {r['name']} ({game}, {r.get('players')}/{r.get('max_players')} players, "
+                  f"Host: {r['host']}, {status})")
+
+        has_next = offset + len(rooms) < total
+        if not join and not has_next and offset == 0:
+            return None  # 只有一頁
+        prompt = "Enter room number to join, " if join else ""
+        sel = input(f"{prompt}n/p for next/previous page, Enter to go back: ").strip().lower()
+        if sel == "n" and has_next:
+            offset += len(rooms)
+        elif sel == "p" and offset > 0:
+            offset = max(offset - resp.get("limit", len(rooms)), 0)
+        elif join and sel.isdigit() and 1 <= int(sel) <= len(rooms):
+            return rooms[int(sel) - 1]["name"]
+        elif sel == "":
+            return None
+        else:
+            print("Invalid input.")
+
 def check_user_room(sock, username):
     try:
-        sock.send(json.dumps({"cmd": "get_user_room", "user": username}).encode())
-        data = sock.recv(1024).decode()
-        if not data: return None
-        return json.loads(data).get("room_name")
+        send_msg(sock, {"cmd": "get_user_room", "user": username})
+        return recv_msg(sock).get("room_name")
     except: return None
 
+def apply_room_update(username, ev):
+    """套用伺服器推送的房間變化 (listener 執行緒呼叫)，回傳要顯示給玩家的通知"""
+    event = ev.get("event")
+    user = ev.get("user")
+    with room_cond:
+        if event == "room_state":
+            info = ev.get("room_info")
+            if info:
+                info["room_name"] = ev.get("room_name")
+            room_state.update(synced=True, room_name=ev.get("room_name"), info=info)
+            room_cond.notify_all()
+            return None
+        info = room_state["info"]
+        if not info or ev.get("room_name") != room_state["room_name"]:
+            return None  # 不是目前所在房間的事件
+        if event == "member_joined":
+            if user not in info["members"]:
+                info["members"].append(user)
+            info["ready"][user] = False
+            info["open"] = len(info["members"]) < info.get("max_players", 2)
+            note = f"{user} joined the room."
+        elif event == "member_left":
+            if user in info["members"]:
+                info["members"].remove(user)
+            info["ready"].pop(user, None)
+            info["open"] = True
+            note = f"{user} left the room."
+        elif event == "host_changed":
+            info["host"] = ev.get("host")
+            note = "You are now the host." if info["host"] == username else f"{info['host']} is now the host."
+        elif event == "ready_changed":
+            info["ready"][user] = ev.get("ready")
+            note = f"{user} is {'ready' if ev.get('ready') else 'not ready'}."
+        else:
+            return None
+        room_cond.notify_all()
+    return None if user == username else note
+
+def local_room_info():
+    """本地房間狀態的複本 (尚未同步或不在房間時為 None)"""
+    with room_cond:
+        return copy.deepcopy(room_state["info"]) if room_state["synced"] else None
+
+def wait_for_room(room_name, timeout=2):
+    """等 listener 收到自己進出房間的事件 (伺服器在回應指令前就會送出)"""
+    with room_cond:
+        room_cond.wait_for(lambda: not room_state["synced"] or room_state["room_name"] == room_name, timeout)
+
+def reset_room_state():
+    with room_cond:
+        room_state.update(synced=False, room_name=None, info=None)
+
 def handle_invitations(sock, username):
     try:
-        sock.send(json.dumps({"cmd": "manage_invitations"}).encode())
-        data = sock.recv(1024).decode()
-        invitations = json.loads(data).get("invitations", [])
+        send_msg(sock, {"cmd": "manage_invitations"})
+        invitations = recv_msg(sock).get("invitations", [])
 
         if not invitations:
             print("\nNo pending invitations.")
@@ -669,18 +1095,17 @@ def handle_invitations(sock, username):
             if 0 <= idx < len(invitations):
                 room_name = invitations[idx]
                 choice = get_yes_no(f"Accept invitation to {room_name}? (y/n): ")
-                sock.send(json.dumps({
+                send_msg(sock, {
                     "cmd": "respond_invitation",
                     "user": username,
                     "room_name": room_name,
                     "accept": choice 
-                }).encode())
+                })
                 
-                resp_data = sock.recv(1024).decode()
-                try:
-                    print(f"\n[Server] {json.loads(resp_data).get('msg', resp_data)}")
-                except:
-                    print(f"\n[Server] {resp_data}")
+                resp = recv_msg(sock)
+                print(f"\n[Server] {resp.get('msg', resp)}")
+                if choice and resp.get("status") == "ok":
+                    wait_for_room(room_name)
             else:
                 print("Invalid selection.")
     except Exception as e:
@@ -689,7 +1114,7 @@ def handle_invitations(sock, username):
 def invite_player(sock, username, current_room):
     resp = send_and_recv(sock, {"cmd": "invite_player", "user": username}, silent=True)
     try:
-        users = json.loads(resp).get("available_users", [])
+        users = resp.get("available_users", [])
     except: users = []
 
     if not users:
@@ -712,23 +1137,33 @@ def invite_player(sock, username, current_room):
             time.sleep(1)
 
 def listen_for_game_start(main_sock, username):
-    global game_started, game_info, listen_socket
+    global game_started, game_info, listen_socket, matching_game
     try:
         listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         listen_socket.connect((HOST, PORT))
-        listen_socket.send(json.dumps({"cmd": "_listener", "user": username}).encode())
+        send_msg(listen_socket, {"cmd": "_listener", "user": username, "compression": supported_codecs()})
         listen_socket.settimeout(None)
     except Exception as e:
         print(f"[WARNING] Listener init failed: {e}")
         return
+    my_socket = listen_socket
 
     while True:
         try:
-            data = listen_socket.recv(1024).decode()
-            if not data: break
+            resp = recv_msg(listen_socket)
             try:
-                resp = json.loads(data)
-                if resp.get("type") == "start_game":
+                if resp.get("type") == "compression":
+                    # 伺服器選定 listener 連線的壓縮演算法，之後的推播可能經過壓縮
+                    enable_compression(listen_socket, resp.get("compression"))
+                elif resp.get("type") == "room_update":
+                    note = apply_room_update(username, resp)
+                    if note:
+                        print(f"\n[Room] {note}")
+                elif resp.get("type") == "matchmaking":
+                    # 配對成功、取消或開房失敗，都表示已經不在排隊中
+                    matching_game = None
+                    print(f"\n[Match] {resp.get('msg')}")
+                elif resp.get("type") == "start_game":
                     game_info = resp
                     game_started = True
                     game_event.set()
@@ -782,32 +1217,40 @@ def listen_for_game_start(main_sock, username):
                             print("\n[SYSTEM] Game has ended. Press [Enter] to refresh menu...")
                             try:
                                 if listen_socket:
-                                    listen_socket.send(json.dumps({
+                                    send_msg(listen_socket, {
                                         "cmd": "set_ready", "user": username, "ready": False
-                                    }).encode())
+                                    })
                             except: pass
                         threading.Thread(target=wait_for_game).start()
                     except Exception as e:
                         print(f"[ERROR] Launch failed: {e}")
                         game_process_event.clear()
-            except json.JSONDecodeError: pass
-        except (ConnectionResetError, OSError): break
+            except ValueError: pass
+        except (ConnectionResetError, OSError, ValueError): break
 
+    # 沒有推播之後本地房間狀態不再更新，改回向伺服器查詢
+    if listen_socket is my_socket:
+        reset_room_state()
     if listen_socket:
         try: listen_socket.close()
         except: pass
 
 def main_menu(sock, username):
+    global matching_game
     room_name = None
     while True:
         try:
-            if room_name is None:
+            if room_state["synced"]:
+                room_name = room_state["room_name"]  # listener 推送的本地狀態
+            elif room_name is None:
                 room_name = check_user_room(sock, username)
             in_room = room_name is not None
 
             print("\n--- PLAYER MENU ---")
             if in_room: print(f"Current location: Room {room_name}")
             else: print("Current location: Lobby")
+            if not in_room and matching_game:
+                print(f"Searching for a {matching_game} match...")
 
             if not in_room:
                 print("1. Create a room")
@@ -816,8 +1259,9 @@ def main_menu(sock, username):
                 print("4. List public rooms")
                 print("5. List online users")
                 print("6. Manage invitations")
-                print("7. Logout")
-                print("8. Exit")
+                print("7. Cancel matchmaking" if matching_game else "7. Quick match")
+                print("8. Logout")
+                print("9. Exit")
             else:
                 print("1. Leave room")
                 print("2. Invite player")
@@ -835,8 +1279,7 @@ def main_menu(sock, username):
                 if choice == "1":
                     print("\nSelect a game for this room:")
                     try:
-                        data = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True)
-                        games = json.loads(data).get("games", [])
+                        games = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True).get("games", [])
                         if not games:
                             print("No games available.")
                             continue
@@ -853,12 +1296,13 @@ def main_menu(sock, username):
                         name = input("Enter room name: ")
                         private = get_yes_no("Private room? (y/n): ")
                         
-                        data = send_and_recv(sock, {
+                        resp = send_and_recv(sock, {
                             "cmd": "create_room", "room_name": name, 
                             "private": private, "game_id": selected_game_id
                         })
-                        if json.loads(data).get("status") == "ok":
+                        if resp.get("status") == "ok":
                             room_name = name
+                            wait_for_room(name)
                         else: room_name = None
                     except Exception as e:
                         print(f"[Error] Create room failed: {e}")
@@ -866,36 +1310,29 @@ def main_menu(sock, username):
 
                 elif choice == "2":
                     try:
-                        data = send_and_recv(sock, {"cmd": "list_rooms"}, silent=True)
-                        rooms = json.loads(data).get("rooms", [])
-                        if not rooms:
-                            print("\nNo public rooms.")
-                            continue
-                        print("\nAvailable Rooms:")
-                        for i, r in enumerate(rooms, 1):
-                            status = "Open" if r.get("open", False) else "Full"
-                            print(f"{i}. {r['name']} (Host: {r['host']}, {status})")
-                        
-                        sel = input("Enter room number to join: ")
-                        if sel.isdigit():
-                            idx = int(sel) - 1
-                            if 0 <= idx < len(rooms):
-                                name = rooms[idx]['name']
-                                data = send_and_recv(sock, {"cmd": "join_room", "room_name": name})
-                                if json.loads(data).get("status") == "ok":
-                                    room_name = name
-                            else: print("Invalid room.")
-                        else: print("Invalid input.")
+                        name = browse_rooms(sock, join=True)
+                        if name:
+                            resp = send_and_recv(sock, {"cmd": "join_room", "room_name": name})
+                            if resp.get("status") == "ok":
+                                room_name = name
+                                wait_for_room(name)
                     except: pass
 
                 elif choice == "3": view_store(sock, username)
-                elif choice == "4": send_and_recv(sock, {"cmd": "list_rooms"})
+                elif choice == "4": browse_rooms(sock)
                 elif choice == "5": send_and_recv(sock, {"cmd": "list", "online_only": True})
                 elif choice == "6": handle_invitations(sock, username)
-                elif choice == "7": 
+                elif choice == "7":
+                    if matching_game:
+                        send_and_recv(sock, {"cmd": "cancel_matchmake"})
+                        matching_game = None
+                    else:
+                        quick_match(sock, username)
+                elif choice == "8": 
+                    matching_game = None  # 登出時伺服器會把玩家移出配對佇列
                     send_and_recv(sock, {"cmd": "logout"}, silent=True)
                     return
-                elif choice == "8": 
+                elif choice == "9": 
                     send_and_recv(sock, {"cmd": "exit"}, silent=True)
                     sock.close()
                     sys.exit()
@@ -905,19 +1342,23 @@ def main_menu(sock, username):
                 if choice == "1":
                     send_and_recv(sock, {"cmd": "leave_room"})
                     room_name = None
+                    wait_for_room(None)
                 elif choice == "2": invite_player(sock, username, room_name)
-                elif choice == "3": send_and_recv(sock, {"cmd": "get_room_info", "user": username})
+                elif choice == "3":
+                    info = local_room_info()
+                    if info: print_room_info(info)
+                    else: send_and_recv(sock, {"cmd": "get_room_info", "user": username})
                 elif choice == "4": send_and_recv(sock, {"cmd": "list", "online_only": True})
                 elif choice == "5": handle_invitations(sock, username)
                 elif choice == "6":
                     try:
-                        data = send_and_recv(sock, {"cmd": "get_room_info", "user": username}, silent=True)
-                        info = json.loads(data).get("room_info", {})
+                        info = local_room_info() or send_and_recv(sock, {"cmd": "get_room_info", "user": username}, silent=True).get("room_info", {})
                         game_id = info.get("game_id")
+                        if game_id in active_downloads:
+                            print(f"[System] {game_id} is still downloading, please wait.")
+                            continue
                         
-                        store_data = send_and_recv(sock, {"cmd": "get_store_list"}, silent=True)
-                        games_list = json.loads(store_data).get("games", [])
-                        server_game_info = next((g for g in games_list if g["game_id"] == game_id), None)
+                        server_game_info = send_and_recv(sock, {"cmd": "get_game_details", "game_id": game_id}, silent=True).get("game_info")
                         
                         if not server_game_info:
                             print("[Error] Game not found on server.")
@@ -943,7 +1384,7 @@ def main_menu(sock, username):
                             
                             do_update = get_yes_no("Update now? (y/n): ")
                             if do_update:
-                                download_game(sock, game_id, username) # 呼叫下載函式進行更新
+                                update_game(sock, game_id, username) # 只下載有變動的檔案進行更新
                                 print("\n[Success] Update complete! You can now set ready.")
                                 # 更新完不用 continue，讓他也許可以直接按 Ready，或者讓他重按一次比較保險
                             else:
@@ -962,8 +1403,8 @@ def main_menu(sock, username):
                         send_and_recv(sock, {"cmd": "set_ready", "user": username, "ready": state})
                     except: pass
                 elif choice == "7":
-                    data = send_and_recv(sock, {"cmd": "start_game", "user": username})
-                    if json.loads(data).get("status") == "ok":
+                    resp = send_and_recv(sock, {"cmd": "start_game", "user": username})
+                    if resp.get("status") == "ok":
                         print("Waiting for game start...")
                         if game_event.wait(timeout=5):
                             game_process_event.wait()
@@ -1009,6 +1450,7 @@ def start_system():
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.connect((HOST, PORT))
                 print(f"\n[{role_name} Mode] Connected to Server.")
+                threading.Thread(target=heartbeat_loop, args=(s,), daemon=True).start()
                 
                 while True:
                     print(f"\n--- {role_name.upper()} LOGIN ---")
@@ -1031,14 +1473,16 @@ def start_system():
                     elif auth_choice == "2":
                         u = input("Username: ")
                         p = input("Password: ")
-                        data = send_and_recv(s, {
+                        resp = send_and_recv(s, {
                             "cmd": "login", 
                             "username": u, 
                             "password": p,
-                            "role": role 
+                            "role": role,
+                            "compression": supported_codecs()
                         })
                         
-                        if "success" in data.lower():
+                        if resp.get("status") == "ok":
+                            enable_compression(s, resp.get("compression"))
                             if role == "player":
                                 listen_thread = threading.Thread(
                                     target=listen_for_game_start, args=(s, u), daemon=True
@@ -1046,6 +1490,11 @@ def start_system():
                                 listen_thread.start()
                                 main_menu(s, u)
                                 game_event.clear()
+                                # 登出後關閉 listener 連線，下次登入重新同步房間狀態
+                                if listen_socket:
+                                    try: listen_socket.shutdown(socket.SHUT_RDWR)
+                                    except OSError: pass
+                                reset_room_state()
                             else:
                                 developer_menu(s, u)
                             
@@ -5,6 +5,9 @@ DEPLOY_DIR = "deploy_package"
 FILES_TO_COPY = [
     "db_server.py",
     "lobby_server.py",
+    "game_worker.py",
+    "artifact_store.py",
+    "metrics.py",
     "config.py",
     "clean_env.py", 
     "prepare_demo.py",